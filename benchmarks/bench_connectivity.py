@@ -0,0 +1,373 @@
+"""
+Connectivity benchmark & integration rig for the v2, v3, v2+v3 and race methods.
+
+Builds a "client" and a "router" network namespace joined by a veth pair (`eth0` in the client, `lan0` in the router
+with the client's default gateway on it), then runs the probes inside the client namespace. For every method and
+`connection type` it measures the per probe latency & CPU time, and the end to end detection latency while toggling
+either the link (the router's end of the veth goes down, so the client loses carrier) or the gateway (the router stops
+answering pings, but the link stays up).
+
+If namespaces can't be created (not root, no `ip` command, restricted container) it falls back to a fake sysfs tree
+whose carrier files are toggled instead, with a fake gateway on the wired card that stops replying while the card has
+no carrier or the gateway is toggled down. every method is measured then too, but the pings never leave the process:
+an unanswered one takes `--ping-timeout`, an answered one takes no time at all.
+
+Results are written as JSON (by default to benchmarks/results/connectivity-<commit>.json) to compare across commits.
+
+usage: sudo python benchmarks/bench_connectivity.py [--rounds N] [--toggles N] [--output FILE] [--fake-sysfs]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import types
+from time import perf_counter, process_time, sleep
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)  # smart_sleep opens its log files relative to the repository root
+sys.path.insert(0, REPO_ROOT)
+
+CLIENT_NS = "ssbench-client"
+ROUTER_NS = "ssbench-router"
+CLIENT_ADDRESS = "10.77.0.2/24"
+ROUTER_ADDRESS = "10.77.0.1/24"
+METHODS = ["v2", "v3", "v2+v3", "race"]
+CONNECTION_TYPES = ["any", "wired", "wireless"]
+
+
+def ip(*args: str, namespace: str = None):
+    """runs an `ip` command, in `namespace` if given"""
+    command = ["ip"] + (["-n", namespace] if namespace else []) + list(args)
+    subprocess.run(command, check=True, capture_output=True)
+
+
+def setup_namespaces():
+    teardown_namespaces()
+    ip("netns", "add", CLIENT_NS)
+    ip("netns", "add", ROUTER_NS)
+    ip(
+        "link", "add", "eth0", "netns", CLIENT_NS,
+        "type", "veth", "peer", "name", "lan0", "netns", ROUTER_NS,
+    )  # fmt: skip
+    for namespace, device, address in [
+        (CLIENT_NS, "eth0", CLIENT_ADDRESS),
+        (ROUTER_NS, "lan0", ROUTER_ADDRESS),
+    ]:
+        ip("link", "set", "lo", "up", namespace=namespace)
+        ip("addr", "add", address, "dev", device, namespace=namespace)
+        ip("link", "set", device, "up", namespace=namespace)
+    ip(
+        "route",
+        "add",
+        "default",
+        "via",
+        ROUTER_ADDRESS.split("/")[0],
+        namespace=CLIENT_NS,
+    )
+
+
+def teardown_namespaces():
+    for namespace in [CLIENT_NS, ROUTER_NS]:
+        subprocess.run(["ip", "netns", "del", namespace], capture_output=True)
+
+
+class NamespaceRouter:
+    """toggles the fake router, from inside the client namespace"""
+
+    mode = "netns"
+    methods = METHODS
+    has_gateway = True
+
+    def set_link(self, up: bool):
+        ip("link", "set", "lan0", "up" if up else "down", namespace=ROUTER_NS)
+
+    def set_gateway(self, up: bool):
+        subprocess.run(
+            ["ip", "netns", "exec", ROUTER_NS, "sysctl", "-qw",
+             f"net.ipv4.icmp_echo_ignore_all={0 if up else 1}"],
+            check=True,
+        )  # fmt: skip
+
+
+class FakeIcmpProber:
+    """stands in for smart_sleep's IcmpProber, the fake router's gateway replies while its link & itself are up"""
+
+    available = True
+
+    def __init__(self, router: "FakeSysfsRouter"):
+        self.router = router
+        self.timeout = 1.0
+        self.retries = 1
+
+    def probe(self, ip: str, interface: str = None, timeout: float = None):
+        if self.router.link_up and self.router.gateway_up:
+            return 0.0
+        # like a real ping, an unanswered one only gives up after its timeout
+        wait = self.timeout * (self.retries + 1)
+        sleep(wait if timeout is None else min(wait, timeout))
+        return None
+
+
+class FakeSysfsRouter:
+    """
+    a fake /sys/class/net with a wired & a wireless card, whose carrier gets toggled, and a fake gateway on the wired
+    card that can stop replying
+    """
+
+    mode = "fake sysfs"
+    methods = METHODS
+    has_gateway = True
+
+    def __init__(self, smart_sleep):
+        import netifaces
+
+        self.root = tempfile.mkdtemp(prefix="ssbench-sysfs-")
+        for card in ["eth0", "wlan0", "lo"]:
+            os.makedirs(os.path.join(self.root, card))
+        self._write("lo", "1")
+        self._write("wlan0", "0")
+        self.gateway_up = True
+        self.set_link(True)
+        smart_sleep.SYSFS_NET = smart_sleep.SysfsNetReader(self.root)
+        gateway = (ROUTER_ADDRESS.split("/")[0], "eth0", True)
+        gateways = {
+            "default": {netifaces.AF_INET: gateway},
+            netifaces.AF_INET: [gateway],
+        }
+        smart_sleep.GATEWAY_CACHE = types.SimpleNamespace(
+            get=lambda: gateways, hits=0, misses=0
+        )
+        smart_sleep.ICMP_PROBER = FakeIcmpProber(self)
+
+    def _write(self, card: str, carrier: str):
+        for attribute, value in [
+            ("carrier", carrier),
+            ("operstate", "up" if carrier == "1" else "down"),
+        ]:
+            with open(os.path.join(self.root, card, attribute), "w") as file:
+                file.write(value + "\n")
+
+    def set_link(self, up: bool):
+        self.link_up = up
+        self._write("eth0", "1" if up else "0")
+
+    def set_gateway(self, up: bool):
+        self.gateway_up = up
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def measure_probes(probe, connection_type: str, rounds: int) -> dict:
+    """per probe wall clock latency & CPU time (of all threads) in microseconds"""
+    wall, cpu = [], []
+    for _ in range(rounds):
+        cpu_start, start = process_time(), perf_counter()
+        probe(connection_type)
+        wall.append((perf_counter() - start) * 1e6)
+        cpu.append((process_time() - cpu_start) * 1e6)
+    wall.sort()
+    return {
+        "latency median us": statistics.median(wall),
+        "latency p95 us": wall[int(len(wall) * 0.95) - 1],
+        "cpu median us": statistics.median(cpu),
+    }
+
+
+def measure_detection(
+    probe, connection_type: str, toggle, toggles: int, interval: float, timeout: float
+) -> dict:
+    """
+    toggles the router down & back up `toggles` times, probing every `interval` seconds, and times how long after each
+    toggle the probe's result flips. timed from when the toggle command has returned
+    """
+    latencies = {"down": [], "up": []}
+    missed = 0
+    for _ in range(toggles):
+        for direction, up in [("down", False), ("up", True)]:
+            toggle(up)
+            start = perf_counter()
+            while perf_counter() - start < timeout:
+                if probe(connection_type)[0] == up:
+                    latencies[direction].append((perf_counter() - start) * 1e3)
+                    break
+                sleep(interval)
+            else:
+                missed += 1
+                toggle(True)
+    result = {
+        f"detect {direction} median ms": (statistics.median(values) if values else None)
+        for direction, values in latencies.items()
+    }
+    result["missed"] = missed
+    return result
+
+
+def run(router, args) -> list:
+    import smart_sleep
+
+    smart_sleep.logger.setLevel("WARNING")  # don't benchmark the debug logs
+    smart_sleep.ICMP_PROBER.timeout = args.ping_timeout
+    smart_sleep.ICMP_PROBER.retries = 0
+    results = []
+    for method in METHODS:
+        probe = smart_sleep.connectivity_function_factory(method)
+        for connection_type in CONNECTION_TYPES:
+            result = {"method": method, "connection type": connection_type}
+            results.append(result)
+            if method not in router.methods:
+                result["skipped"] = f"needs a gateway, not available with {router.mode}"
+                continue
+            connected = probe(connection_type)[0]
+            result["connected"] = connected
+            result.update(measure_probes(probe, connection_type, args.rounds))
+            if not connected:
+                # eg: wireless, there's no wireless card to take down
+                continue
+            toggles = {"link": router.set_link}
+            if method != "v2" and router.has_gateway:
+                toggles["gateway"] = router.set_gateway
+            for name, toggle in toggles.items():
+                result[f"{name} toggle"] = measure_detection(
+                    probe,
+                    connection_type,
+                    toggle,
+                    args.toggles,
+                    args.interval,
+                    args.detect_timeout,
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rounds", type=int, default=200, help="probes per latency measurement"
+    )
+    parser.add_argument(
+        "--toggles",
+        type=int,
+        default=5,
+        help="down/up cycles per detection measurement",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.01,
+        help="seconds in between probes while detecting",
+    )
+    parser.add_argument(
+        "--detect-timeout",
+        type=float,
+        default=5,
+        help="give up detecting a toggle after these seconds",
+    )
+    parser.add_argument(
+        "--ping-timeout", type=float, default=0.2, help="v3's ping timeout"
+    )
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument(
+        "--fake-sysfs", action="store_true", help="don't try network namespaces"
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # we're inside the client namespace, report back on stdout
+        json.dump(run(NamespaceRouter(), args), sys.stdout)
+        return
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    mode, results = None, None
+    if not args.fake_sysfs:
+        try:
+            setup_namespaces()
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"network namespaces not available ({e}), using a fake sysfs tree")
+        else:
+            try:
+                worker = subprocess.run(
+                    [
+                        "ip",
+                        "netns",
+                        "exec",
+                        CLIENT_NS,
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--worker",
+                    ]
+                    + sys.argv[1:],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+                mode, results = NamespaceRouter.mode, json.loads(worker.stdout)
+            finally:
+                teardown_namespaces()
+    if results is None:
+        import smart_sleep
+
+        router = FakeSysfsRouter(smart_sleep)
+        try:
+            mode, results = router.mode, run(router, args)
+        finally:
+            router.close()
+
+    report = {
+        "benchmark": "connectivity",
+        "commit": commit,
+        "mode": mode,
+        "python": platform.python_version(),
+        "kernel": platform.release(),
+        "settings": {
+            name: getattr(args, name)
+            for name in [
+                "rounds",
+                "toggles",
+                "interval",
+                "detect_timeout",
+                "ping_timeout",
+            ]
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"connectivity-{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"mode: {mode}")
+    print(
+        f"{'method':<8}{'type':<10}{'median µs':>11}{'cpu µs':>9}"
+        f"{'link down ms':>14}{'link up ms':>12}{'gw down ms':>12}{'gw up ms':>10}"
+    )
+    for result in results:
+        if "skipped" in result:
+            print(
+                f"{result['method']:<8}{result['connection type']:<10}  skipped: {result['skipped']}"
+            )
+            continue
+        cells = []
+        for toggle in ["link toggle", "gateway toggle"]:
+            for direction in ["down", "up"]:
+                value = result.get(toggle, {}).get(f"detect {direction} median ms")
+                cells.append("-" if value is None else f"{value:.1f}")
+        print(
+            f"{result['method']:<8}{result['connection type']:<10}"
+            f"{result['latency median us']:>11.1f}{result['cpu median us']:>9.1f}"
+            f"{cells[0]:>14}{cells[1]:>12}{cells[2]:>12}{cells[3]:>10}"
+        )
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
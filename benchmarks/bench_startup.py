@@ -0,0 +1,241 @@
+"""
+Cold start benchmark: import time of smart_sleep, and time from spawning the program to its first phase decision.
+
+The import time is broken down per module with `python -X importtime`. The first phase decision is the first
+"Computer is in ... phase" log line of a daemon started in a scratch directory, with the template config whose night
+phase is moved to cover the current time (so the daemon only checks connectivity, and is killed before it could
+suspend anything), without metrics & telegram alerts. It's timed for `python -m smart_sleep`, the documented way to
+start the program (cached bytecode is used), against a 150ms budget. `python smart_sleep.py` (the script is compiled on
+every start, which alone takes longer than the rest of the start) and the bare interpreter's start are timed for
+reference, since site-packages' .pth hooks alone can eat a good part of it on some systems.
+
+Exits with 1 if the median start of `python -m smart_sleep` misses the budget.
+
+Results are written as JSON (by default to benchmarks/results/startup-<commit>.json) to compare across commits.
+
+usage: python benchmarks/bench_startup.py [--rounds N] [--top N] [--output FILE]
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import py_compile
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = 150
+COMMANDS = {
+    "script": [sys.executable, os.path.join(REPO_ROOT, "smart_sleep.py")],
+    "module": [sys.executable, "-m", "smart_sleep"],
+}
+# the starts that have to make the budget, the others are only timed for reference
+BUDGETED = ["module"]
+
+
+def make_scratch_directory(template: str) -> str:
+    """a directory with logs/ and a config.yaml whose night phase is in progress"""
+    directory = tempfile.mkdtemp(prefix="ssbench-startup-")
+    os.makedirs(os.path.join(directory, "logs"))
+    with open(template) as file:
+        config = yaml.safe_load(file)
+    for key in ["metrics", "adaptive_timeout", "wake_planner"]:
+        config.pop(key, None)
+    config["telegram"] = {
+        "BOT_TOKEN": "",
+        "CHAT_ID": "",
+    }  # alerts are only sent with a token
+    now = datetime.datetime.now()
+    config["night phase"].update(
+        {
+            "start time": (now - datetime.timedelta(minutes=1)).strftime("%H:%M"),
+            "end time": (now + datetime.timedelta(hours=2)).strftime("%H:%M"),
+            "timeout": 60,
+        }
+    )
+    config["morning phase"].update(
+        {
+            "start time": (now + datetime.timedelta(hours=3)).strftime("%H:%M"),
+            "end time": (now + datetime.timedelta(hours=4)).strftime("%H:%M"),
+        }
+    )
+    config["logging level"] = 20
+    with open(os.path.join(directory, "config.yaml"), "w") as file:
+        yaml.safe_dump(config, file)
+    return directory
+
+
+def environment() -> dict:
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, PYTHONUNBUFFERED="1")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def import_times(directory: str, top: int) -> dict:
+    """the total & the slowest modules (cumulative, in ms) of importing smart_sleep"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import smart_sleep"],
+        cwd=directory,
+        env=environment(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(own) / 1e3, int(cumulative) / 1e3, depth))
+    # a module is listed after everything it imported. walk back from smart_sleep to the modules it imported itself,
+    # leaving out what the interpreter's startup imported before it
+    end = next(i for i, module in enumerate(modules) if module[0] == "smart_sleep")
+    start = end
+    while start > 0 and modules[start - 1][3] > 0:
+        start -= 1
+    own_modules = [module for module in modules[start:end] if module[3] == 1]
+    total = modules[end]
+    return {
+        "total ms": total[2],
+        "smart_sleep self ms": total[1],
+        "slowest": [
+            {"module": name, "cumulative ms": cumulative}
+            for name, _, cumulative, _ in sorted(
+                own_modules, key=lambda module: -module[2]
+            )[:top]
+        ],
+    }
+
+
+def bare_interpreter(directory: str) -> float:
+    """ms to start & exit the interpreter without running anything, what's left of the budget is ours"""
+    start = perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], cwd=directory, env=environment())
+    return (perf_counter() - start) * 1e3
+
+
+def first_phase_decision(command: list, directory: str, timeout: float = 10) -> float:
+    """ms from spawning `command` to its first "Computer is in" log line"""
+    start = perf_counter()
+    process = subprocess.Popen(
+        command,
+        cwd=directory,
+        env=environment(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        start_new_session=True,
+    )
+    try:
+        for line in process.stdout:
+            if "Computer is in" in line:
+                return (perf_counter() - start) * 1e3
+            if perf_counter() - start > timeout:
+                break
+        raise RuntimeError(
+            f"{' '.join(command)} made no phase decision, exit code {process.poll()}"
+        )
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rounds", type=int, default=10, help="daemon starts per command"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="how many of the slowest imports to show"
+    )
+    parser.add_argument(
+        "--config",
+        default=os.path.join(REPO_ROOT, "config[TEMPLATE].yaml"),
+        help="the config to start from",
+    )
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    # what `python -m smart_sleep` finds after the first start, or in the docker image
+    py_compile.compile(os.path.join(REPO_ROOT, "smart_sleep.py"), doraise=True)
+    directory = make_scratch_directory(args.config)
+    try:
+        imports = import_times(directory, args.top)
+        starts = {}
+        for name, measure in [("interpreter", bare_interpreter)] + [
+            (name, functools.partial(first_phase_decision, command))
+            for name, command in COMMANDS.items()
+        ]:
+            measure(directory)  # warm up the page cache
+            times = sorted(measure(directory) for _ in range(args.rounds))
+            starts[name] = {
+                "median ms": statistics.median(times),
+                "min ms": times[0],
+                "max ms": times[-1],
+            }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "benchmark": "startup",
+        "commit": commit,
+        "python": platform.python_version(),
+        "budget ms": BUDGET_MS,
+        "budgeted": BUDGETED,
+        "settings": {"rounds": args.rounds, "config": os.path.basename(args.config)},
+        "imports": imports,
+        "first phase decision": starts,
+    }
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"startup-{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(
+        f"import smart_sleep: {imports['total ms']:.1f}ms "
+        f"({imports['smart_sleep self ms']:.1f}ms in smart_sleep itself)"
+    )
+    for module in imports["slowest"]:
+        print(f"  {module['module']:<24}{module['cumulative ms']:>8.1f}ms")
+    print(f"\n{'first phase decision':<22}{'median ms':>10}{'min ms':>9}{'max ms':>9}")
+    missed = []
+    for name, result in starts.items():
+        if name == "interpreter":
+            verdict = "python -c pass, for reference"
+        elif name not in BUDGETED:
+            verdict = "for reference, the script is compiled on every start"
+        elif result["median ms"] <= BUDGET_MS:
+            verdict = "ok"
+        else:
+            verdict = f"over {BUDGET_MS}ms"
+            missed.append(name)
+        print(
+            f"{name:<22}{result['median ms']:>10.1f}{result['min ms']:>9.1f}"
+            f"{result['max ms']:>9.1f}  {verdict}"
+        )
+    print(f"\nresults written to {output}")
+    if missed:
+        print(f"{' & '.join(missed)} missed the {BUDGET_MS}ms budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
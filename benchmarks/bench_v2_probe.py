@@ -0,0 +1,93 @@
+"""
+Micro-benchmark for a single `check_connected_to_internetV2` probe.
+
+Compares the old implementation (forking `ls /sys/class/net` and one `cat` per attribute) against the sysfs reader
+the program uses now.
+
+usage: python benchmarks/bench_v2_probe.py [--rounds N] [--connection-type any|wired|wireless]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)  # smart_sleep opens its log files relative to the repository root
+sys.path.insert(0, REPO_ROOT)
+
+import smart_sleep  # noqa: E402
+
+
+def legacy_check_connected_to_internetV2(connection_type: str = "any"):
+    """the subprocess based V2 probe, as it was before the sysfs reader"""
+
+    def get_card_status(card_name: str) -> int:
+        try:
+            result = int(
+                subprocess.check_output(
+                    ["cat", f"/sys/class/net/{card_name}/carrier"],
+                    stderr=subprocess.DEVNULL,
+                )
+                .decode()
+                .strip("\n")
+            )
+        except subprocess.CalledProcessError:
+            result = (
+                subprocess.check_output(
+                    ["cat", f"/sys/class/net/{card_name}/operstate"]
+                )
+                .decode()
+                .strip("\n")
+            )
+            result = 1 if result == "up" else 0
+        return result
+
+    network_devices = subprocess.check_output(["ls", "/sys/class/net"]).decode().split()
+    wired = [e for e in network_devices if e[0] == "e"]
+    wireless = [w for w in network_devices if w[0] == "w"]
+    devices = {"wired": wired, "wireless": wireless, "any": wired + wireless}
+    connected = [card for card in devices[connection_type] if get_card_status(card)]
+    return bool(connected), tuple(connected)
+
+
+def measure(function, connection_type: str, rounds: int) -> list:
+    """runs `function` `rounds` times and returns the per probe latency in microseconds"""
+    timings = []
+    for _ in range(rounds):
+        start = perf_counter()
+        function(connection_type)
+        timings.append((perf_counter() - start) * 1e6)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument(
+        "--connection-type", default="any", choices=["any", "wired", "wireless"]
+    )
+    args = parser.parse_args()
+
+    smart_sleep.logger.setLevel("WARNING")  # don't benchmark the debug logs
+
+    legacy = legacy_check_connected_to_internetV2(args.connection_type)
+    current = smart_sleep.check_connected_to_internetV2(args.connection_type)
+    assert legacy == current, f"results differ! legacy: {legacy}, sysfs: {current}"
+
+    print(f"devices: {smart_sleep.SYSFS_NET.list_devices()}   result: {current}")
+    print(f"{'implementation':<20}{'median µs':>12}{'p95 µs':>12}{'min µs':>12}")
+    for name, function in [
+        ("subprocess (old)", legacy_check_connected_to_internetV2),
+        ("sysfs pread (new)", smart_sleep.check_connected_to_internetV2),
+    ]:
+        timings = sorted(measure(function, args.connection_type, args.rounds))
+        print(
+            f"{name:<20}{statistics.median(timings):>12.1f}"
+            f"{timings[int(len(timings) * 0.95) - 1]:>12.1f}{timings[0]:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
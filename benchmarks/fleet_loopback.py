@@ -0,0 +1,217 @@
+"""
+Fleet loopback rig: a coordinator and N agents on one machine, talking the real fleet protocol over loopback.
+
+The coordinator & the agents are the program's own FleetCoordinator & FleetAgent, connected over 127.0.0.1 (or a unix
+socket). An agent's suspend is replaced by waiting for a Wake-on-LAN magic packet with its MAC address, which the
+coordinator sends to a UDP socket on 127.0.0.1 instead of the broadcast address. For every fleet size it times how
+long it takes for every agent to connect, to hear the coordinator's decision to sleep (fan out) and to be back after
+the coordinator decides to wake them up (magic packet received, connected again).
+
+Results are written as JSON (by default to benchmarks/results/fleet-<commit>.json) to compare across commits.
+
+usage: python benchmarks/fleet_loopback.py [--agents 1,10,100] [--unix] [--output FILE]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+class MagicPacketListener:
+    """receives the magic packets sent to 127.0.0.1, and tells the agent they're for that it was woken up"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # a whole fleet's packets arrive at this one socket at once, unlike on a real network
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.woken: dict = {}  # mac bytes -> threading.Event
+        self.received_at: dict = {}  # mac bytes -> perf_counter of the first packet
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            try:
+                packet = self.sock.recv(1024)
+            except OSError:
+                return
+            if len(packet) != 102 or packet[:6] != b"\xff" * 6:
+                continue
+            mac = packet[6:12]
+            if mac in self.woken and mac not in self.received_at:
+                self.received_at[mac] = perf_counter()
+                self.woken[mac].set()
+
+    def close(self):
+        self.sock.close()
+
+
+async def run_fleet(size: int, settings: dict, listener: MagicPacketListener) -> dict:
+    loop = asyncio.get_running_loop()
+    # every sleeping agent blocks a worker thread, like it would block on rtcwake
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(size + 4))
+    coordinator = smart_sleep.FleetCoordinator(
+        settings, state_file="fleet_agents.json", wake_retry_interval=1
+    )
+    await coordinator.start()
+    if "port" in settings:
+        settings = dict(settings, port=coordinator.server.sockets[0].getsockname()[1])
+
+    asleep_at = {}
+
+    def suspend_for(mac: bytes):
+        def suspend(until: datetime.datetime):
+            asleep_at[mac] = perf_counter()
+            timeout = (until - smart_sleep.now_local()).total_seconds()
+            if not listener.woken[mac].wait(timeout):
+                raise RuntimeError(f"agent {mac.hex(':')} was never woken up")
+
+        return suspend
+
+    agents = []
+    for number in range(size):
+        mac = bytes([2, 0, 0, 0, number // 256, number % 256])
+        listener.woken[mac] = threading.Event()
+        agent_settings = dict(
+            settings,
+            role="agent",
+            name=f"agent-{number}",
+            mac=mac.hex(":"),
+            broadcast="127.0.0.1",
+            **{"wake port": listener.port},
+        )
+        agents.append(smart_sleep.FleetAgent(agent_settings, suspend_for(mac)))
+
+    async def all_connected(timeout: float = 30):
+        while len(coordinator.connections) < size:
+            if perf_counter() - start > timeout:
+                raise RuntimeError(
+                    f"only {len(coordinator.connections)}/{size} agents connected"
+                )
+            await asyncio.sleep(0.001)
+
+    start = perf_counter()
+    tasks = [loop.create_task(agent.run()) for agent in agents]
+    try:
+        await all_connected()
+        connected = perf_counter() - start
+
+        start = perf_counter()
+        await coordinator.sleep(smart_sleep.now_local() + datetime.timedelta(minutes=1))
+        while len(asleep_at) < size:
+            await asyncio.sleep(0.001)
+        fan_out = sorted(at - start for at in asleep_at.values())
+        while coordinator.connections:
+            await asyncio.sleep(0.001)
+
+        start = perf_counter()
+        await coordinator.wake()
+        await all_connected()
+        back = perf_counter() - start
+        woken = sorted(at - start for at in listener.received_at.values())
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await coordinator.close()
+    return {
+        "agents": size,
+        "connect all ms": connected * 1e3,
+        "sleep fan out median ms": statistics.median(fan_out) * 1e3,
+        "sleep fan out max ms": fan_out[-1] * 1e3,
+        "magic packet median ms": statistics.median(woken) * 1e3,
+        "magic packet max ms": woken[-1] * 1e3,
+        "all back ms": back * 1e3,
+        "wake packets sent": smart_sleep.METRICS.wake_packets,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--agents", default="1,10,100", help="comma separated fleet sizes to run"
+    )
+    parser.add_argument(
+        "--unix", action="store_true", help="talk over a unix socket instead of TCP"
+    )
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    # the program keeps its logs & the fleet's agents relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="ssbench-fleet-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs("logs")
+    global smart_sleep
+    import smart_sleep
+
+    smart_sleep.logger.setLevel("WARNING")
+    results = []
+    try:
+        for size in map(int, args.agents.split(",")):
+            listener = MagicPacketListener()
+            if args.unix:
+                settings = {"role": "coordinator", "socket": f"fleet-{size}.sock"}
+            else:
+                settings = {"role": "coordinator", "host": "127.0.0.1", "port": 0}
+            settings.update({"secret": "loopback", "max agents": size})
+            smart_sleep.METRICS.wake_packets = 0
+            try:
+                results.append(asyncio.run(run_fleet(size, settings, listener)))
+            finally:
+                listener.close()
+                if os.path.exists("fleet_agents.json"):
+                    os.remove("fleet_agents.json")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = subprocess.run(
+        ["git", "-C", REPO_ROOT, "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    report = {
+        "benchmark": "fleet",
+        "commit": commit,
+        "transport": "unix" if args.unix else "tcp",
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"fleet-{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"transport: {report['transport']}")
+    print(
+        f"{'agents':>7}{'connect ms':>12}{'sleep p50':>11}{'sleep max':>11}"
+        f"{'wol p50':>9}{'wol max':>9}{'back ms':>9}{'packets':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['agents']:>7}{result['connect all ms']:>12.1f}"
+            f"{result['sleep fan out median ms']:>11.1f}{result['sleep fan out max ms']:>11.1f}"
+            f"{result['magic packet median ms']:>9.1f}{result['magic packet max ms']:>9.1f}"
+            f"{result['all back ms']:>9.1f}{result['wake packets sent']:>9}"
+        )
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
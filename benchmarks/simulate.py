@@ -0,0 +1,445 @@
+"""
+Virtual clock simulator: replays a connectivity trace through the real main loop, weeks of nights in seconds.
+
+The program's clock (`datetime.now`, `date.today`, `sleep`, `monotonic` & the kernel clocks) is replaced by a virtual
+clock that jumps ahead instead of waiting. `rtcwake` suspends the virtual computer till the alarm, the probes answer
+from the trace instead of the network, and telegram alerts are only counted. Everything else, the phase logic, the
+timeline, the adaptive timeout & the wake planner (which learn from the probe store as the simulation goes), is the
+program's own code.
+
+The trace is either synthetic (the router goes down around `--down` every night and comes back around `--up`, with
+random daytime blips) or recorded: a probe store directory, eg: logs/probes.
+
+The scheduling features the template ships commented out (the adaptive timeout & the wake planner) are turned on with
+the template's values, unless the config sets them. `--without` drops them, to compare against the fixed timeouts.
+
+For every simulated day it reports the wake cycles, time suspended, how long after a change in connectivity the
+program noticed it, and the changes it never noticed. Results are also written as JSON (by default to
+benchmarks/results/simulation-<commit>.json) so scheduling changes can be compared across commits & configs.
+
+usage: python benchmarks/simulate.py [--config FILE] [--days N] [--without KEY] [--trace DIR] [--output FILE]
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEDULING = {
+    "adaptive_timeout": {
+        "min": 5,
+        "max": 600,
+        "min suspend": 60,
+        "history days": 28,
+    },
+    "wake_planner": {"step": 0.25, "margin": 30, "history days": 28},
+}
+sys.path.insert(0, REPO_ROOT)
+
+
+class StopSimulation(Exception):
+    """raised by the virtual clock when the simulation's end is reached"""
+
+
+class VirtualClock:
+    """
+    The simulation's time. `now` is a unix timestamp, `awake` counts only the time the virtual computer was not
+    suspended, like CLOCK_MONOTONIC does.
+    """
+
+    def __init__(self, start: float, end: float):
+        self.start = start
+        self.now = start
+        self.end = end
+        self.awake = 0.0
+
+    def advance(self, seconds: float, suspended: bool = False):
+        self.now += max(0.0, seconds)
+        if not suspended:
+            self.awake += max(0.0, seconds)
+        if self.now >= self.end:
+            raise StopSimulation()
+
+    def clock_gettime(self, clock_id: int) -> float:
+        if clock_id == smart_sleep.CLOCK_MONOTONIC:
+            return self.awake
+        if clock_id == smart_sleep.CLOCK_BOOTTIME:
+            return self.now - self.start
+        return self.now
+
+
+def virtual_datetime_module(clock: VirtualClock) -> types.ModuleType:
+    """a copy of the datetime module, whose `datetime.now()` & `date.today()` read the virtual clock"""
+
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(clock.now, tz)
+
+        @classmethod
+        def today(cls):
+            return cls.fromtimestamp(clock.now)
+
+    class VirtualDate(datetime.date):
+        @classmethod
+        def today(cls):
+            return cls.fromtimestamp(clock.now)
+
+    module = types.ModuleType("datetime")
+    module.__dict__.update(datetime.__dict__)
+    module.datetime = VirtualDatetime
+    module.date = VirtualDate
+    return module
+
+
+class Trace:
+    """the router's state over time, as sorted (timestamp, connected) change points"""
+
+    def __init__(self, changes: list, initial: bool = True):
+        self.changes = sorted(changes)
+        self.times = [time for time, _ in self.changes]
+        self.initial = initial
+
+    def connected(self, at: float) -> bool:
+        index = bisect.bisect_right(self.times, at) - 1
+        return self.changes[index][1] if index >= 0 else self.initial
+
+    @classmethod
+    def synthetic(
+        cls,
+        start: datetime.datetime,
+        days: int,
+        down: datetime.timedelta,
+        up: datetime.timedelta,
+        jitter: float,
+        blips: float,
+        seed: int,
+    ) -> "Trace":
+        """
+        :param down: time of the day the router goes down at
+        :param up: time of the day (the day after) it comes back up at
+        :param jitter: seconds either way the times vary by
+        :param blips: chance of a short outage during the day
+        """
+        rng = random.Random(seed)
+        changes = []
+        for day in range(-1, days + 1):
+            midnight = datetime.datetime.combine(
+                start.date() + datetime.timedelta(days=day), datetime.time.min
+            )
+            went_down = (
+                midnight
+                + down
+                + datetime.timedelta(seconds=rng.uniform(-jitter, jitter))
+            )
+            came_up = (
+                midnight
+                + up
+                + datetime.timedelta(days=1, seconds=rng.uniform(-jitter, jitter))
+            )
+            changes += [(went_down.timestamp(), False), (came_up.timestamp(), True)]
+            if rng.random() < blips:
+                blip = midnight + datetime.timedelta(hours=rng.uniform(12, 20))
+                changes += [
+                    (blip.timestamp(), False),
+                    (blip.timestamp() + rng.uniform(30, 600), True),
+                ]
+        return cls(changes)
+
+    @classmethod
+    def recorded(cls, directory: str) -> "Trace":
+        """builds the trace from the changes in result of the probes in a probe store directory"""
+        store = smart_sleep.ProbeStore(directory)
+        names = sorted(os.listdir(directory))
+        days = [
+            datetime.datetime.strptime(name[len("probes-") : -len(".bin")], "%Y%m%d")
+            for name in names
+            if name.startswith("probes-")
+        ]
+        if not days:
+            raise ValueError(f"no probe records in {directory}")
+        changes, previous = [], None
+        for record in store.records(days[0], days[-1] + datetime.timedelta(days=1)):
+            if record[3] != previous:
+                changes.append((record[0], bool(record[3])))
+                previous = record[3]
+        return cls(changes, initial=changes[0][1])
+
+
+class Simulation:
+    """patches the program onto the virtual clock & trace, and records what it does"""
+
+    def __init__(self, clock: VirtualClock, trace: Trace, probe_latency: float):
+        self.clock = clock
+        self.trace = trace
+        self.probe_latency = probe_latency
+        self.probes = []  # (timestamp, result)
+        self.suspends = []  # (timestamp, seconds)
+        self.alerts = 0
+        self.last_suspend = datetime.datetime.fromtimestamp(clock.start)
+
+    def patch(self):
+        module = smart_sleep
+        module.datetime = virtual_datetime_module(self.clock)
+        module.sleep = self.clock.advance
+        module.monotonic = lambda: self.clock.awake
+        module.clock_gettime = self.clock.clock_gettime
+        module.get_link_monitor = lambda: None
+        module.get_timer_waiter = lambda alarm=False: None
+        module.RTC_DRIVER = module.RtcDriver(root=os.path.join(os.getcwd(), "no-sysfs"))
+        module.subprocess = types.SimpleNamespace(
+            check_output=self.check_output,
+            CalledProcessError=subprocess.CalledProcessError,
+            DEVNULL=subprocess.DEVNULL,
+        )
+        module.connectivity_function_factory = lambda version="v2": self.probe
+        module.timed_connectivity_function_factory = lambda version="v2": (
+            lambda connection_type="any", timeout=None: (
+                *self.probe(connection_type),
+                None,
+            )
+        )
+        # alerts are counted, never sent
+        module.alert_onTelegram = self.alert
+        module.NOTIFIER.flush = lambda: None
+        module.get_last_sleep_time = lambda: self.last_suspend
+
+        async def run_blocking(function, *args, **kwargs):
+            return function(*args, **kwargs)
+
+        async def pause(seconds: float):
+            self.clock.advance(seconds)
+
+        module.run_blocking = run_blocking
+        module.pause = pause
+
+    def probe(self, connection_type: str = "any"):
+        self.clock.advance(self.probe_latency)
+        result = self.trace.connected(self.clock.now)
+        self.probes.append((self.clock.now, result))
+        return result, ("eth0",) if result else ()
+
+    def check_output(self, command: list, **kwargs) -> bytes:
+        if "rtcwake" not in command:
+            raise FileNotFoundError(command[0])
+        mode = command[command.index("-m") + 1]
+        seconds = float(command[-1])  # `-s N` is last, `sudo -s` also has a -s
+        if mode == "mem":
+            self.last_suspend = datetime.datetime.fromtimestamp(self.clock.now)
+            self.suspends.append((self.clock.now, seconds))
+            self.clock.advance(seconds, suspended=True)
+        else:
+            self.clock.advance(seconds)
+        return b""
+
+    def alert(self, message: str):
+        self.alerts += 1
+
+    def report(self) -> list:
+        """per simulated day: wake cycles, time suspended, detection latencies & missed changes"""
+        days = collections.OrderedDict()
+        day = datetime.date.fromtimestamp(self.clock.start)
+        while day <= datetime.date.fromtimestamp(min(self.clock.now, self.clock.end)):
+            days[day] = {
+                "day": day.isoformat(),
+                "wake cycles": 0,
+                "suspended hours": 0.0,
+                "changes": 0,
+                "detection latencies": [],
+                "missed": 0,
+            }
+            day += datetime.timedelta(days=1)
+        for time, seconds in self.suspends:
+            stats = days.get(datetime.date.fromtimestamp(time))
+            if stats:
+                stats["wake cycles"] += 1
+                stats["suspended hours"] += seconds / 3600
+        probe_times = [time for time, _ in self.probes]
+        changes = [
+            change
+            for change in self.trace.changes
+            if self.clock.start <= change[0] < self.clock.now
+        ]
+        for index, (time, connected) in enumerate(changes):
+            stats = days.get(datetime.date.fromtimestamp(time))
+            if not stats:
+                continue
+            stats["changes"] += 1
+            next_change = (
+                changes[index + 1][0] if index + 1 < len(changes) else self.clock.now
+            )
+            probe = bisect.bisect_left(probe_times, time)
+            # the first probe after the change has to see it, before the router changes again
+            if probe < len(self.probes) and probe_times[probe] < next_change:
+                stats["detection latencies"].append(probe_times[probe] - time)
+            else:
+                stats["missed"] += 1
+        for stats in days.values():
+            latencies = sorted(stats.pop("detection latencies"))
+            stats["detection latency mean s"] = (
+                sum(latencies) / len(latencies) if latencies else None
+            )
+            stats["detection latency max s"] = latencies[-1] if latencies else None
+        return list(days.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--config", default=os.path.join(REPO_ROOT, "config[TEMPLATE].yaml")
+    )
+    parser.add_argument(
+        "--without",
+        action="append",
+        default=[],
+        help="config key to drop, eg: wake_planner",
+    )
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument(
+        "--start", help="YYYY-MM-DD HH:MM to start at, by default noon today"
+    )
+    parser.add_argument(
+        "--trace", help="probe store directory to replay, instead of a synthetic trace"
+    )
+    parser.add_argument(
+        "--down", default="23:30", help="synthetic trace: when the router goes down"
+    )
+    parser.add_argument(
+        "--up", default="08:45", help="synthetic trace: when the router comes back up"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=600, help="synthetic trace: seconds either way"
+    )
+    parser.add_argument(
+        "--blips",
+        type=float,
+        default=0.1,
+        help="synthetic trace: chance of a daytime outage",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--probe-latency",
+        type=float,
+        default=0.005,
+        help="seconds a virtual probe takes",
+    )
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    def time_of_day(value: str) -> datetime.timedelta:
+        hours, minutes = value.split(":")
+        return datetime.timedelta(hours=int(hours), minutes=int(minutes))
+
+    with open(args.config) as file:
+        config = yaml.safe_load(file)
+    for key, settings in SCHEDULING.items():
+        config.setdefault(key, settings)
+    for key in args.without:
+        config.pop(key, None)
+    config.pop("metrics", None)
+
+    trace_directory = os.path.abspath(args.trace) if args.trace else None
+    # the program keeps its config, logs & probe store relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="ssbench-sim-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs("logs")
+    global smart_sleep
+    import smart_sleep
+
+    try:
+        trace = Trace.recorded(trace_directory) if trace_directory else None
+        if args.start:
+            start = datetime.datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+        elif trace is not None:
+            start = datetime.datetime.fromtimestamp(trace.times[0])
+        else:
+            start = datetime.datetime.combine(datetime.date.today(), datetime.time(12))
+        if trace is None:
+            trace = Trace.synthetic(
+                start,
+                args.days,
+                time_of_day(args.down),
+                time_of_day(args.up),
+                args.jitter,
+                args.blips,
+                args.seed,
+            )
+        end = start + datetime.timedelta(days=args.days)
+        with open("config.yaml", "w") as file:
+            yaml.safe_dump(config, file)
+        clock = VirtualClock(start.timestamp(), end.timestamp())
+        simulation = Simulation(clock, trace, args.probe_latency)
+        simulation.patch()
+        smart_sleep.logger.setLevel("WARNING")
+        smart_sleep.config_loader()
+        try:
+            asyncio.run(smart_sleep.main_loop(simulation.last_suspend))
+        except StopSimulation:
+            pass
+        days = simulation.report()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = subprocess.run(
+        ["git", "-C", REPO_ROOT, "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    totals = {
+        "wake cycles": sum(day["wake cycles"] for day in days),
+        "suspended hours": sum(day["suspended hours"] for day in days),
+        "changes": sum(day["changes"] for day in days),
+        "missed": sum(day["missed"] for day in days),
+        "probes": len(simulation.probes),
+        "alerts": simulation.alerts,
+    }
+    report = {
+        "benchmark": "simulation",
+        "commit": commit,
+        "config": os.path.basename(args.config),
+        "without": args.without,
+        "trace": args.trace
+        or f"synthetic (down {args.down}, up {args.up}, seed {args.seed})",
+        "days": days,
+        "totals": totals,
+    }
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"simulation-{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(
+        f"{'day':<12}{'wake cycles':>12}{'suspended h':>13}{'changes':>9}"
+        f"{'detect mean s':>15}{'detect max s':>14}{'missed':>8}"
+    )
+    for day in days:
+        mean, maximum = day["detection latency mean s"], day["detection latency max s"]
+        print(
+            f"{day['day']:<12}{day['wake cycles']:>12}{day['suspended hours']:>13.2f}{day['changes']:>9}"
+            f"{'-' if mean is None else f'{mean:.1f}':>15}{'-' if maximum is None else f'{maximum:.1f}':>14}"
+            f"{day['missed']:>8}"
+        )
+    print(
+        f"\ntotal: {totals['wake cycles']} wake cycles, {totals['suspended hours']:.1f} h suspended, "
+        f"{totals['missed']}/{totals['changes']} changes missed, {totals['probes']} probes, {totals['alerts']} alerts"
+    )
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,29 +18,102 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import argparse
+import atexit
+import bisect
+import calendar
+import collections
+import copy
 import datetime
-from time import sleep
+import errno
+import functools
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import types
+from time import (
+    sleep,
+    monotonic,
+    clock_gettime,
+    CLOCK_BOOTTIME,
+    CLOCK_MONOTONIC,
+    CLOCK_REALTIME,
+)
 
-import colorama
-import netifaces
-import requests
 import logging
 import subprocess
-from colorama import Fore
-from logging.handlers import TimedRotatingFileHandler
-from typing import Literal, Tuple, Dict, List, Callable
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import (
+    Literal,
+    Tuple,
+    Dict,
+    List,
+    Callable,
+    Optional,
+    Deque,
+    Iterator,
+    TYPE_CHECKING,
+)
+
+if TYPE_CHECKING:
+    # for the annotations only. asyncio, requests, netifaces, sqlite3, http.server, ctypes, mmap, concurrent.futures &
+    # colorama are imported on first use, so that they don't slow down the start
+    import asyncio
+    import concurrent.futures
+    import ctypes
+    import socketserver
+    import sqlite3
+
+    import requests
 
 # program constants
-CHAT_ID = ""
-BOT_TOKEN = ""
-CONNECTION_TYPE: Literal["any", "wired", "wireless"] = "any"
-NIGHT_PHASE: dict = dict()
-MORNING_PHASE: dict = dict()
-TIMEOUT = 500
-SLEEP_INTERVAL = 0  # 0 means disabled
+# the active config, compiled by config_loader. replaced as a whole when the config file is edited
+CONFIG: Optional["Config"] = None
+# the timeout of phases that don't have their own, when the config doesn't set `timeout` either
+DEFAULT_TIMEOUT = 500
+# set when an edited config has been swapped in, so that whatever we're waiting on stops & the schedule is re-planned
+REPLAN = threading.Event()
+# rtnetlink subscriber used to wait for link changes instead of polling. None until first needed, False if unavailable
+LINK_MONITOR = None
+# the C library, loaded on first use by get_libc()
+LIBC = None
+# timerfd waiters by whether they wake the computer up from suspend, opened on first use by get_timer_waiter()
+TIMER_WAITERS = {}
+# where the last suspend time is looked up, and where the syslog scanner remembers how far it got
+SYSLOG_PATH = "/var/log/syslog"
+SYSLOG_SCAN_STATE = "logs/syslog_scan_state.json"
+# thread pool used to probe gateways in parallel. created on first use
+PROBE_EXECUTOR = None
+# seconds to wait after the computer wakes up ("sleep") or the thread resumes ("suspend"), to give the computer time to
+# connect to the wifi. waited on the event loop, see pause()
+WAKE_DELAY = {"sleep": 2, "suspend": 1}
+# and the seconds on top of that in between the probes of a connectivity wait
+PROBE_WAKE_DELAY = 5
 
 # This controls whether the computer sleeps for real or not. change it acc to your needs
 DEBUG = False
+
+
+class Fore:
+    """the colors used in the logs, the same ANSI codes as colorama's. colorama itself is only needed by the console"""
+
+    RED = "\x1b[31m"
+    GREEN = "\x1b[32m"
+    YELLOW = "\x1b[33m"
+    CYAN = "\x1b[36m"
+    WHITE = "\x1b[37m"
+    LIGHTMAGENTA_EX = "\x1b[95m"
+    LIGHTWHITE_EX = "\x1b[97m"
+
+
 # Logging formatter
 FORMATTER = {
     "format": "{color}[{asctime}] :--{levelname:-^9s}--: [{funcName}()] {message}",
@@ -56,319 +129,1188 @@ FORMATTER = {
 }
 
 
+class PlainFormatter(logging.Formatter):
+    """
+    Formats a record without colors, only once: the result is kept on the record, so the other handlers (and the
+    colored variant) reuse it instead of formatting the record again.
+    """
+
+    def format(self, record):
+        if getattr(record, "plain_message", None) is None:
+            record.plain_message = logging.Formatter.format(self, record)
+        return record.plain_message
+
+
 class ColoredFormatter(logging.Formatter):
-    def __init__(self, msg, datefmt=None, style=None):
-        logging.Formatter.__init__(self, msg, datefmt, style)
+    """derives the colored line by prefixing the plain line with the level's color"""
+
+    def __init__(self, plain_formatter: PlainFormatter):
+        logging.Formatter.__init__(self)
+        self.plain_formatter = plain_formatter
 
     def format(self, record):
-        if record.levelname in FORMATTER["colors"]:
-            record.color = FORMATTER["colors"][str(record.levelname)]
+        return FORMATTER["colors"].get(
+            record.levelname, ""
+        ) + self.plain_formatter.format(record)
 
-        return logging.Formatter.format(self, record)
 
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts the records on a bounded queue for the QueueListener's thread to format & write. when the queue is full the
+    record is dropped and counted instead, so that logging never blocks the program.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # only merge the args in, they could change before the listener gets to the record. formatting is left to the
+        # listener's thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ConfigError(ValueError):
+    """the config file is missing or has invalid values. what's wrong has been logged already"""
 
-def config_loader(filename: str = "config.yaml") -> dict:
+
+class Frozen:
     """
-    Loads the config from the `filename` and returns the dictionary from it and sets the program constants
-    :param filename: str, the filename
-    :return: dictionary
+    Base of the compiled config objects. the attributes are set once, in __init__, and can't be set or deleted after
+    that: a changed config makes new objects, so whoever holds one never sees it half updated.
+    """
+
+    __slots__ = ()
+
+    def _freeze(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable, can't set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(
+            f"{type(self).__name__} is immutable, can't delete '{name}'"
+        )
+
+
+class Phase(Frozen):
+    """
+    The night or morning phase, compiled from its config: start & end time of the day, the timeout, and the boundaries
+    derived from them, so that the main loop doesn't look anything up or convert anything again.
+    Also reads like the phase dict it replaces (`phase["start time"]`), for the helpers that take a phase dict.
+    """
+
+    __slots__ = (
+        "name",
+        "start_time",
+        "end_time",
+        "timeout",
+        "timeout_delta",
+        "passive_end_time",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        start_time: datetime.timedelta,
+        end_time: datetime.timedelta,
+        timeout: int,
+    ):
+        """
+        :param name: NIGHT PHASE/MORNING PHASE
+        :param start_time: time of the day the phase starts at
+        :param end_time: time of the day the phase ends at
+        :param timeout: seconds in between connectivity checks
+        """
+        timeout_delta = datetime.timedelta(seconds=timeout)
+        self._freeze(
+            name=name,
+            start_time=start_time,
+            end_time=end_time,
+            timeout=timeout,
+            timeout_delta=timeout_delta,
+            # connectivity is checked every `timeout` seconds till then, and vigorously after that
+            passive_end_time=end_time - timeout_delta,
+        )
+
+    def __getitem__(self, key: str):
+        attribute = key.replace(" ", "_")
+        if attribute not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, attribute)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "Phase({}, {} — {}, timeout {}s)".format(
+            self.name, self.start_time, self.end_time, self.timeout
+        )
+
+
+class Config(Frozen):
     """
+    The config, validated & compiled once by compile_config(). When the config file is edited, a new Config is
+    compiled & swapped in as a whole by apply_config(), this one is never changed.
+    """
+
+    __slots__ = (
+        "data",
+        "connection_type",
+        "night",
+        "morning",
+        "bot_token",
+        "chat_id",
+        "timeout",
+        "sleep_interval",
+        "sleep_interval_delta",
+        "sleep_detection",
+        "connectivity_method",
+        "adaptive_scheduler",
+        "wake_planner",
+        "metrics",
+        "fleet",
+        "ping_timeout",
+        "ping_retries",
+        "race",
+        "logging_level",
+        "timeline",
+    )
+
+    def __init__(self, **values):
+        missing = set(self.__slots__) - set(values)
+        if missing:
+            raise TypeError(f"config values missing: {', '.join(sorted(missing))}")
+        self._freeze(**values)
+
+    @property
+    def phases(self) -> Tuple[Phase, Phase]:
+        return self.night, self.morning
+
+    def phase(self, name: str) -> Optional[Phase]:
+        """
+        :param name: the phase's name
+        :return: the phase called `name`, None for NEITHER
+        """
+        return next((phase for phase in self.phases if phase.name == name), None)
+
+
+def read_config(filename: str = "config.yaml") -> dict:
     """
-888                        888                                 .d888 
-888                        888                                d88P"  
-888                        888                                888    
-888  .d88b.   8888b.   .d88888       .d8888b .d88b.  88888b.  888888 
-888 d88""88b     "88b d88" 888      d88P"   d88""88b 888 "88b 888    
-888 888  888 .d888888 888  888      888     888  888 888  888 888    
-888 Y88..88P 888  888 Y88b 888      Y88b.   Y88..88P 888  888 888    
-888  "Y88P"  "Y888888  "Y88888       "Y8888P "Y88P"  888  888 888    
-                                                                     
-                                                                     
-                                                                     
+    reads the yaml config file
+    :param filename: str, the filename
+    :return: dictionary
+    Raises ConfigError if the file is missing or isn't valid yaml
     """
     try:
         import yaml
 
         with open(filename) as config_file:
             config = yaml.safe_load(config_file)
-    except ModuleNotFoundError:
+    except ModuleNotFoundError as e:
         logger.exception(
             "pyyaml module nto found!\nare you sure you have installed requirements.txt"
         )
-        quit(1)
-    except FileNotFoundError:
+        raise ConfigError(str(e))
+    except FileNotFoundError as e:
         logger.exception(
             "config.yaml file not made. Please make it according to the specifications"
         )
-        quit(1)
+        raise ConfigError(str(e))
+    except yaml.YAMLError as e:
+        logger.error("%s is not valid yaml: %s", filename, e)
+        raise ConfigError(str(e))
+    if not isinstance(config, dict):
+        logger.error("%s should be a yaml mapping, got: %s", filename, type(config))
+        raise ConfigError(f"{filename} is not a mapping")
+    return config
+
+
+def compile_config(config: dict) -> Config:
+    """
+    Validates the config read from the config file, and compiles it into a Config. doesn't change anything, the
+    result is put to use by apply_config()
+    :param config: the dictionary read from the config file
+    :return: the compiled config
+    Raises ConfigError if a value is missing or invalid
+    """
+    """
+888                        888                                 .d888
+888                        888                                d88P"
+888                        888                                888
+888  .d88b.   8888b.   .d88888       .d8888b .d88b.  88888b.  888888
+888 d88""88b     "88b d88" 888      d88P"   d88""88b 888 "88b 888
+888 888  888 .d888888 888  888      888     888  888 888  888 888
+888 Y88..88P 888  888 Y88b 888      Y88b.   Y88..88P 888  888 888
+888  "Y88P"  "Y888888  "Y88888       "Y8888P "Y88P"  888  888 888
 
-    global CONNECTION_TYPE, NIGHT_PHASE, MORNING_PHASE, CHAT_ID, BOT_TOKEN, TIMEOUT, SLEEP_INTERVAL
+
+
+    """
+    data = copy.deepcopy(config)
     # try and load each of the important stuff
     # Wifi
     try:
-        CONNECTION_TYPE = config["connection type"]
-    except KeyError:
+        connection_type = config["connection type"]
+    except KeyError as e:
         logger.exception("CONNECTION_TYPE value not provided in config file!")
-        quit(1)
+        raise ConfigError(f"missing {e}")
         # logger.info("CONNECTION_TYPE not provided. Moving on...")
     else:
-        logger.info(f'CONNECTION_TYPE: "{CONNECTION_TYPE}" loaded...')
-
-    # night phase timing
-    try:
-        NIGHT_PHASE = config["night phase"]
-        assert "start time" in NIGHT_PHASE, "`start time` value missing in config file"
-        assert "end time" in NIGHT_PHASE, "`end time` value missing in config file"
-    except KeyError:
-        logger.exception("`night phase` value not provided in config file!")
-        quit(1)
-    except AssertionError:
-        logger.exception("Values for `night phase` are missing in config file!")
-        quit(1)
-    else:
-        logger.info(f"Night Phase and it's timings loaded...")
-        NIGHT_PHASE["name"] = "NIGHT PHASE"
+        logger.info(f'CONNECTION_TYPE: "{connection_type}" loaded...')
 
-    # morning phase timing
-    try:
-        MORNING_PHASE = config["morning phase"]
-        assert (
-            "start time" in MORNING_PHASE
-        ), "`start time` value missing in config file"
-        assert "end time" in MORNING_PHASE, "`end time` value missing in config file"
-    except KeyError:
-        logger.exception("`morning phase` value not provided in config file!")
-        quit(1)
-    except AssertionError:
-        logger.exception("Values for `morning phase` are missing in config file!")
-        quit(1)
-    else:
-        logger.info(f"Morning Phase and it's timings loaded...")
-        MORNING_PHASE["name"] = "MORNING PHASE"
+    # night & morning phase timings
+    phases = {}
+    for phase_key, phase_name in [
+        ("night phase", "NIGHT PHASE"),
+        ("morning phase", "MORNING PHASE"),
+    ]:
+        try:
+            phase = config[phase_key]
+            assert "start time" in phase, "`start time` value missing in config file"
+            assert "end time" in phase, "`end time` value missing in config file"
+        except (KeyError, TypeError) as e:
+            logger.exception("`%s` value not provided in config file!", phase_key)
+            raise ConfigError(f"missing {e}")
+        except AssertionError as e:
+            logger.exception("Values for `%s` are missing in config file!", phase_key)
+            raise ConfigError(str(e))
+        else:
+            logger.info("%s and it's timings loaded...", phase_key.capitalize())
+            phases[phase_name] = dict(phase, name=phase_name)
 
     # try loading Telegram bot token
     try:
         telegram = config["telegram"]
+        assert isinstance(telegram, dict), "`telegram` should be a mapping"
         assert "BOT_TOKEN" in telegram, "BOT_Token key in `telegram` not provided!"
         assert "CHAT_ID" in telegram, "CHAT_ID in `telegram` not provided!"
-    except KeyError:
+    except KeyError as e:
         logger.info("Telegram tokens not found. Moving over...")
-        quit(1)
+        raise ConfigError(f"missing {e}")
     except AssertionError as e:
         logger.exception(e)
-        quit(1)
+        raise ConfigError(str(e))
     else:
-        BOT_TOKEN = telegram["BOT_TOKEN"]
-        CHAT_ID = telegram["CHAT_ID"]
+        bot_token = telegram["BOT_TOKEN"]
+        chat_id = telegram["CHAT_ID"]
         logger.info("Telegram bot_token and chat id loaded...")
 
+    timeout = DEFAULT_TIMEOUT
     try:
-        TIMEOUT = config["timeout"]
+        timeout = config["timeout"]
         assert (
-            isinstance(TIMEOUT, int) is True
-        ), f"TIMEOUT not of correct type.\n Expected type int, got {type(TIMEOUT)}"
+            isinstance(timeout, int) is True
+        ), f"TIMEOUT not of correct type.\n Expected type int, got {type(timeout)}"
     except KeyError:
         logger.debug("timeout key not found. will use default")
     except AssertionError as e:
         logger.exception(e)
-        quit(1)
+        raise ConfigError(str(e))
     else:
         logger.warning(
-            f"Custom TIMEOUT({TIMEOUT} seconds) has been loaded, but prefer adding `timeout` inside the "
+            f"Custom TIMEOUT({timeout} seconds) has been loaded, but prefer adding `timeout` inside the "
             "morning & night phase key in future. Refer config[TEMPLATE].yaml for reference. "
             "\n This key is will only change the default timeout. warning will be removed in a future "
             "release"
         )
     # if morning or night timeouts are detected
-    for phase_name in ["morning phase", "night phase"]:
+    for phase in phases.values():
         try:
-            __phase_timeout = config[phase_name]["timeout"]
+            __phase_timeout = phase["timeout"]
             assert isinstance(
                 __phase_timeout, int
-            ), f"expected integer for {phase_name} got: {type(__phase_timeout)} \t {__phase_timeout}"
+            ), f"expected integer for {phase['name'].lower()} got: {type(__phase_timeout)} \t {__phase_timeout}"
         except KeyError:
-            logger.debug(f"{phase_name} timeout not found, using default")
-            config[phase_name]["timeout"] = TIMEOUT
+            logger.debug(f"{phase['name'].lower()} timeout not found, using default")
+            phase["timeout"] = timeout
         except AssertionError as e:
             logger.exception(e)
-            quit(1)
+            raise ConfigError(str(e))
         finally:
             logger.info(
-                "%s timeout loaded... %d seconds",
-                phase_name,
-                config[phase_name]["timeout"],
+                "%s timeout loaded... %s seconds",
+                phase["name"].lower(),
+                phase.get("timeout"),
             )
 
     # load sleep_interval
+    sleep_interval = 0  # 0 means disabled
     try:
-        SLEEP_INTERVAL = config["sleep_interval"]
+        sleep_interval = config["sleep_interval"]
         assert isinstance(
-            SLEEP_INTERVAL, (int, float)
+            sleep_interval, (int, float)
         ), "sleep_interval is not an integer"
     except KeyError:
         logger.debug("no sleep_interval defined")
     except AssertionError as e:
         logger.exception(e)
-        quit(1)
+        raise ConfigError(str(e))
+    else:
+        logger.info(f"Loaded sleep interval of: {sleep_interval} seconds")
+
+    # load sleep detection method
+    sleep_detection = config.get("sleep_detection", "auto")
+    try:
+        assert sleep_detection in [
+            "auto",
+            "syslog",
+            "kernel",
+        ], f"`sleep_detection` should be one of 'auto'/'syslog'/'kernel'. got: {sleep_detection}"
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
     else:
-        logger.info(f"Loaded sleep interval of: {SLEEP_INTERVAL} seconds")
+        logger.info("Detecting last sleep time from... %s", sleep_detection)
 
     # load connectivity method
+    connectivity_method = config.get("connectivity_method", "v2")
     try:
-        if "connectivity_method" in config:
-            method = config["connectivity_method"]
-            assert method in [
-                "v2",
-                "v3",
-                "v2+v3",
-            ], f"`connectivity_method` should be one of 'v2'/'v3'/'v2+v3'. got: {method}"
-        else:
-            config["connectivity_method"] = "v2"
+        assert (
+            connectivity_method in PROBE_METHODS
+        ), f"`connectivity_method` should be one of {'/'.join(PROBE_METHODS)}. got: {connectivity_method}"
     except AssertionError as e:
         logger.exception(e)
-        quit(1)
+        raise ConfigError(str(e))
+    else:
+        logger.info("Using connectivity method... %s", connectivity_method)
+
+    # load adaptive timeout
+    adaptive_scheduler = None
+    try:
+        if "adaptive_timeout" in config:
+            adaptive = config["adaptive_timeout"] or {}
+            assert isinstance(adaptive, dict), "`adaptive_timeout` should be a mapping"
+            min_interval = adaptive.get("min", 5)
+            max_interval = adaptive.get("max", timeout)
+            min_suspend = adaptive.get("min suspend", 60)
+            history_days = adaptive.get("history days", 28)
+            assert (
+                isinstance(min_interval, (int, float))
+                and isinstance(max_interval, (int, float))
+                and 0 < min_interval <= max_interval
+            ), f"`adaptive_timeout` needs 0 < min <= max. got: min {min_interval}, max {max_interval}"
+            assert (
+                isinstance(min_suspend, (int, float)) and min_suspend > 0
+            ), f"`adaptive_timeout` -> `min suspend` should be a positive number. got: {min_suspend}"
+            assert (
+                isinstance(history_days, int) and history_days > 0
+            ), f"`adaptive_timeout` -> `history days` should be a positive integer. got: {history_days}"
+            adaptive_scheduler = AdaptiveProbeScheduler(
+                PROBE_STORE, min_interval, max_interval, history_days, min_suspend
+            )
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
+    else:
+        if adaptive_scheduler is not None:
+            logger.info(
+                "Adaptive timeout enabled... %s to %s seconds",
+                adaptive_scheduler.min_interval,
+                adaptive_scheduler.max_interval,
+            )
+
+    # load wake planner
+    wake_planner = None
+    try:
+        if "wake_planner" in config:
+            planner = config["wake_planner"] or {}
+            assert isinstance(planner, dict), "`wake_planner` should be a mapping"
+            step = planner.get("step", 0.25)
+            margin = planner.get("margin", 30)
+            history_days = planner.get("history days", 28)
+            assert (
+                isinstance(step, (int, float)) and 0 < step <= 1
+            ), f"`wake_planner` -> `step` should be a number in (0, 1]. got: {step}"
+            assert (
+                isinstance(margin, (int, float)) and margin >= 0
+            ), f"`wake_planner` -> `margin` should be a positive number. got: {margin}"
+            assert (
+                isinstance(history_days, int) and history_days > 0
+            ), f"`wake_planner` -> `history days` should be a positive integer. got: {history_days}"
+            wake_planner = WakePlanner(PROBE_STORE, step, margin, history_days)
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
+    else:
+        if wake_planner is not None:
+            logger.info(
+                "Wake planner enabled... waking up at the %s quantile of router-up times",
+                wake_planner.step,
+            )
+
+    # load metrics endpoint settings
+    metrics = None
+    try:
+        if "metrics" in config:
+            metrics = config["metrics"]
+            assert isinstance(metrics, dict) and (
+                "port" in metrics or "socket" in metrics
+            ), "`metrics` needs either a `port` or a `socket`"
+            assert "port" not in metrics or (
+                isinstance(metrics["port"], int) and 0 < metrics["port"] < 65536
+            ), f"`metrics` -> `port` should be a port number. got: {metrics.get('port')}"
+            metrics = types.MappingProxyType(dict(metrics))
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
+    else:
+        if metrics is not None:
+            logger.info("Metrics endpoint settings loaded...")
+
+    # load fleet settings
+    fleet = None
+    try:
+        if "fleet" in config:
+            fleet = config["fleet"]
+            assert (
+                isinstance(fleet, dict) and fleet.get("role") in FLEET_ROLES
+            ), f"`fleet` -> `role` should be one of {FLEET_ROLES}"
+            assert (
+                "port" in fleet or "socket" in fleet
+            ), "`fleet` needs either a `port` or a `socket`"
+            assert "port" not in fleet or (
+                isinstance(fleet["port"], int) and 0 < fleet["port"] < 65536
+            ), f"`fleet` -> `port` should be a port number. got: {fleet.get('port')}"
+            assert (
+                fleet["role"] == "coordinator" or "socket" in fleet or "host" in fleet
+            ), "`fleet` -> `host` of the coordinator is needed by an agent"
+            assert "socket" in fleet or (
+                isinstance(fleet.get("secret"), str) and fleet["secret"]
+            ), "`fleet` -> `secret` is needed over TCP, the same one on the coordinator & the agents"
+            assert "max agents" not in fleet or (
+                isinstance(fleet["max agents"], int) and fleet["max agents"] > 0
+            ), f"`fleet` -> `max agents` should be a positive number. got: {fleet.get('max agents')}"
+            if "mac" in fleet:
+                try:
+                    parse_mac(fleet["mac"])
+                except ValueError as e:
+                    raise AssertionError(f"`fleet` -> `mac`: {e}")
+            fleet = types.MappingProxyType(dict(fleet))
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
+    else:
+        if fleet is not None:
+            logger.info("Fleet settings loaded, role: %s...", fleet["role"])
+
+    # load ping settings
+    ping = config.get("ping") or {}
+    try:
+        assert isinstance(ping, dict), "`ping` should be a mapping"
+        ping_timeout = ping.get("timeout", 1.0)
+        ping_retries = ping.get("retries", 1)
+        assert (
+            isinstance(ping_timeout, (int, float)) and ping_timeout > 0
+        ), f"`ping` -> `timeout` should be a positive number of seconds. got: {ping_timeout}"
+        assert (
+            isinstance(ping_retries, int) and ping_retries >= 0
+        ), f"`ping` -> `retries` should be a non negative integer. got: {ping_retries}"
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
+    else:
+        logger.info("Ping timeout: %s seconds, retries: %d", ping_timeout, ping_retries)
+
+    # load the race method's settings
+    race = config.get("race") or {}
+    try:
+        assert isinstance(race, dict), "`race` should be a mapping"
+        signals = race.get("signals", RACE_SIGNALS)
+        targets = race.get("targets") or []
+        assert isinstance(signals, list) and all(
+            signal in RACE_SIGNALS for signal in signals
+        ), f"`race` -> `signals` should be a list of {RACE_SIGNALS}. got: {signals}"
+        assert isinstance(targets, list), "`race` -> `targets` should be a list"
+        for target in targets:
+            split_target(target)
+        assert (
+            signals or targets
+        ), "`race` needs at least one of the `signals`, or a target"
+        quorum = race.get("quorum", len(signals) + len(targets))
+        assert isinstance(quorum, int) and 0 < quorum <= len(signals) + len(
+            targets
+        ), f"`race` -> `quorum` should be in between 1 and the number of signals & targets. got: {quorum}"
+        race_timeout = race.get("timeout", 2)
+        assert (
+            isinstance(race_timeout, (int, float)) and race_timeout > 0
+        ), f"`race` -> `timeout` should be a positive number of seconds. got: {race_timeout}"
+        race = types.MappingProxyType(
+            {
+                "signals": tuple(signals),
+                "targets": tuple(targets),
+                "quorum": quorum,
+                "timeout": race_timeout,
+            }
+        )
+    except (AssertionError, ValueError) as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
     else:
-        logger.info("Using connectivity method... %s", config["connectivity_method"])
+        if connectivity_method == "race":
+            logger.info(
+                "Racing %s, %d of the ones that vote have to vote online, within %s seconds",
+                ", ".join(race["signals"] + race["targets"]),
+                race["quorum"],
+                race["timeout"],
+            )
+
+    # load the logging level, checked here so a bad one on a reload is rejected before anything is swapped in
+    logging_level = config.get("logging level", 10)
+    try:
+        if isinstance(logging_level, str):
+            # `logging.getLevelName` gives back the number for the names it knows
+            logging_level = logging.getLevelName(logging_level.upper())
+        assert (
+            isinstance(logging_level, int)
+            and not isinstance(logging_level, bool)
+            and logging_level >= 0
+        ), f"`logging level` should be 10, 20, 30, 40 or 50 (or DEBUG, INFO, ...). got: {config.get('logging level')}"
+    except AssertionError as e:
+        logger.exception(e)
+        raise ConfigError(str(e))
 
     """
-8888888b.                                         88888888888 d8b                        
-888   Y88b                                            888     Y8P                        
-888    888                                            888                                
-888   d88P 8888b.  888d888 .d8888b   .d88b.           888     888 88888b.d88b.   .d88b.  
-8888888P"     "88b 888P"   88K      d8P  Y8b          888     888 888 "888 "88b d8P  Y8b 
-888       .d888888 888     "Y8888b. 88888888          888     888 888  888  888 88888888 
-888       888  888 888          X88 Y8b.              888     888 888  888  888 Y8b.     
-888       "Y888888 888      88888P'  "Y8888           888     888 888  888  888  "Y8888                                                                                           
+8888888b.                                         88888888888 d8b
+888   Y88b                                            888     Y8P
+888    888                                            888
+888   d88P 8888b.  888d888 .d8888b   .d88b.           888     888 88888b.d88b.   .d88b.
+8888888P"     "88b 888P"   88K      d8P  Y8b          888     888 888 "888 "88b d8P  Y8b
+888       .d888888 888     "Y8888b. 88888888          888     888 888  888  888 88888888
+888       888  888 888          X88 Y8b.              888     888 888  888  888 Y8b.
+888       "Y888888 888      88888P'  "Y8888           888     888 888  888  888  "Y8888
     """
 
     # Parsing Night Phase + Morning Phase timings
 
-    for phase in [NIGHT_PHASE, MORNING_PHASE]:
+    for name, phase in phases.items():
         try:
             times = parse_time(phase)
         except AssertionError as e:
             logger.error(
                 "Datetime value in config.yml for '%s' not in range\nValueError:%s",
-                phase["name"].lower(),
+                name.lower(),
                 e,
             )
-            quit(1)
+            raise ConfigError(str(e))
         except TypeError as e:
             logger.error(
                 "Datetime value in config.yml for '%s' not in right format\nTypeError:%s",
-                phase["name"].lower(),
+                name.lower(),
                 e,
             )
-            quit(1)
+            raise ConfigError(str(e))
         else:
-            phase["start time"] = times["start time"]
-            phase["end time"] = times["end time"]
-            logger.info("Parsing time for %s... %sDone", phase["name"], Fore.GREEN)
+            phases[name] = Phase(
+                name, times["start time"], times["end time"], phase["timeout"]
+            )
+            logger.info("Parsing time for %s... %sDone", name, Fore.GREEN)
             logger.info(
                 "Time range loaded for %s: (%s — %s)",
-                phase["name"],
-                str(phase["start time"]),
-                str(phase["end time"]),
+                name,
+                str(times["start time"]),
+                str(times["end time"]),
             )
-    return config
+    night, morning = phases["NIGHT PHASE"], phases["MORNING PHASE"]
+    timeline = PhaseTimeline([night, morning])
+    logger.info(
+        "Phase timeline compiled, next transition: %s -> %s",
+        *map(str, timeline.next_transition()),
+    )
+    return Config(
+        data=data,
+        connection_type=connection_type,
+        night=night,
+        morning=morning,
+        bot_token=bot_token,
+        chat_id=chat_id,
+        timeout=timeout,
+        sleep_interval=sleep_interval,
+        sleep_interval_delta=datetime.timedelta(seconds=sleep_interval),
+        sleep_detection=sleep_detection,
+        connectivity_method=connectivity_method,
+        adaptive_scheduler=adaptive_scheduler,
+        wake_planner=wake_planner,
+        metrics=metrics,
+        fleet=fleet,
+        ping_timeout=ping_timeout,
+        ping_retries=ping_retries,
+        race=race,
+        logging_level=logging_level,
+        timeline=timeline,
+    )
 
 
-def alert_onTelegram(message: str):
+def apply_config(config: Config):
     """
-    This function will send an alert to telegram notifying about the change
-    If BOT_TOKEN is not provided, this function will not run
-    :param message: The message
+    puts `config` to use: it replaces the active config in a single assignment, so nothing ever sees half of the old
+    config and half of the new one
+    :param config: the compiled config
     :return: None
     """
-    if BOT_TOKEN and CHAT_ID:
-        x = requests.get(
-            "https://api.telegram.org/bot"
-            + BOT_TOKEN
-            + "/sendMessage?chat_id="
-            + str(CHAT_ID)
-            + "&parse_mode=Markdown"
-            "&text=" + message[:1000]
+    global CONFIG
+    ICMP_PROBER.timeout = config.ping_timeout
+    ICMP_PROBER.retries = config.ping_retries
+    CONNECTIVITY_RACE.configure(**config.race)
+    CONFIG = config
+
+
+def config_loader(filename: str = "config.yaml") -> Config:
+    """
+    Loads the config from the `filename`, validates & compiles it and makes it the active config. exits the program if
+    the config is invalid
+    :param filename: str, the filename
+    :return: the compiled config
+    """
+    try:
+        config = compile_config(read_config(filename))
+    except ConfigError:
+        quit(1)
+    apply_config(config)
+    return config
+
+
+def reload_config(filename: str = "config.yaml") -> bool:
+    """
+    Loads the edited config file again and swaps it in, then interrupts whatever the program is waiting on so that the
+    schedule gets re-planned with the new config. an edit that doesn't load or validate is rejected, and the active
+    config stays.
+    :param filename: str, the filename
+    :return: True if the new config was swapped in
+    """
+    try:
+        config = compile_config(read_config(filename))
+    except ConfigError as e:
+        logger.error(
+            "Rejected the edited %s, keeping the active config: %s", filename, e
         )
-        logger.debug(x)
+        return False
+    if CONFIG is not None and config.data == CONFIG.data:
+        logger.debug("%s was written, but nothing changed", filename)
+        return False
+    if CONFIG is not None and config.metrics != CONFIG.metrics:
+        logger.warning("The metrics endpoint settings only change after a restart")
+    if CONFIG is not None and config.fleet != CONFIG.fleet:
+        logger.warning("The fleet settings only change after a restart")
+    apply_config(config)
+    logger.setLevel(config.logging_level)
+    logger.info("Reloaded %s, re-planning the schedule", filename)
+    # whatever is waiting on the old schedule stops waiting, the main loop plans again with the new config
+    REPLAN.set()
+    for waiter in TIMER_WAITERS.values():
+        if waiter is not None:
+            waiter.interrupt()
+    if LINK_MONITOR:
+        LINK_MONITOR.interrupt()
+    return True
 
 
-"""
-888                            d8b                   
-888                            Y8P                   
-888                                                  
-888  .d88b.   .d88b.   .d88b.  888 88888b.   .d88b.  
-888 d88""88b d88P"88b d88P"88b 888 888 "88b d88P"88b 
-888 888  888 888  888 888  888 888 888  888 888  888 
-888 Y88..88P Y88b 888 Y88b 888 888 888  888 Y88b 888 
-888  "Y88P"   "Y88888  "Y88888 888 888  888  "Y88888 
-                  888      888                   888 
-             Y8b d88P Y8b d88P              Y8b d88P 
-              "Y88P"   "Y88P"                "Y88P"  
-"""
+# inotify(7) flags & the event header
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct(
+    "iIII"
+)  # watch descriptor, mask, cookie, length of the name
 
-# Initialise colorama
-colorama.init(autoreset=True)
 
-# Starting program logger
+class ConfigWatcher:
+    """
+    Watches the config file with inotify. The file's directory is watched, because editors save by writing a new file &
+    renaming it over the old one, which a watch on the old file would miss. The file itself is watched too, because a
+    config bind mounted into a container (see docker-compose.yaml) is edited through the host's directory, not ours.
+    """
 
-logger = logging.getLogger(__name__)
+    def __init__(self, filename: str = "config.yaml"):
+        """
+        :param filename: the config file to watch
+        Raises OSError if inotify is not available
+        """
+        self.filename = filename
+        self.name = os.path.basename(filename).encode()
+        libc = get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise libc_error()
+        directory = os.path.dirname(os.path.abspath(filename)).encode()
+        if libc.inotify_add_watch(self.fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = libc_error()
+            self.close()
+            raise error
+        # events of a watch on a file carry no name. -1 (no watch) if the file doesn't exist yet
+        self.file_watch = libc.inotify_add_watch(
+            self.fd, os.path.abspath(filename).encode(), IN_CLOSE_WRITE
+        )
 
-# Color logs on screen
-colors = ColoredFormatter(FORMATTER["format"], datefmt=FORMATTER["datefmt"], style="{")
-console = logging.StreamHandler()
-console.setFormatter(colors)
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
-# File logs uncolored
-file_logs_uncolored = TimedRotatingFileHandler(
-    "logs/logs.log", backupCount=7, when="midnight"
-)
-uncolored_formatter = logging.Formatter(
-    FORMATTER["format"].replace("{color}", ""), datefmt=FORMATTER["datefmt"], style="{"
-)
-file_logs_uncolored.setFormatter(uncolored_formatter)
+    def changed(self) -> bool:
+        """
+        reads every pending event without blocking
+        :return: True if the config file was written or replaced
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                watch, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                changed = changed or name == self.name or watch == self.file_watch
+        return changed
 
-# File logs colored
-file_logs_colored = TimedRotatingFileHandler(
-    "logs/logs_color.log", backupCount=7, when="midnight"
-)
-file_logs_colored.setFormatter(colors)
 
-# Adding those handlers
-logger.addHandler(console)
-logger.addHandler(file_logs_colored)
-logger.addHandler(file_logs_uncolored)
+def watch_config(filename: str = "config.yaml") -> Optional[ConfigWatcher]:
+    """
+    reloads the config whenever the config file is edited, from the running event loop
+    :param filename: the config file
+    :return: the watcher, None if inotify is not available and a changed config needs a restart
+    """
+    import asyncio
 
-logger.setLevel(10)
+    try:
+        watcher = ConfigWatcher(filename)
+    except (OSError, AttributeError) as e:
+        logger.warning(
+            "Unable to watch %s for changes, edits will need a restart: %s", filename, e
+        )
+        return None
 
-"""
-ooooo   ooooo           oooo                                                                
-`888'   `888'           `888                                                                
- 888     888   .ooooo.   888  oo.ooooo.   .ooooo.  oooo d8b                                 
- 888ooooo888  d88' `88b  888   888' `88b d88' `88b `888""8P                                 
- 888     888  888ooo888  888   888   888 888ooo888  888                                     
- 888     888  888    .o  888   888   888 888    .o  888                                     
-o888o   o888o `Y8bod8P' o888o  888bod8P' `Y8bod8P' d888b                                    
-                               888                                                          
-                              o888o                                                         
-                                                                                            
-oooooooooooo                                       .    o8o                                 
-`888'     `8                                     .o8    `"'                                 
- 888         oooo  oooo  ooo. .oo.    .ooooo.  .o888oo oooo   .ooooo.  ooo. .oo.    .oooo.o 
- 888oooo8    `888  `888  `888P"Y88b  d88' `"Y8   888   `888  d88' `88b `888P"Y88b  d88(  "8 
- 888    "     888   888   888   888  888         888    888  888   888  888   888  `"Y88b.  
- 888          888   888   888   888  888   .o8   888 .  888  888   888  888   888  o.  )88b 
-o888o         `V88V"V8P' o888o o888o `Y8bod8P'   "888" o888o `Y8bod8P' o888o o888o 8""888P'
-"""
+    def on_readable():
+        if watcher.changed():
+            reload_config(filename)
 
+    asyncio.get_running_loop().add_reader(watcher.fd, on_readable)
+    logger.debug("Watching %s for changes", filename)
+    return watcher
 
-def parse_time(phase_dict: dict) -> Dict[str, datetime.timedelta]:
+
+class NotificationOutbox:
     """
-    Returns the new dictionary with parsed datetime from string
-    :param phase_dict: the phase dictionary containing datetime string
-    :return:
+    Append-only on disk queue (sqlite in WAL mode) of telegram alerts that haven't been delivered yet.
+    Alerts survive suspends and restarts of the program, and are only removed once telegram has accepted them.
     """
-    logger.debug("Data received: %s", phase_dict)
-    ultimate_time = datetime.timedelta(hours=23, minutes=59, seconds=59)
+
+    def __init__(self, filename: str = "logs/outbox.sqlite3"):
+        """
+        :param filename: the sqlite database file
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection: Optional["sqlite3.Connection"] = None
+        # alerts in the outbox, kept up to date so it can be read without a query
+        self.depth = 0
+
+    @property
+    def connection(self) -> "sqlite3.Connection":
+        if self._connection is None:
+            # imported on first use, most runs never get to queue an alert
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self.filename, check_same_thread=False, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            # make sure an alert is on disk before we suspend
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, queued_at REAL, message TEXT)"
+            )
+            self.depth = connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def open(self):
+        """
+        opens the outbox now instead of on first use, so `depth` counts the alerts a previous run left in it
+        :return: None
+        """
+        with self._lock:
+            self.connection
+
+    def append(self, message: str) -> int:
+        """
+        :return: the id of the queued alert
+        """
+        with self._lock:
+            cursor = self.connection.execute(
+                "INSERT INTO outbox (queued_at, message) VALUES (?, ?)",
+                (datetime.datetime.now().timestamp(), message),
+            )
+            self.depth += 1
+            return cursor.lastrowid
+
+    def pending(self, max_length: int) -> List[Tuple[int, float, str]]:
+        """
+        the oldest undelivered alerts, as many as fit in `max_length` characters once batched (at least one)
+        :param max_length: max length of the batched message, see batch_message()
+        :return: list of (id, queued at timestamp, message)
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id, queued_at, message FROM outbox ORDER BY id"
+            ).fetchall()
+        batch, length = [], 0
+        for row in rows:
+            # every alert of a batch is stamped, and separated from the previous one
+            length += len(stamp_alert(row[1], row[2])) + len(ALERT_SEPARATOR)
+            if batch and length - len(ALERT_SEPARATOR) > max_length:
+                break
+            batch.append(row)
+        return batch
+
+    def remove(self, ids: List[int]):
+        with self._lock:
+            cursor = self.connection.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(_id,) for _id in ids]
+            )
+            self.depth -= cursor.rowcount
+
+
+ALERT_SEPARATOR = "\n\n"
+
+
+def stamp_alert(queued_at: float, message: str) -> str:
+    """
+    :param queued_at: when the alert was queued, as a timestamp
+    :param message: the alert
+    :return: the alert with when it was queued, as it's sent in a batch
+    """
+    return f"`[{datetime.datetime.fromtimestamp(queued_at).strftime('%b %d %H:%M:%S')}]` {message}"
+
+
+class TelegramNotifier:
+    """
+    Delivers telegram alerts from a background thread, so that the program never waits on telegram.
+    Alerts are first written to the outbox, and everything pending in it gets delivered as one batched message.
+    Uses one `requests.Session` (keep-alive, pooled connections) and POSTs the messages, so they get url encoded
+    properly. Failed deliveries are retried with exponential backoff and full jitter, which matters most right when the
+    network has just come back and is still flaky. `flush()` cuts the backoff short once we know we're connected.
+    """
+
+    def __init__(
+        self,
+        outbox: NotificationOutbox,
+        base_delay: float = 1,
+        max_delay: float = 300,
+        max_length: int = 4000,
+    ):
+        """
+        :param outbox: where the undelivered alerts are kept
+        :param base_delay: seconds to back off after the first failed attempt
+        :param max_delay: max seconds to back off for
+        :param max_length: max length of a batched message. telegram allows 4096 characters
+        """
+        self.outbox = outbox
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_length = max_length
+        self._wake = threading.Event()
+        self.session: Optional["requests.Session"] = None
+        self.thread: Optional[threading.Thread] = None
+        # metrics
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+        self.latencies: Deque[float] = collections.deque(maxlen=100)
+        # id -> monotonic time the alert was queued at, for the "notification sent" stage. the outbox's wall clock
+        # timestamps would count the time spent suspended too
+        self._queued_at: Dict[int, float] = {}
+
+    def send(self, message: str):
+        """
+        writes the message to the outbox and returns right away
+        :param message: The message
+        :return: None
+        """
+        self._queued_at[self.outbox.append(message[:1000])] = monotonic()
+        self.flush()
+
+    def flush(self):
+        """
+        delivers everything in the outbox now, skipping any backoff in progress
+        :return: None
+        """
+        if self.thread is None:
+            # requests takes longer to import than the rest of the program, so it's only imported for the first alert
+            import requests
+
+            self.session = requests.Session()
+            self.thread = threading.Thread(
+                target=self._worker, name="telegram notifier", daemon=True
+            )
+            self.thread.start()
+        self._wake.set()
+
+    def _deliver(self, message: str) -> Optional[float]:
+        """
+        sends the message once
+        :param message: The message
+        :return: None if delivered, otherwise seconds to wait before retrying. raises if it should not be retried
+        """
+        import requests
+
+        config = CONFIG
+        try:
+            response = self.session.post(
+                f"https://api.telegram.org/bot{config.bot_token}/sendMessage",
+                data={
+                    "chat_id": config.chat_id,
+                    "parse_mode": "Markdown",
+                    "text": message,
+                },
+                timeout=10,
+            )
+        except requests.exceptions.RequestException as e:
+            logger.debug("Unable to reach telegram: %s", e)
+            return 0
+        logger.debug(response)
+        if response.ok:
+            return None
+        if response.status_code == 429:
+            # telegram tells us how long to back off for
+            try:
+                return float(response.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                return 0
+        if response.status_code >= 500:
+            return 0
+        raise ValueError(f"telegram rejected the message: {response.text}")
+
+    def _worker(self):
+        attempt = 0
+        # after telegram rejects a batch, that many alerts are sent one at a time, to drop only the one it rejects
+        one_by_one = 0
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                while batch := self.outbox.pending(
+                    0 if one_by_one else self.max_length
+                ):
+                    if len(batch) == 1:
+                        message = batch[0][2]
+                    else:
+                        message = ALERT_SEPARATOR.join(
+                            stamp_alert(queued_at, text) for _, queued_at, text in batch
+                        )
+                    try:
+                        retry_after = self._deliver(message)
+                    except ValueError as e:
+                        if len(batch) > 1:
+                            logger.warning("%s, sending the alerts one at a time", e)
+                            one_by_one = len(batch)
+                            continue
+                        logger.error("%s", e)
+                        self.dropped += 1
+                        self.outbox.remove([batch[0][0]])
+                        self._queued_at.pop(batch[0][0], None)
+                        one_by_one = max(one_by_one - 1, 0)
+                        continue
+                    if retry_after is None:
+                        one_by_one = max(one_by_one - len(batch), 0)
+                        self.outbox.remove([row[0] for row in batch])
+                        now = datetime.datetime.now().timestamp()
+                        self.sent += len(batch)
+                        self.latencies.extend(now - row[1] for row in batch)
+                        for row in batch:
+                            # alerts left in the outbox by an earlier run aren't timed
+                            queued_at = self._queued_at.pop(row[0], None)
+                            if queued_at is not None:
+                                SPANS.record(
+                                    "notification sent", monotonic() - queued_at
+                                )
+                        logger.debug(
+                            "%d telegram alert(s) delivered after %d retries",
+                            len(batch),
+                            attempt,
+                        )
+                        attempt = 0
+                        continue
+                    attempt += 1
+                    self.retries += 1
+                    backoff = min(self.max_delay, self.base_delay * 2**attempt)
+                    # flush() wakes us up early, eg: when we know we're connected again
+                    if self._wake.wait(max(retry_after, random.uniform(0, backoff))):
+                        self._wake.clear()
+            except Exception:
+                # eg: the outbox's database failing. the alerts stay in the outbox, so keep the thread alive & retry
+                attempt += 1
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2**attempt)
+                )
+                logger.exception(
+                    "Unable to deliver the telegram alerts, retrying in %.1f seconds",
+                    delay,
+                )
+                self._wake.wait(delay)
+                self._wake.set()
+
+    @property
+    def queue_depth(self) -> int:
+        """the number of alerts waiting to be delivered, kept up to date by the outbox instead of counted"""
+        return self.outbox.depth
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        :return: delivery & retry counters, queue depth and the delivery latency of the last 100 alerts
+        """
+        return {
+            "sent": self.sent,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "queue depth": self.queue_depth,
+            "latency avg": (
+                sum(self.latencies) / len(self.latencies) if self.latencies else 0
+            ),
+            "latency max": max(self.latencies, default=0),
+        }
+
+
+NOTIFIER = TelegramNotifier(NotificationOutbox())
+
+
+def alert_onTelegram(message: str):
+    """
+    This function will send an alert to telegram notifying about the change.
+    The alert is written to the outbox and delivered in the background by NOTIFIER, so this never blocks.
+    If the bot token is not provided, this function will not run
+    :param message: The message
+    :return: None
+    """
+    if CONFIG is not None and CONFIG.bot_token and CONFIG.chat_id:
+        NOTIFIER.send(message)
+
+
+"""
+888                            d8b                   
+888                            Y8P                   
+888                                                  
+888  .d88b.   .d88b.   .d88b.  888 88888b.   .d88b.  
+888 d88""88b d88P"88b d88P"88b 888 888 "88b d88P"88b 
+888 888  888 888  888 888  888 888 888  888 888  888 
+888 Y88..88P Y88b 888 Y88b 888 888 888  888 Y88b 888 
+888  "Y88P"   "Y88888  "Y88888 888 888  888  "Y88888 
+                  888      888                   888 
+             Y8b d88P Y8b d88P              Y8b d88P 
+              "Y88P"   "Y88P"                "Y88P"  
+"""
+
+# Starting program logger
+
+logger = logging.getLogger(__name__)
+
+# Uncolored logs, every record is formatted only once
+uncolored_formatter = PlainFormatter(
+    FORMATTER["format"].replace("{color}", ""), datefmt=FORMATTER["datefmt"], style="{"
+)
+colors = ColoredFormatter(uncolored_formatter)
+
+# Color logs on screen
+console = logging.StreamHandler()
+console.setFormatter(colors)
+
+# File logs uncolored
+file_logs_uncolored = TimedRotatingFileHandler(
+    "logs/logs.log", backupCount=7, when="midnight"
+)
+file_logs_uncolored.setFormatter(uncolored_formatter)
+
+# File logs colored
+file_logs_colored = TimedRotatingFileHandler(
+    "logs/logs_color.log", backupCount=7, when="midnight"
+)
+file_logs_colored.setFormatter(colors)
+
+# The logger only puts records on the queue, a listener thread writes them to those handlers
+LOG_QUEUE: queue.Queue = queue.Queue(maxsize=10000)
+log_queue_handler = DroppingQueueHandler(LOG_QUEUE)
+log_listener = QueueListener(LOG_QUEUE, console, file_logs_colored, file_logs_uncolored)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger.addHandler(log_queue_handler)
+
+logger.setLevel(10)
+
+
+def flush_logs():
+    """
+    waits till the listener has written out every queued log record
+    :return: None
+    """
+    if log_listener._thread is not None:
+        LOG_QUEUE.join()
+    for handler in log_listener.handlers:
+        handler.flush()
+
+
+def init_console():
+    """
+    wraps stdout & stderr with colorama, which resets the color after every write and strips the colors when they
+    aren't a terminal, and points the console logs at the wrapped stderr. called when the program starts, importing
+    this module doesn't need colorama
+    :return: None
+    """
+    import colorama
+
+    colorama.init(autoreset=True)
+    console.setStream(sys.stderr)
+
+
+"""
+ooooo   ooooo           oooo                                                                
+`888'   `888'           `888                                                                
+ 888     888   .ooooo.   888  oo.ooooo.   .ooooo.  oooo d8b                                 
+ 888ooooo888  d88' `88b  888   888' `88b d88' `88b `888""8P                                 
+ 888     888  888ooo888  888   888   888 888ooo888  888                                     
+ 888     888  888    .o  888   888   888 888    .o  888                                     
+o888o   o888o `Y8bod8P' o888o  888bod8P' `Y8bod8P' d888b                                    
+                               888                                                          
+                              o888o                                                         
+                                                                                            
+oooooooooooo                                       .    o8o                                 
+`888'     `8                                     .o8    `"'                                 
+ 888         oooo  oooo  ooo. .oo.    .ooooo.  .o888oo oooo   .ooooo.  ooo. .oo.    .oooo.o 
+ 888oooo8    `888  `888  `888P"Y88b  d88' `"Y8   888   `888  d88' `88b `888P"Y88b  d88(  "8 
+ 888    "     888   888   888   888  888         888    888  888   888  888   888  `"Y88b.  
+ 888          888   888   888   888  888   .o8   888 .  888  888   888  888   888  o.  )88b 
+o888o         `V88V"V8P' o888o o888o `Y8bod8P'   "888" o888o `Y8bod8P' o888o o888o 8""888P'
+"""
+
+
+def parse_time(phase_dict: dict) -> Dict[str, datetime.timedelta]:
+    """
+    Returns the new dictionary with parsed datetime from string
+    :param phase_dict: the phase dictionary containing datetime string
+    :return:
+    """
+    logger.debug("Data received: %s", phase_dict)
+    ultimate_time = datetime.timedelta(hours=23, minutes=59, seconds=59)
     start_time = phase_dict["start time"]
     end_time = phase_dict["end time"]
     converted_time = []
@@ -408,179 +1350,555 @@ def get_current_time_delta() -> datetime.timedelta:
     )
 
 
-def current_time_within_time_range(phase: dict) -> bool:
+def repr_time_delta(time: datetime.timedelta):
     """
-    checks whether the current time is within the start-time <= time < end-time range
-    :param phase: dictionary containing the phase's start and end time
-    :return: bool
+    represents the passed in time delta as a proper date
+    :param time:
+    :return:
     """
-    # thank you https://stackoverflow.com/questions/30529437/python-time-comparison-at-midnight
-    now = get_current_time_delta()
-    logger.debug("Phase start time: %s\t Current time:%s", phase["start time"], now)
-    if phase["start time"] <= phase["end time"]:
-        return phase["start time"] <= now < phase["end time"]
-    else:
-        return phase["start time"] <= now or phase["end time"] > now
-    # return phase["start time"] <= get_current_time_delta() < phase["end time"]
+    formated_time = datetime.datetime.combine(
+        datetime.datetime.today().date(), (datetime.datetime.min + time).time()
+    )
+    return formated_time.strftime("%d/%b/%Y %H:%M:%S")
 
 
-def get_nearest_phase(
-    *args, key: Literal["start time", "end time"] = "start time"
-) -> Tuple[str, datetime.timedelta]:
+def now_local() -> datetime.datetime:
     """
-    This function will return the phase which is nearest to the current time.
-    We'll get a list/tuple of all the phase names and their start timings.
-    Then run the super complex python expression to get the nearest phase
-    :param key: the key to check within range against
-    :param args:
-    :return: tuple of the nearest phase and the time left until then
+    :return: the current time, timezone aware in the local timezone
     """
-    now = get_current_time_delta()
+    return datetime.datetime.now().astimezone()
 
-    def key_function(dict_):
-        """
-        This function will be the "key" function to be put in max()'s key arg
-        :param dict_: the dict
-        :return: the output of the difference b/w current time and the start time of the phase
-        """
-        return dict_[key] - now
 
-    logger.debug("%s\n\t%s", args, list(map(key_function, args)))
-    answer = min(args, key=key_function)
-    return answer["name"], answer["start time"] - now
+def localize(wall_time: datetime.datetime) -> datetime.datetime:
+    """
+    :param wall_time: naive datetime, in local time
+    :return: timezone aware datetime. a wall time skipped by DST (eg: 02:30 when clocks go from 02:00 to 03:00) is
+             moved forward by the length of the gap (03:30), so it's never earlier than the wall time asked for
+    """
+    instant = wall_time.astimezone()
+    skipped = wall_time - instant.replace(tzinfo=None)
+    if skipped > datetime.timedelta(0):
+        instant = (instant + skipped).astimezone()
+    return instant
 
 
-def get_nearest_phaseV2(phase1, phase2) -> Tuple[str, datetime.timedelta]:
+def next_occurrence(
+    time: datetime.timedelta, after: Optional[datetime.datetime] = None
+) -> datetime.datetime:
     """
-    This function will return the phase which is nearest to the current time.
-    :param phase1: the first phase time + name dict
-    :param phase2: the second phase time + name dict
-    :return: tuple of the nearest phase and the time left until then
+    the next instant the wall clock reads `time`. DST aware, so eg: 08:00 is always 08:00 local time even on the day
+    the clocks change
+    :param time: the time of the day, wraps around if it's negative or more than a day
+    :param after: timezone aware datetime the instant has to be after. now by default
+    :return: timezone aware datetime
     """
-    now = get_current_time_delta()
-    range_1 = {
-        "name": phase2["name"],
-        "start time": phase1["end time"],
-        "end time": phase2["start time"],
-    }
-    range_2 = {
-        "name": phase1["name"],
-        "start time": phase2["end time"],
-        "end time": phase1["start time"],
-    }
-    if current_time_within_time_range(range_1):
-        return range_1["name"], range_1["start time"] - now
-    elif current_time_within_time_range(range_2):
-        return range_2["name"], range_2["start time"] - now
+    after = after or now_local()
+    time = time % datetime.timedelta(days=1)
+    day = after.date()
+    while True:
+        instant = localize(datetime.datetime.combine(day, datetime.time.min) + time)
+        if instant > after:
+            return instant
+        day += datetime.timedelta(days=1)
 
 
-def repr_time_delta(time: datetime.timedelta):
+def to_instant(time) -> datetime.datetime:
     """
-    represents the passed in time delta as a proper date
-    :param time:
-    :return:
+    :param time: either a time of the day (timedelta), or a datetime
+    :return: timezone aware datetime. the next occurrence of `time` if it was a time of the day
     """
-    formated_time = datetime.datetime.combine(
-        datetime.datetime.today().date(), (datetime.datetime.min + time).time()
-    )
-    return formated_time.strftime("%d/%b/%Y %H:%M:%S")
+    if isinstance(time, datetime.timedelta):
+        return next_occurrence(time)
+    return time if time.tzinfo else time.astimezone()
 
 
-def get_last_sleep_time() -> datetime.datetime:
+class PhaseTimeline:
     """
-    returns tha last sleep time in datetime.datetime format.
-    uses the command: grep -E "PM: suspend entry" /var/log/syslog
-    to get the last sleep time from system logs
-    Since the year is not present in log file, assumes the last sleep time is the current year
-    :return: the last sleep time. datetime.datetime.min if unable to find the last sleep time.
+    The phases compiled into a sorted list of absolute, timezone aware instants at which the current phase changes.
+    Days are generated lazily as lookups go further into the future, and every lookup is a bisect over the list.
     """
-    try:
-        sleep_entry_entries = subprocess.check_output(
-            'grep -E "PM: suspend entry" /var/log/syslog; exit 0', shell=True
-        ).decode()
-        assert len(sleep_entry_entries) != 0, "No last sleep time recorded"
-    except (subprocess.CalledProcessError, AssertionError):
-        return datetime.datetime.min
 
-    sleep_entry_entries = sleep_entry_entries.split("\n")[:-1]
-    last_sleep_entry = sleep_entry_entries[-1].split()
-    month_date_time = " ".join(last_sleep_entry[0:3])
+    def __init__(self, phases: List["Phase"], days: int = 14):
+        """
+        :param phases: the compiled phases. they shouldn't overlap
+        :param days: how many days to generate at a time
+        """
+        self.phases = phases
+        self.days = days
+        self._instants: List[float] = []
+        self._transitions: List[Tuple[datetime.datetime, str]] = []
+        self._first_day: Optional[datetime.date] = None
+        self._next_day: Optional[datetime.date] = None
+
+    def _generate(self, day: datetime.date):
+        """adds the transitions of the phases starting on `day`"""
+        midnight = datetime.datetime.combine(day, datetime.time.min)
+        for phase in self.phases:
+            start = midnight + phase.start_time
+            end = midnight + phase.end_time
+            if end <= start:
+                end += datetime.timedelta(days=1)
+            self._transitions.append((localize(start), phase.name))
+            self._transitions.append((localize(end), "NEITHER"))
+
+    def _extend(self, since: datetime.datetime, until: datetime.datetime):
+        """generates days so that the transitions cover `since` & there's at least one transition after `until`"""
+        # start from the day before, a phase that started then might still be going on
+        first_day = since.date() - datetime.timedelta(days=1)
+        if self._first_day is None or first_day < self._first_day:
+            self._first_day = self._next_day = first_day
+            self._transitions, self._instants = [], []
+        while not self._instants or self._instants[-1] <= until.timestamp():
+            for _ in range(self.days):
+                self._generate(self._next_day)
+                self._next_day += datetime.timedelta(days=1)
+            # a phase ending at the exact instant another starts: the NEITHER in between comes first
+            self._transitions.sort(key=lambda t: (t[0], t[1] != "NEITHER"))
+            self._instants = [instant.timestamp() for instant, _ in self._transitions]
+
+    def _index(self, when: datetime.datetime) -> int:
+        """:return: index of the last transition at or before `when`"""
+        self._extend(when, when)
+        return bisect.bisect_right(self._instants, when.timestamp()) - 1
+
+    def phase_at(
+        self, when: Optional[datetime.datetime] = None
+    ) -> Tuple[str, datetime.datetime]:
+        """
+        :param when: timezone aware datetime, now by default
+        :return: the name of the phase we're in at `when` & the instant it ends
+        """
+        when = when or now_local()
+        index = self._index(when)
+        name = self._transitions[index][1] if index >= 0 else "NEITHER"
+        return name, self._transitions[index + 1][0]
+
+    def next_transition(
+        self, when: Optional[datetime.datetime] = None
+    ) -> Tuple[datetime.datetime, str]:
+        """
+        :param when: timezone aware datetime, now by default
+        :return: the next instant the phase changes & the phase it changes to
+        """
+        when = when or now_local()
+        index = self._index(when) + 1
+        # skip the NEITHER in between back to back phases
+        while (
+            index + 1 < len(self._instants)
+            and self._instants[index + 1] == self._instants[index]
+        ):
+            index += 1
+        return self._transitions[index]
+
+    def next_start(
+        self, name: str, when: Optional[datetime.datetime] = None
+    ) -> datetime.datetime:
+        """
+        :param name: the phase's name
+        :param when: timezone aware datetime, now by default
+        :return: the next instant the phase `name` starts
+        """
+        when = when or now_local()
+        while True:
+            instant, phase = self.next_transition(when)
+            if phase == name:
+                return instant
+            when = instant
+
+    def transitions(
+        self, since: datetime.datetime, until: datetime.datetime
+    ) -> List[Tuple[datetime.datetime, str]]:
+        """
+        :return: every (instant, phase it changes to) in since <= instant < until
+        """
+        self._extend(since, until)
+        start = bisect.bisect_left(self._instants, since.timestamp())
+        end = bisect.bisect_left(self._instants, until.timestamp())
+        return self._transitions[start:end]
+
+
+def print_plan(days: int = 7):
+    """
+    prints the phase transitions of the next `days` days
+    :param days: how many days to print
+    :return: None
+    """
+    now = now_local()
+    transitions = CONFIG.timeline.transitions(now, now + datetime.timedelta(days=days))
+    for (instant, name), (next_instant, _) in zip(
+        transitions, transitions[1:] + [(None, None)]
+    ):
+        # back to back phases: don't print the NEITHER in between
+        if instant == next_instant:
+            continue
+        print(f"  {instant.strftime('%a %d/%b/%Y %H:%M:%S %Z')}  ->  {name}")
+
+
+def parse_syslog_time(line: str) -> Optional[datetime.datetime]:
+    """
+    parses the timestamp at the start of a syslog line. understands both the classic `Mon DD HH:MM:SS` format (assumes
+    the current year, since the year is not present in the line) and the ISO 8601 format
+    :param line: the syslog line
+    :return: the time, None if it could not be parsed
+    """
+    entry = line.split()
+    month_date_time = " ".join(entry[0:3])
 
     try:
-        last_sleep_entry_time = datetime.datetime.strptime(
-            month_date_time, "%b %d %H:%M:%S"
-        )
-        last_sleep_entry_time = last_sleep_entry_time.replace(
-            year=datetime.date.today().year
-        )
+        entry_time = datetime.datetime.strptime(month_date_time, "%b %d %H:%M:%S")
+        entry_time = entry_time.replace(year=datetime.date.today().year)
     except ValueError:
         pass
     else:
-        return last_sleep_entry_time
+        return entry_time
 
     try:
-        last_sleep_entry_time = datetime.datetime.fromisoformat(last_sleep_entry[0])
-    except ValueError:
+        entry_time = datetime.datetime.fromisoformat(entry[0])
+    except (ValueError, IndexError):
         pass
     else:
-        return last_sleep_entry_time
+        return entry_time
 
-    logger.warning("found sleep entry in syslog, but unable to parse time")
-
-    return datetime.datetime.min
+    return None
 
 
-def connected_to_wifi(ssid: str) -> bool:
+def find_last_line_containing(
+    filename: str, marker: bytes, start: int = 0
+) -> Tuple[Optional[bytes], int]:
     """
-    checks whether the device is connected to wifi using linux's nmcli command.
-    Assumes, that the device automatically connects to `ssid` if `ssid` is in range.
-    so we just need to check if wifi scan discovers the ssid
-    :param ssid: str, the name of the wifi network
-    :return: bool
+    scans the file backwards from its end (memory mapped, so nothing is read into memory) and stops at the first line
+    containing `marker`
+    :param filename: the file to scan
+    :param marker: the bytes to look for
+    :param start: the offset to stop scanning at. data before it is not looked at
+    :return: the last line containing the marker (None if not found), and the offset till which the file has been
+             scanned (end of the last complete line)
     """
-    scan_output = subprocess.check_output(["nmcli", "device", "wifi", "list"]).decode()
-    return ssid in scan_output
+    with open(filename, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0 or start >= size:
+            return None, min(start, size)
+        import mmap
 
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # only count complete lines as scanned, the last line could still be getting written
+            scanned_till = max(mapped.rfind(b"\n", start, size) + 1, start)
+            position = mapped.rfind(marker, start, scanned_till)
+            if position == -1:
+                return None, scanned_till
+            line_start = mapped.rfind(b"\n", 0, position) + 1
+            line_end = mapped.find(b"\n", position, scanned_till)
+            return mapped[line_start:line_end], scanned_till
 
-def check_connected_to_internetV2(
-    connection_type: Literal["any", "wired", "wireless"] = "any",
-) -> Tuple[bool, Tuple[str]]:
+
+def get_last_sleep_time_from_syslog() -> datetime.datetime:
     """
-    check's internet connectivity based on system's reporting.
-    src: https://sourcedigit.com/20684-how-to-check-eth0-status-on-linux-ubuntu-find-network-interface-card-details-on-
-    ubuntu/
-    :param connection_type: the type of connection to check whether connected to internet or not. by default scans for
-    ethernet and for wifi
-    accepted arguments: 'wired', 'wireless', 'any'
-    :return: bool
+    returns tha last sleep time in datetime.datetime format.
+    scans /var/log/syslog backwards for the last "PM: suspend entry" line to get the last sleep time from system logs.
+    The syslog's inode and the offset scanned till are saved in SYSLOG_SCAN_STATE, so the next call only scans the
+    lines written since, and also looks in the rotated syslog.1 if the syslog was rotated in between.
+    Since the year is not present in log file, assumes the last sleep time is the current year
+    :return: the last sleep time. datetime.datetime.min if unable to find the last sleep time.
     """
+    marker = b"PM: suspend entry"
+    try:
+        with open(SYSLOG_SCAN_STATE) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        state = {"inode": None, "offset": 0, "line": None}
 
-    def get_card_status(card_name: str) -> int:
-        """
-        checks and returns the status of network cards [wired and/or wireless] and if they're connected to internet
-        or not as reported by the system
-        :param card_name: the name of the network card
-        :return: int, 0 or 1
-        """
-
-        try:
-            result = int(
-                subprocess.check_output(["cat", f"/sys/class/net/{card_name}/carrier"])
-                .decode()
-                .strip("\n")
+    try:
+        syslog_stat = os.stat(SYSLOG_PATH)
+        syslog_inode = syslog_stat.st_ino
+        if syslog_inode == state["inode"] and state["offset"] <= syslog_stat.st_size:
+            line, offset = find_last_line_containing(
+                SYSLOG_PATH, marker, state["offset"]
             )
-        except subprocess.CalledProcessError:
-            result = (
-                subprocess.check_output(
-                    ["cat", f"/sys/class/net/{card_name}/operstate"]
+        else:
+            # first run or the log got rotated. scan the new log, and what we hadn't scanned of the old one
+            line, offset = find_last_line_containing(SYSLOG_PATH, marker)
+            rotated = SYSLOG_PATH + ".1"
+            if line is None and os.path.exists(rotated):
+                rotated_start = (
+                    state["offset"] if os.stat(rotated).st_ino == state["inode"] else 0
                 )
-                .decode()
-                .strip("\n")
-            )
-            result = 1 if result == "up" else 0
-        return result
+                line, _ = find_last_line_containing(rotated, marker, rotated_start)
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to scan %s: %s", SYSLOG_PATH, e)
+    else:
+        if line is not None:
+            state["line"] = line.decode(errors="replace")
+        state.update(inode=syslog_inode, offset=offset)
+        try:
+            with open(SYSLOG_SCAN_STATE, "w") as state_file:
+                json.dump(state, state_file)
+        except OSError as e:
+            logger.debug("Unable to save syslog scan state: %s", e)
 
-    network_devices = subprocess.check_output(["ls", "/sys/class/net"]).decode().split()
+    if state["line"] is None:
+        return datetime.datetime.min
+
+    last_sleep_entry_time = parse_syslog_time(state["line"])
+    if last_sleep_entry_time is not None:
+        return last_sleep_entry_time
+
+    logger.warning("found sleep entry in syslog, but unable to parse time")
+
+    return datetime.datetime.min
+
+
+class SuspendTracker:
+    """
+    Detects suspends without reading any logs.
+    CLOCK_BOOTTIME keeps counting while the computer is suspended but CLOCK_MONOTONIC doesn't, so the gap in between
+    them grows by exactly the time spent suspended. /sys/power/suspend_stats/success counts the successful suspends.
+    Every `sample()` compares both with the previous sample. The suspend's start is the current wall time minus the
+    time spent suspended, which is exact when the sample is taken right after resuming, and otherwise later than the
+    actual start by however long we were awake after resuming: at most the time we were awake in between the samples.
+    The samples are saved to `state_file`, to keep working across restarts of the program.
+    """
+
+    def __init__(
+        self,
+        state_file: str = "logs/suspend_tracker_state.json",
+        suspend_stats: str = "/sys/power/suspend_stats/success",
+        min_suspend: float = 1.0,
+        save_every: float = 60,
+    ):
+        """
+        :param state_file: where to persist the samples
+        :param suspend_stats: the suspend success counter. it is optional, clocks alone are enough
+        :param min_suspend: seconds the clock gap has to grow by to count as a suspend
+        :param save_every: max seconds in between saving the samples to `state_file`
+        """
+        self.state_file = state_file
+        self.suspend_stats = suspend_stats
+        self.min_suspend = min_suspend
+        self.save_every = save_every
+        self._saved_at = -save_every
+        # suspends detected since the program started
+        self.detected = 0
+        try:
+            with open(state_file) as file:
+                self.state = json.load(file)
+        except (OSError, ValueError):
+            self.state = {"boot id": None, "last sleep": None}
+
+    @staticmethod
+    def _boot_id() -> Optional[str]:
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    def _suspend_count(self) -> Optional[int]:
+        try:
+            with open(self.suspend_stats) as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def last_sleep(self) -> Optional[datetime.datetime]:
+        """
+        the time the last detected suspend started at, None if no suspend has been detected. an upper bound, accurate
+        to within the time we were awake in between the samples around the suspend
+        """
+        if self.state["last sleep"] is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.state["last sleep"])
+
+    def sample(self, save: bool = False) -> bool:
+        """
+        samples the clocks and suspend counter. constant time, only a couple of syscalls
+        :param save: save the sample right away. eg: right before suspending
+        :return: True if a suspend happened since the previous sample
+        """
+        wall = datetime.datetime.now().timestamp()
+        monotonic_now = clock_gettime(CLOCK_MONOTONIC)
+        gap = clock_gettime(CLOCK_BOOTTIME) - monotonic_now
+        count = self._suspend_count()
+        boot_id = self._boot_id()
+
+        suspended = False
+        if self.state["boot id"] == boot_id and boot_id is not None:
+            suspended_for = gap - self.state["gap"]
+            count_grew = None not in (count, self.state["count"]) and (
+                count > self.state["count"]
+            )
+            if suspended_for >= self.min_suspend or count_grew:
+                suspended = True
+                self.detected += 1
+                # the wall clock kept going while suspended, so the suspend started `suspended_for` seconds before
+                # now, minus however long we've been awake since resuming. that can't be more than the time we were
+                # awake since the previous sample, and it can't have started before the previous sample either
+                awake = monotonic_now - self.state.get("monotonic", monotonic_now)
+                self.state["last sleep"] = max(self.state["wall"], wall - suspended_for)
+                logger.debug(
+                    "Detected a suspend of %.1f seconds, that started at %s, or up to %.1f seconds before",
+                    suspended_for,
+                    self.last_sleep.strftime("%d/%b/%Y %H:%M:%S"),
+                    max(awake, 0),
+                )
+
+        self.state.update(
+            {
+                "boot id": boot_id,
+                "gap": gap,
+                "count": count,
+                "wall": wall,
+                "monotonic": monotonic_now,
+            }
+        )
+        if save or suspended or monotonic_now - self._saved_at >= self.save_every:
+            self._saved_at = monotonic_now
+            try:
+                with open(self.state_file, "w") as file:
+                    json.dump(self.state, file)
+            except OSError as e:
+                logger.debug("Unable to save suspend tracker state: %s", e)
+        return suspended
+
+
+SUSPEND_TRACKER = SuspendTracker()
+
+
+def get_last_sleep_time(sleep_detection: Optional[str] = None) -> datetime.datetime:
+    """
+    returns tha last sleep time in datetime.datetime format, from the source set by `sleep_detection` in the config:
+    - kernel: from the kernel clocks & suspend counters, see SuspendTracker. an upper bound of when the suspend
+              started, accurate to within the time the program was awake in between the samples around it
+    - syslog: from the "PM: suspend entry" lines in the syslog
+    - auto: kernel if it has seen a suspend, syslog otherwise
+    :param sleep_detection: *Optional. the source to use instead of the config's, eg: before the config is compiled
+    :return: the last sleep time. datetime.datetime.min if unable to find the last sleep time.
+    """
+    if sleep_detection is None:
+        sleep_detection = CONFIG.sleep_detection if CONFIG is not None else "auto"
+    if sleep_detection in ["auto", "kernel"]:
+        SUSPEND_TRACKER.sample()
+        last_sleep = SUSPEND_TRACKER.last_sleep
+        if last_sleep is not None:
+            return last_sleep
+        if sleep_detection == "kernel":
+            return datetime.datetime.min
+    return get_last_sleep_time_from_syslog()
+
+
+def connected_to_wifi(ssid: str) -> bool:
+    """
+    checks whether the device is connected to wifi using linux's nmcli command.
+    Assumes, that the device automatically connects to `ssid` if `ssid` is in range.
+    so we just need to check if wifi scan discovers the ssid
+    :param ssid: str, the name of the wifi network
+    :return: bool
+    """
+    scan_output = subprocess.check_output(["nmcli", "device", "wifi", "list"]).decode()
+    return ssid in scan_output
+
+
+class SysfsNetReader:
+    """
+    Reads the network cards' attributes straight from sysfs, instead of forking `ls` & `cat` for every one of them.
+    The attribute files are kept open in between probes and re-read with pread(), since sysfs regenerates the content
+    of an attribute every time it is read from offset 0.
+    """
+
+    def __init__(self, root: str = "/sys/class/net"):
+        """
+        :param root: the directory containing the network devices. can be pointed to a fake tree
+        """
+        self.root = root
+        self._fds: Dict[str, Dict[str, int]] = {}
+
+    def list_devices(self) -> List[str]:
+        """
+        :return: names of all the network devices present right now
+        """
+        with os.scandir(self.root) as entries:
+            devices = sorted(entry.name for entry in entries)
+        for gone in set(self._fds) - set(devices):
+            self._close_device(gone)
+        return devices
+
+    def _close_device(self, device: str):
+        for fd in self._fds.pop(device, {}).values():
+            os.close(fd)
+
+    def close(self):
+        for device in list(self._fds):
+            self._close_device(device)
+
+    def read(self, device: str, attribute: str, retry: bool = True) -> Optional[str]:
+        """
+        reads an attribute of a device, opening the attribute file only the first time
+        :param device: the name of the network device
+        :param attribute: the attribute file, eg: carrier/operstate
+        :param retry: reopen the file once if the kept open descriptor went stale (device removed & re-added)
+        :return: the stripped content, None if it can't be read. (`carrier` can't be read while the device is down)
+        """
+        fds = self._fds.setdefault(device, {})
+        try:
+            if attribute not in fds:
+                fds[attribute] = os.open(
+                    os.path.join(self.root, device, attribute), os.O_RDONLY
+                )
+            return os.pread(fds[attribute], 64, 0).decode().strip()
+        except OSError as e:
+            if e.errno == errno.EINVAL or not retry:
+                return None
+            self._close_device(device)
+            return self.read(device, attribute, retry=False)
+
+    def card_status(self, card_name: str) -> int:
+        """
+        checks and returns the status of network cards [wired and/or wireless] and if they're connected to internet
+        or not as reported by the system
+        :param card_name: the name of the network card
+        :return: int, 0 or 1
+        """
+        carrier = self.read(card_name, "carrier")
+        if carrier is not None and carrier.isdigit():
+            return int(carrier)
+        return 1 if self.read(card_name, "operstate") == "up" else 0
+
+    def card_statuses(self, card_names: List[str]) -> Dict[str, int]:
+        """
+        reads the status of every given card in one pass
+        :param card_names: the network cards to check
+        :return: dict of card name -> 0 or 1
+        """
+        return {card: self.card_status(card) for card in card_names}
+
+
+SYSFS_NET = SysfsNetReader()
+
+
+def link_is_up() -> bool:
+    """
+    :return: True if any wired or wireless card has a carrier
+    """
+    try:
+        cards = [card for card in SYSFS_NET.list_devices() if card[0] in "ew"]
+        return any(SYSFS_NET.card_statuses(cards).values())
+    except OSError:
+        return False
+
+
+def check_connected_to_internetV2(
+    connection_type: Literal["any", "wired", "wireless"] = "any",
+) -> Tuple[bool, Tuple[str]]:
+    """
+    check's internet connectivity based on system's reporting.
+    src: https://sourcedigit.com/20684-how-to-check-eth0-status-on-linux-ubuntu-find-network-interface-card-details-on-
+    ubuntu/
+    :param connection_type: the type of connection to check whether connected to internet or not. by default scans for
+    ethernet and for wifi
+    accepted arguments: 'wired', 'wireless', 'any'
+    :return: bool
+    """
+    network_devices = SYSFS_NET.list_devices()
     wired = [e for e in network_devices if e[0] == "e"]
     wireless = [w for w in network_devices if w[0] == "w"]
 
@@ -591,9 +1909,9 @@ def check_connected_to_internetV2(
 
     devices = {"wired": wired, "wireless": wireless, "any": wired + wireless}
 
-    for card in devices[connection_type]:
+    for card, status in SYSFS_NET.card_statuses(devices[connection_type]).items():
         logger.debug("Testing device... " + Fore.CYAN + card)
-        if get_card_status(card) == 1:
+        if status == 1:
             CONNECTED_TO_INTERNET = True
             DEVICE_CONNECTED.append(card)
             logger.debug(
@@ -608,94 +1926,365 @@ def check_connected_to_internetV2(
     return CONNECTED_TO_INTERNET, tuple(DEVICE_CONNECTED)
 
 
+# ICMP message types. ref: RFC 792 & RFC 4443
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+ICMP_HEADER = struct.Struct("!BBHHH")  # type, code, checksum, identifier, sequence
+
+
+def icmp_checksum(data: bytes) -> int:
+    """
+    the internet checksum (RFC 1071) of `data`
+    :param data: the ICMP packet with the checksum field zeroed
+    :return: 16 bit checksum
+    """
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpProber:
+    """
+    Sends ICMP echo requests from within the process instead of running `ping`.
+    Uses the unprivileged ICMP datagram sockets (`net.ipv4.ping_group_range`), and falls back to raw sockets when
+    running as root.
+    """
+
+    def __init__(self, timeout: float = 1.0, retries: int = 1):
+        """
+        :param timeout: seconds to wait for a reply to each echo request. can be less than a second
+        :param retries: how many more echo requests to send if the first one goes unanswered
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self._sequence = itertools.count(1)
+        self._identifier = os.getpid() & 0xFFFF
+        self._available: Optional[bool] = None
+
+    @staticmethod
+    def _open(family: int) -> Tuple[socket.socket, bool]:
+        """
+        opens an ICMP socket for the address family
+        :return: the socket, and whether it is a raw socket
+        """
+        protocol = (
+            socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+        )
+        try:
+            return socket.socket(family, socket.SOCK_DGRAM, protocol), False
+        except PermissionError:
+            if os.geteuid() != 0:
+                raise
+            return socket.socket(family, socket.SOCK_RAW, protocol), True
+
+    @property
+    def available(self) -> bool:
+        """whether this process is allowed to open an ICMP socket at all"""
+        if self._available is None:
+            try:
+                self._open(socket.AF_INET)[0].close()
+                self._available = True
+            except OSError as e:
+                logger.warning(
+                    "Unable to open an ICMP socket (%s), will use the ping command instead",
+                    e,
+                )
+                self._available = False
+        return self._available
+
+    def probe(
+        self,
+        ip: str,
+        interface: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Optional[float]:
+        """
+        pings `ip`, retrying `retries` times
+        :param ip: the ipv4/ipv6 address. an ipv6 link local address can carry its scope as `fe80::1%eth0`
+        :param interface: the interface to use as the scope of an ipv6 link local address
+        :param timeout: seconds the probe gets in total, retries included. no limit other than `timeout` & `retries`
+                        if None
+        :return: round trip time in seconds, None if no reply came back
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        rtt = None
+        for _ in range(self.retries + 1):
+            wait = self.timeout
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    break
+            rtt = self._probe_once(ip, interface, wait)
+            if rtt is not None:
+                break
+        return rtt
+
+    def _probe_once(
+        self, ip: str, interface: Optional[str], timeout: float
+    ) -> Optional[float]:
+        address, _, scope = ip.partition("%")
+        scope = scope or interface
+        if ":" in address:
+            family, request_type, reply_type = (
+                socket.AF_INET6,
+                ICMPV6_ECHO_REQUEST,
+                ICMPV6_ECHO_REPLY,
+            )
+        else:
+            family, request_type, reply_type = (
+                socket.AF_INET,
+                ICMP_ECHO_REQUEST,
+                ICMP_ECHO_REPLY,
+            )
+
+        sequence = next(self._sequence) & 0xFFFF
+        payload = b"12-hour-server"
+        header = ICMP_HEADER.pack(request_type, 0, 0, self._identifier, sequence)
+        # the kernel fills in the checksum of ICMPv6 packets by itself
+        if family == socket.AF_INET:
+            checksum = icmp_checksum(header + payload)
+            header = ICMP_HEADER.pack(
+                request_type, 0, checksum, self._identifier, sequence
+            )
+
+        try:
+            # the interface can be gone by now, and `available` only tells about ipv4 ICMP sockets
+            if family == socket.AF_INET6:
+                destination = (
+                    address,
+                    0,
+                    0,
+                    socket.if_nametoindex(scope) if scope else 0,
+                )
+            else:
+                destination = (address, 0)
+            sock, raw = self._open(family)
+        except OSError as e:
+            logger.debug("Unable to ping %s: %s", ip, e)
+            return None
+        try:
+            sock.setblocking(False)
+            start = monotonic()
+            sock.sendto(header + payload, destination)
+            deadline = start + timeout
+            while (remaining := deadline - monotonic()) > 0:
+                ready, _, _ = select.select([sock], [], [], remaining)
+                if not ready:
+                    break
+                packet, source = sock.recvfrom(1024)
+                if raw and family == socket.AF_INET:
+                    packet = packet[(packet[0] & 0x0F) * 4 :]  # strip the ip header
+                if len(packet) < ICMP_HEADER.size or source[0] != address:
+                    continue
+                _type, _, _, identifier, reply_sequence = ICMP_HEADER.unpack_from(
+                    packet
+                )
+                # datagram sockets get their identifier rewritten by the kernel, so only raw ones can check it
+                if (
+                    _type == reply_type
+                    and reply_sequence == sequence
+                    and (not raw or identifier == self._identifier)
+                ):
+                    return monotonic() - start
+        except OSError as e:
+            logger.debug("Unable to ping %s: %s", ip, e)
+        finally:
+            sock.close()
+        return None
+
+
+ICMP_PROBER = IcmpProber()
+
+
+def get_probe_executor() -> "concurrent.futures.ThreadPoolExecutor":
+    """
+    returns the thread pool used to probe several gateways at the same time, creating it on first use
+    :return: the thread pool
+    """
+    global PROBE_EXECUTOR
+    if PROBE_EXECUTOR is None:
+        import concurrent.futures
+
+        PROBE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="probe"
+        )
+    return PROBE_EXECUTOR
+
+
+def select_gateways(
+    connection_type: Literal["any", "wired", "wireless"] = "any",
+) -> list:
+    """
+    picks the gateways to check for a connection type
+    any -> the ipv4 & ipv6 default gateways
+    wired/wireless -> every gateway reachable through a wired/wireless card
+    :param connection_type: any/wired/wireless
+    :return: the gateways, as (address, interface, is default) tuples from `netifaces.gateways()`
+    """
+    import netifaces
+
+    gateways = GATEWAY_CACHE.get()
+    to_check = []
+
+    if connection_type == "any":
+        # AF_INET is ipv4 addresses, AF_INET6 is ipv6
+        for family in [netifaces.AF_INET, netifaces.AF_INET6]:
+            if family in gateways["default"]:
+                to_check.append(gateways["default"][family])
+    elif connection_type in ["wired", "wireless"]:
+        for family in [netifaces.AF_INET, netifaces.AF_INET6]:
+            if family in gateways:
+                to_check.extend(gateways[family])
+    else:
+        raise ValueError(
+            f'parameter connection_type expected one of wired/wireless/any, got: "{connection_type}"'
+        )
+
+    # only ping if:
+    #   - connection  == any
+    #       OR
+    #   - gateway[0] == w && connection == wireless
+    #       OR
+    #   - gateway[0] == e && connection == wired
+    to_check = [
+        gateway
+        for gateway in to_check
+        if (connection_type == "any")
+        or (connection_type == "wireless" and gateway[1][0] == "w")
+        or (connection_type == "wired" and gateway[1][0] == "e")
+    ]
+
+    logger.debug(
+        "gateways found: %s (cache hits: %d, misses: %d)",
+        gateways,
+        GATEWAY_CACHE.hits,
+        GATEWAY_CACHE.misses,
+    )
+    return to_check
+
+
 def check_connected_to_internetV3(
     connection_type: Literal["any", "wired", "wireless"] = "any",
 ) -> Tuple[bool, Tuple[str]]:
     """
     Checks for internet connectivity by pinging the default gateway.
-    any -> pings the default gateway
+    any -> pings the ipv4 & ipv6 default gateways
     wired -> same as `any`, but checks in AF_LINK gateways
     (PS: i dunno if practically there could be 2 default gateways, so i just made the method assuming there could be
      multiple gateways that work)
     :param connection_type: any/wired/wireless; which connection device to check
     :return: (bool, str) ; if device is connected and the connected device's name
     """
+    connected, devices, _ = ping_gateways(connection_type)
+    return connected, devices
+
+
+def ping_gateways(
+    connection_type: Literal["any", "wired", "wireless"] = "any",
+    timeout: Optional[float] = None,
+) -> Tuple[bool, Tuple[str, ...], Optional[float]]:
+    """
+    the v3 method, see check_connected_to_internetV3
+    :param connection_type: any/wired/wireless; which connection device to check
+    :param timeout: seconds the pings get in total. a gateway that hasn't replied by then counts as offline. no limit
+                    other than the prober's own timeout if None
+    :return: (bool, devices, rtt) ; if device is connected, the connected devices' names and the round trip time in
+             seconds of the gateway that replied. None if none replied, or it was pinged with the ping command
+    """
+    deadline = None if timeout is None else monotonic() + timeout
 
-    def ping(ip: str) -> bool:
+    def remaining() -> Optional[float]:
+        """:return: seconds left till the deadline, None if there's no deadline"""
+        return None if deadline is None else max(deadline - monotonic(), 0)
+
+    def ping(ip: str, interface: Optional[str] = None) -> Tuple[bool, Optional[float]]:
         """
         Pings the given ip and returns boolean value on success or fail
         :param ip: the ip address. correctness of ip check is not performed
-        :return: True/False if ping was successful or failed
+        :param interface: the interface the gateway is reachable through
+        :return: True/False if ping was successful or failed, and the round trip time if it's known
         """
+        if ICMP_PROBER.available:
+            rtt = ICMP_PROBER.probe(ip, interface, timeout=remaining())
+            if rtt is None:
+                logger.debug("No reply from %s", ip)
+                return False, None
+            logger.debug("Reply from %s in %.2f ms", ip, rtt * 1000)
+            return True, rtt
+
         _ping_output = ""
         try:
-            _ping_output = subprocess.check_output(["ping", "-c", "1", ip]).decode()
+            _ping_output = subprocess.check_output(
+                ["ping", "-c", "1", ip], timeout=remaining()
+            ).decode()
             assert (
                 "1 received" in _ping_output
             ), "Ping 'successful', but packet not received"
-        except subprocess.CalledProcessError:
-            return False
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return False, None
         except AssertionError:
             logger.error("ping output: %s", _ping_output, exc_info=True)
-            return False
+            return False, None
         else:
-            return True
+            return True, None
 
     """
     Pseudocode:
-        * pick a device: default/AF_LINK/AF_INET (else: valuerror)
-        * default: ping the ip
+        * pick a device: default/AF_LINK/AF_INET/AF_INET6 (else: valuerror)
+        * default: ping the ipv4 & ipv6 default gateways
         * else: 
-            * iterate through the list, if name starts with w/e ping it
+            * ping every gateway whose device name starts with w/e
+        * all the gateways are pinged in parallel, the first reply decides
     """
     _CONNECTED_TO_INTERNET = False
     _DEVICES_CONNECTED: List[str] = []
+    rtt = None
 
-    gateways = netifaces.gateways()
-    to_check = []
-
-    if connection_type == "any":
-        if netifaces.AF_INET in gateways["default"]:
-            to_check.append(
-                gateways["default"][netifaces.AF_INET]
-            )  # AF_INET is ipv4 addresses
-    elif connection_type in ["wired", "wireless"]:
-        if netifaces.AF_INET in gateways:
-            to_check.extend(gateways[netifaces.AF_INET])
-    else:
-        raise ValueError(
-            f'parameter connection_type expected one of wired/wireless/any, got: "{connection_type}"'
-        )
-
-    logger.debug("gateways found: %s", gateways)
+    to_check = select_gateways(connection_type)
     logger.debug("devices to check: %s", to_check)
     for gateway in to_check:
-        # only ping if:
-        #   - connection  == any
-        #       OR
-        #   - gateway[0] == w && connection == wireless
-        #       OR
-        #   - gateway[0] == e && connection == wired
-        if (
-            (connection_type == "any")
-            or (connection_type == "wireless" and gateway[1][0] == "w")
-            or (connection_type == "wired" and gateway[1][0] == "e")
-        ):
-            logger.debug("Testing device... " + Fore.CYAN + gateway[1])
-            output = ping(gateway[0])
-            if output is True:
+        logger.debug("Testing device... " + Fore.CYAN + gateway[1])
+
+    import concurrent.futures
+
+    # any reachable gateway satisfies every connection type (select_gateways() filtered them), so return as soon as
+    # one of them replies. if none reply, we end up waiting for the slowest one, not for the sum of all of them
+    futures = {
+        get_probe_executor().submit(ping, gateway[0], gateway[1]): gateway
+        for gateway in to_check
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures, remaining()):
+            try:
+                replied, reply_rtt = future.result()
+            except Exception as e:
+                logger.error("Unable to ping %s: %s", futures[future][0], e)
+                continue
+            if replied is True:
+                gateway = futures[future]
                 _CONNECTED_TO_INTERNET = True
                 _DEVICES_CONNECTED.append(gateway[1])
+                rtt = reply_rtt
                 logger.debug(
                     f"Device: {Fore.CYAN + gateway[1] + Fore.WHITE} is connected to internet"
                 )
+                break
+    except concurrent.futures.TimeoutError:
+        logger.debug("No gateway replied in %.1f seconds", timeout)
+    for straggler in futures:
+        straggler.cancel()
     if _CONNECTED_TO_INTERNET is False:
         logger.debug(
             "No device connected to internet. Computer is currently %sOFFLINE",
             Fore.YELLOW,
         )
 
-    return _CONNECTED_TO_INTERNET, tuple(_DEVICES_CONNECTED)
+    return _CONNECTED_TO_INTERNET, tuple(_DEVICES_CONNECTED), rtt
 
 
 def check_connected_to_internetV2V3(
@@ -707,16 +2296,272 @@ def check_connected_to_internetV2V3(
                             scans for any device by default
     :return: boolean and a tuple of devices that were detected to be connected
     """
+    connected, devices, _ = carrier_then_ping(connection_type)
+    return connected, devices
+
+
+def carrier_then_ping(
+    connection_type: Literal["any", "wired", "wireless"] = "any",
+    timeout: Optional[float] = None,
+) -> Tuple[bool, Tuple[str, ...], Optional[float]]:
+    """
+    the v2+v3 method, see check_connected_to_internetV2V3. the gateways are only pinged if a device has a carrier
+    :param timeout: seconds the probe gets in total, see ping_gateways()
+    :return: (bool, devices, rtt) ; like ping_gateways(), rtt is None if the gateways weren't pinged
+    """
+    start = monotonic()
     v2 = check_connected_to_internetV2(connection_type)
     if v2[0]:
-        v3 = check_connected_to_internetV3(connection_type)
-        return v3[0], v2[1] + v3[1]
+        v3 = ping_gateways(
+            connection_type,
+            None if timeout is None else timeout - (monotonic() - start),
+        )
+        return v3[0], v2[1] + v3[1], v3[2]
     else:
-        return v2
+        return v2[0], v2[1], None
+
+
+# the local signals of the race method, the upstream `targets` are signals of their own
+RACE_SIGNALS = ["carrier", "neighbour", "icmp"]
+
+
+def split_target(target: str) -> Tuple[str, Optional[int]]:
+    """
+    :param target: an upstream target of the race method. `host:port` (`[ipv6]:port`) to connect to, or a name to
+                   look up
+    :return: the host & the port, None for a name to look up
+    Raises ValueError if the port isn't a port number
+    """
+    target = str(target)
+    host, colon, port = target.rpartition(":")
+    if not colon or (":" in host and not host.startswith("[")):
+        # a name, or a bare ipv6 address
+        return target, None
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"`race` -> `targets`: bad port in {target}")
+    return host.strip("[]"), int(port)
+
+
+class ConnectivityRace:
+    """
+    The `race` connectivity method. Instead of running one method after another, it starts all of its signals at the
+    same time under a single deadline:
+        carrier: the network cards' carrier (the v2 method)
+        neighbour: the gateways' entries in the kernel's neighbour cache, whether one was confirmed reachable recently
+        icmp: pings the gateways (the v3 method)
+        tcp <host:port> / dns <name>: connects to / looks up the upstream `targets`, past the router
+    Every signal votes online or offline, or abstains (eg: the gateway's neighbour entry is stale). `quorum` of the
+    signals that vote have to vote online. As soon as that's reached, or can't be reached any more, the outcome is
+    decided and the signals still running are abandoned: the ones that haven't started are cancelled, the rest end by
+    their own timeouts in the background. With the default quorum (all of them), the first offline vote decides.
+    """
+
+    def __init__(
+        self,
+        signals: Tuple[str, ...] = tuple(RACE_SIGNALS),
+        targets: Tuple[str, ...] = (),
+        quorum: Optional[int] = None,
+        timeout: float = 2,
+    ):
+        """
+        :param signals: the local signals to run
+        :param targets: the upstream targets to connect to or look up
+        :param quorum: how many of the signals that vote have to vote online. all of them by default
+        :param timeout: seconds all the signals get, in total
+        """
+        self.configure(signals, targets, quorum, timeout)
+        # the last outcome: result, the signal that decided it, how long it took & every signal's vote
+        self.last: Optional[dict] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def configure(
+        self,
+        signals: Tuple[str, ...],
+        targets: Tuple[str, ...],
+        quorum: Optional[int],
+        timeout: float,
+    ):
+        self.signals = signals
+        self.targets = targets
+        self.quorum = quorum
+        self.timeout = timeout
+
+    @staticmethod
+    def neighbour(connection_type: str) -> Optional[bool]:
+        """
+        :return: True if a gateway was confirmed reachable recently, None otherwise (no entry, stale, being resolved).
+                 a failed entry only tells the last resolution failed, which can be long before the link came back
+        """
+        states = neighbour_states()
+        for gateway in select_gateways(connection_type):
+            if states.get(gateway[0].partition("%")[0], 0) & (
+                NUD_REACHABLE | NUD_PERMANENT | NUD_NOARP
+            ):
+                return True
+        return None
+
+    @staticmethod
+    def connect(host: str, port: int, deadline: float) -> bool:
+        """:return: True if a TCP connection to host:port could be opened before the deadline"""
+        try:
+            with socket.create_connection(
+                (host, port), timeout=max(deadline - monotonic(), 0.001)
+            ):
+                return True
+        except OSError as e:
+            logger.debug("Unable to connect to %s:%d: %s", host, port, e)
+            return False
+
+    @staticmethod
+    def look_up(name: str) -> bool:
+        """:return: True if the name could be looked up. a name that doesn't exist is an answer too"""
+        try:
+            socket.getaddrinfo(name, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            logger.debug("Unable to look up %s: %s", name, e)
+            return e.errno == socket.EAI_NONAME
+        return True
+
+    def _signals(
+        self, connection_type: str, deadline: float
+    ) -> Dict[
+        str, Callable[[], Tuple[Optional[bool], Tuple[str, ...], Optional[float]]]
+    ]:
+        """:return: signal name -> function returning its vote, the devices it found connected & the gateway's rtt"""
+        signals = {}
+        if "carrier" in self.signals:
+            signals["carrier"] = lambda: (
+                *check_connected_to_internetV2(connection_type),
+                None,
+            )
+        if "neighbour" in self.signals:
+            signals["neighbour"] = lambda: (self.neighbour(connection_type), (), None)
+        if "icmp" in self.signals:
+            signals["icmp"] = lambda: ping_gateways(
+                connection_type, deadline - monotonic()
+            )
+        for target in self.targets:
+            host, port = split_target(target)
+            if port is None:
+                signals[f"dns {host}"] = lambda host=host: (
+                    self.look_up(host),
+                    (),
+                    None,
+                )
+            else:
+                signals[f"tcp {target}"] = lambda host=host, port=port: (
+                    self.connect(host, port, deadline),
+                    (),
+                    None,
+                )
+        return signals
+
+    def run(
+        self, connection_type: Literal["any", "wired", "wireless"] = "any"
+    ) -> Tuple[bool, Tuple[str, ...]]:
+        """
+        races the signals
+        :param connection_type: any/wired/wireless; which connection device to check
+        :return: (bool, devices) ; if the quorum voted online, and the devices the signals found connected
+        """
+        result, devices, _ = self.race(connection_type)
+        return result, devices
+
+    def race(
+        self,
+        connection_type: Literal["any", "wired", "wireless"] = "any",
+        timeout: Optional[float] = None,
+    ) -> Tuple[bool, Tuple[str, ...], Optional[float]]:
+        """
+        races the signals
+        :param connection_type: any/wired/wireless; which connection device to check
+        :param timeout: seconds the race gets, if it's less than the race's own `timeout`
+        :return: (bool, devices, rtt) ; like run(), and the round trip time of the gateway that replied to the icmp
+                 signal. None if that signal didn't finish before the race was decided, or got no reply
+        """
+        import concurrent.futures
+
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        start = monotonic()
+        signals = self._signals(connection_type, start + timeout)
+        quorum = min(self.quorum or len(signals), len(signals))
+        if self._executor is None:
+            # twice the signals, so a race doesn't wait for the stragglers of the previous one
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=2 * len(signals) + 2, thread_name_prefix="race"
+            )
+        futures = {
+            self._executor.submit(signal): name for name, signal in signals.items()
+        }
+        votes: Dict[str, Optional[bool]] = {}
+        devices: List[str] = []
+        rtt = None
+        result, decided_by = False, "deadline"
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout):
+                name = futures[future]
+                try:
+                    vote, found, signal_rtt = future.result()
+                except Exception as e:
+                    logger.debug("Signal %s failed: %s", name, e)
+                    vote, found, signal_rtt = None, (), None
+                votes[name] = vote
+                if vote:
+                    devices.extend(found)
+                    rtt = signal_rtt if signal_rtt is not None else rtt
+                online = sum(1 for vote in votes.values() if vote)
+                pending = len(futures) - len(votes)
+                # abstaining signals lower the quorum, down to the signals left to vote
+                needed = min(
+                    quorum,
+                    len(futures) - sum(1 for vote in votes.values() if vote is None),
+                )
+                if needed == 0:
+                    if pending == 0:
+                        decided_by = name
+                        break
+                elif online >= needed or online + pending < needed:
+                    result, decided_by = online >= needed, name
+                    break
+        except concurrent.futures.TimeoutError:
+            pass
+        for future in futures:
+            future.cancel()
+        elapsed = monotonic() - start
+        self.last = {
+            "result": result,
+            "decided by": decided_by,
+            "seconds": elapsed,
+            "votes": {name: votes.get(name, "pending") for name in signals},
+        }
+        METRICS.race_decisions[(decided_by, result)] += 1
+        logger.debug(
+            "Race decided %s by %s in %.1f ms, votes: %s",
+            "online" if result else "offline",
+            decided_by,
+            elapsed * 1000,
+            self.last["votes"],
+        )
+        return result, tuple(dict.fromkeys(devices)), rtt
+
+
+CONNECTIVITY_RACE = ConnectivityRace()
+
+
+def check_connected_to_internet_race(
+    connection_type: Literal["any", "wired", "wireless"] = "any",
+) -> Tuple[bool, Tuple[str, ...]]:
+    """
+    races the carrier, neighbour, icmp & upstream signals, see ConnectivityRace
+    :param connection_type: the type of device to check whether connected to internet or not.
+                            scans for any device by default
+    :return: boolean and a tuple of devices that were detected to be connected
+    """
+    return CONNECTIVITY_RACE.run(connection_type)
 
 
 def connectivity_function_factory(
-    version: Literal["v2", "v3", "v2+v3"] = "v2",
+    version: Literal["v2", "v3", "v2+v3", "race"] = "v2",
 ) -> Callable[[Literal["any", "wired", "wireless"]], Tuple[bool, Tuple[str, ...]]]:
     """
     returns the right method based on version requirements
@@ -727,163 +2572,2226 @@ def connectivity_function_factory(
         "v2": check_connected_to_internetV2,
         "v3": check_connected_to_internetV3,
         "v2+v3": check_connected_to_internetV2V3,
+        "race": check_connected_to_internet_race,
     }
     return methods[version]
 
 
+def timed_connectivity_function_factory(
+    version: Literal["v2", "v3", "v2+v3", "race"] = "v2",
+) -> Callable[
+    [Literal["any", "wired", "wireless"], Optional[float]],
+    Tuple[bool, Tuple[str, ...], Optional[float]],
+]:
+    """
+    like connectivity_function_factory(), but the method also returns the round trip time of the gateway that replied
+    to it in this very probe, None if it didn't ping one. for the probe store.
+    the method also takes the seconds the probe gets, so that it gives up by itself instead of being abandoned
+    :param version: the version of connectivity method to use
+    :return: the method to use
+    """
+    methods = {
+        "v2": lambda connection_type, timeout=None: (
+            *check_connected_to_internetV2(connection_type),
+            None,
+        ),
+        "v3": ping_gateways,
+        "v2+v3": carrier_then_ping,
+        "race": CONNECTIVITY_RACE.race,
+    }
+    return methods[version]
+
+
+# rtnetlink constants. ref: linux/rtnetlink.h & linux/netlink.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_ROUTE = 0x400
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+NLMSG_HEADER = struct.Struct("=LHHLL")  # length, type, flags, sequence, port id
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NDMSG = struct.Struct("=BxxxiHBB")  # family, interface index, state, flags, type
+RTATTR = struct.Struct("=HH")  # length, type
+NDA_DST = 1
+# neighbour states. ref: linux/neighbour.h
+NUD_REACHABLE = 0x02
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+
+class NetlinkMonitor:
+    """
+    Listens to the kernel's rtnetlink multicast groups, so that instead of polling `/sys/class/net` every `timeout`
+    seconds we can block until the kernel tells us that something changed (carrier, operstate, an address being
+    added/removed...)
+    """
+
+    def __init__(
+        self,
+        groups: int = RTMGRP_LINK | RTMGRP_IPV4_IFADDR,
+        message_types: Tuple[int, ...] = (
+            RTM_NEWLINK,
+            RTM_DELLINK,
+            RTM_NEWADDR,
+            RTM_DELADDR,
+        ),
+    ):
+        """
+        :param groups: bitmask of the RTMGRP_* multicast groups to subscribe to
+        :param message_types: the RTM_* message types that count as a change
+        """
+        self.groups = groups
+        self.message_types = message_types
+        self.sock: Optional[socket.socket] = None
+        # set by `wait_async()` while it's waiting
+        self._changed: Optional["asyncio.Event"] = None
+
+    def open(self) -> bool:
+        """
+        opens and binds the netlink socket
+        :return: True if the socket could be opened, False otherwise (eg: restricted container, non-linux)
+        """
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+            )
+            sock.bind((0, self.groups))
+            sock.setblocking(False)
+        except (OSError, AttributeError) as e:
+            logger.warning("Unable to open rtnetlink socket: %s", e)
+            return False
+        self.sock = sock
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def drain(self) -> List[int]:
+        """
+        reads every pending netlink message without blocking. closes the monitor if the socket fails for good
+        :return: the message types of the read messages. -1 if the kernel dropped messages because we were too slow,
+                 or if the monitor got closed
+        """
+        types: List[int] = []
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                types.append(-1)
+                if e.errno == errno.ENOBUFS:
+                    # socket buffer overran, we lost some events. treat it as a change
+                    continue
+                logger.warning("rtnetlink socket failed, closing it: %s", e)
+                self.close()
+                break
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, message_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    break
+                types.append(message_type)
+                offset += (length + 3) & ~3  # messages are 4 byte aligned
+        return types
+
+    def wait(self, timeout: float, settle: float = 0.25) -> bool:
+        """
+        blocks the thread until the kernel reports a change or `timeout` seconds pass
+        :param timeout: max seconds to block for
+        :param settle: seconds to wait after the first event, so that a burst of events (carrier + operstate +
+                       address) gets collapsed into one wakeup
+        :return: True if a change was reported, False if timed out
+        """
+        deadline = monotonic() + timeout
+        while self.sock is not None and (remaining := deadline - monotonic()) > 0:
+            ready, _, _ = select.select([self.sock], [], [], remaining)
+            if not ready:
+                return False
+            types = self.drain()
+            if -1 in types or any(t in self.message_types for t in types):
+                sleep(settle)
+                self.drain()
+                return True
+        return False
+
+    async def wait_async(self, timeout: float, settle: float = 0.25) -> bool:
+        """
+        same as `wait()`, but waits on the event loop instead of blocking the thread
+        :param timeout: max seconds to wait for
+        :param settle: seconds to wait after the first event, to collapse a burst of events into one wakeup
+        :return: True if a change was reported, False if timed out
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def on_readable():
+            types = self.drain()
+            if -1 in types or any(t in self.message_types for t in types):
+                changed.set()
+
+        # drain() can close the socket while we wait
+        fileno = self.sock.fileno()
+        loop.add_reader(fileno, on_readable)
+        self._changed = changed
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._changed = None
+            loop.remove_reader(fileno)
+        await asyncio.sleep(settle)
+        self.drain()
+        return True
+
+    def interrupt(self):
+        """makes a `wait_async()` in progress return right away, as if there was a change. call from the event loop"""
+        if self._changed is not None:
+            self._changed.set()
+
+
+def neighbour_states(family: int = socket.AF_UNSPEC) -> Dict[str, int]:
+    """
+    dumps the kernel's neighbour cache (ARP & NDP) over rtnetlink
+    :param family: AF_INET/AF_INET6, both by default
+    :return: address -> NUD_* state of every entry
+    Raises OSError if rtnetlink isn't available
+    """
+    request = NLMSG_HEADER.pack(
+        NLMSG_HEADER.size + NDMSG.size,
+        RTM_GETNEIGH,
+        NLM_F_REQUEST | NLM_F_DUMP,
+        1,
+        0,
+    ) + NDMSG.pack(family, 0, 0, 0, 0)
+    states: Dict[str, int] = {}
+    with socket.socket(
+        socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+    ) as sock:
+        sock.sendto(request, (0, 0))
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, message_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size or message_type == NLMSG_DONE:
+                    return states
+                if message_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", data, offset + NLMSG_HEADER.size)[
+                        0
+                    ]
+                    raise OSError(error, os.strerror(error))
+                if message_type == RTM_NEWNEIGH:
+                    address_family, _, state, _, _ = NDMSG.unpack_from(
+                        data, offset + NLMSG_HEADER.size
+                    )
+                    attribute = offset + NLMSG_HEADER.size + NDMSG.size
+                    while attribute + RTATTR.size <= offset + length:
+                        attribute_length, attribute_type = RTATTR.unpack_from(
+                            data, attribute
+                        )
+                        if attribute_length < RTATTR.size:
+                            break
+                        if attribute_type == NDA_DST:
+                            address = socket.inet_ntop(
+                                address_family,
+                                data[
+                                    attribute
+                                    + RTATTR.size : attribute
+                                    + attribute_length
+                                ],
+                            )
+                            states[address] = state
+                        attribute += (attribute_length + 3) & ~3
+                offset += (length + 3) & ~3
+
+
+def get_link_monitor() -> Optional[NetlinkMonitor]:
+    """
+    returns the shared link monitor, opening it on first use.
+    :return: the monitor, or None if rtnetlink is not available and we have to fall back to polling
+    """
+    global LINK_MONITOR
+    if LINK_MONITOR and LINK_MONITOR.sock is None:
+        logger.info("rtnetlink socket was closed, falling back to polling connectivity")
+        LINK_MONITOR = False
+    if LINK_MONITOR is None:
+        monitor = NetlinkMonitor()
+        if monitor.open():
+            logger.debug("Subscribed to rtnetlink link & address events")
+            LINK_MONITOR = monitor
+        else:
+            logger.info("rtnetlink not available, falling back to polling connectivity")
+            LINK_MONITOR = False
+    return LINK_MONITOR or None
+
+
+class GatewayCache:
+    """
+    Caches the gateways reported by `netifaces.gateways()`, which re-reads the whole routing table every time.
+    The cache gets invalidated by rtnetlink route events, or after `ttl` seconds if rtnetlink is not available.
+    Safe to use from several threads, eg: the race method's signals.
+    """
+
+    def __init__(self, ttl: float = 60):
+        """
+        :param ttl: seconds after which the cached gateways are refreshed, only used without rtnetlink
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._gateways: Optional[dict] = None
+        self._fetched_at = 0.0
+        self._monitor: Optional[NetlinkMonitor] = None
+        self._monitor_opened = False
+        # a thread draining the route events must also be the one refetching the gateways
+        self._lock = threading.Lock()
+
+    def _routes_changed(self) -> bool:
+        """
+        :return: whether the routing table could have changed since the gateways were fetched
+        """
+        if not self._monitor_opened:
+            self._monitor_opened = True
+            monitor = NetlinkMonitor(
+                RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_ROUTE, (RTM_NEWROUTE, RTM_DELROUTE)
+            )
+            if monitor.open():
+                self._monitor = monitor
+            else:
+                logger.info(
+                    "Gateways will be refreshed every %s seconds instead", self.ttl
+                )
+        if self._monitor is None:
+            return monotonic() - self._fetched_at > self.ttl
+        monitor = self._monitor
+        types = monitor.drain()
+        if monitor.sock is None:
+            logger.info("Gateways will be refreshed every %s seconds instead", self.ttl)
+            self._monitor = None
+        return -1 in types or any(t in monitor.message_types for t in types)
+
+    def invalidate(self):
+        with self._lock:
+            self._gateways = None
+
+    def get(self) -> dict:
+        """
+        :return: the gateways, in the same format as `netifaces.gateways()`
+        """
+        with self._lock:
+            # drained on every call, the first one included, so that the route events after a fetch are never missed
+            changed = self._routes_changed()
+            if self._gateways is None or changed:
+                import netifaces
+
+                self.misses += 1
+                self._gateways = netifaces.gateways()
+                self._fetched_at = monotonic()
+            else:
+                self.hits += 1
+            return self._gateways
+
+
+GATEWAY_CACHE = GatewayCache()
+
+
+# timerfd_create(2) flags & the clocks it accepts that the time module doesn't have
+TFD_CLOEXEC = 0o2000000
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+CLOCK_BOOTTIME_ALARM = 9
+CLOCK_NAMES = {
+    CLOCK_REALTIME: "CLOCK_REALTIME",
+    CLOCK_BOOTTIME: "CLOCK_BOOTTIME",
+    CLOCK_BOOTTIME_ALARM: "CLOCK_BOOTTIME_ALARM",
+}
+
+ITIMERSPEC = struct.Struct("llll")  # it_interval & it_value, both seconds & nanoseconds
+
+
+def get_libc() -> "ctypes.CDLL":
+    """
+    returns the C library, loading it on first use.
+    :return: libc, with errno saved after each call
+    """
+    global LIBC
+    if LIBC is None:
+        import ctypes.util
+
+        LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return LIBC
+
+
+def libc_error() -> OSError:
+    """
+    :return: the error of the last failed call through get_libc(), from the errno it saved
+    """
+    import ctypes
+
+    error = ctypes.get_errno()
+    return OSError(error, os.strerror(error))
+
+
+class TimerfdWaiter:
+    """
+    Sleeps the thread till an absolute deadline with a single timerfd read, instead of waking up over & over to check
+    the time. the timer keeps counting while the computer is suspended, so it fires on time after a resume. on
+    CLOCK_BOOTTIME_ALARM, the timer also wakes the computer up if it's suspended (needs CAP_WAKE_ALARM).
+    """
+
+    def __init__(self, clocks: List[int]):
+        """
+        :param clocks: the clocks to try, in order of preference. the first one the kernel lets us use is used
+        """
+        self.fd = None
+        self.clock = None
+        try:
+            libc = get_libc()
+        except OSError as e:
+            logger.debug("libc not available for timerfd: %s", e)
+            return
+        for clock in clocks:
+            fd = libc.timerfd_create(clock, TFD_CLOEXEC)
+            if fd >= 0:
+                self.fd, self.clock = fd, clock
+                return
+            logger.debug(
+                "timerfd on %s not available: %s",
+                CLOCK_NAMES[clock],
+                libc_error().strerror,
+            )
+
+    @property
+    def available(self) -> bool:
+        return self.fd is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait_until(
+        self, deadline: float, interrupt: Optional[threading.Event] = None
+    ) -> bool:
+        """
+        blocks till `deadline`
+        :param deadline: unix timestamp to wake up at
+        :param interrupt: don't wait if it's set. whoever sets it should call `interrupt()` too
+        :return: True if the deadline was reached (or we were interrupted), False if the wall clock was changed before
+                 that and the caller should check the time again
+        Raises OSError if the timer could not be armed
+        """
+        flags = TFD_TIMER_ABSTIME
+        if self.clock == CLOCK_REALTIME:
+            value = deadline
+            # we're told when the clock gets set, eg: by NTP, instead of sleeping to the wrong instant
+            flags |= TFD_TIMER_CANCEL_ON_SET
+        else:
+            value = (
+                clock_gettime(CLOCK_BOOTTIME) + deadline - clock_gettime(CLOCK_REALTIME)
+            )
+        # an all zero value disarms the timer instead of firing right away
+        spec = ITIMERSPEC.pack(
+            0, 0, int(value), max(1, int((value - int(value)) * 1e9))
+        )
+        if get_libc().timerfd_settime(self.fd, flags, spec, None) < 0:
+            raise libc_error()
+        # checked after arming: an interrupt() before this point was overridden by the arming above
+        if interrupt is not None and interrupt.is_set():
+            return True
+        try:
+            os.read(self.fd, 8)
+        except OSError as e:
+            if e.errno == errno.ECANCELED:
+                return False
+            raise
+        return True
+
+    def interrupt(self):
+        """makes a `wait_until()` in progress in another thread return right away, by firing the timer now"""
+        get_libc().timerfd_settime(self.fd, 0, ITIMERSPEC.pack(0, 0, 0, 1), None)
+
+
+def get_timer_waiter(alarm: bool = False) -> Optional[TimerfdWaiter]:
+    """
+    returns the shared timerfd waiter, opening it on first use.
+    :param alarm: True for a waiter that also wakes the computer up from suspend
+    :return: the waiter, or None if timerfd (or the alarm clock) is not available and we have to fall back
+    """
+    if alarm not in TIMER_WAITERS:
+        waiter = TimerfdWaiter(
+            [CLOCK_BOOTTIME_ALARM] if alarm else [CLOCK_REALTIME, CLOCK_BOOTTIME]
+        )
+        if waiter.available:
+            logger.debug("Using timerfd on %s to sleep", CLOCK_NAMES[waiter.clock])
+        TIMER_WAITERS[alarm] = waiter if waiter.available else None
+    return TIMER_WAITERS[alarm]
+
+
+class RtcDriver:
+    """
+    Sets the RTC wake alarm & suspends the computer by writing to sysfs directly, like rtcwake does, without forking
+    `sudo rtcwake` on the way to suspend.
+    The kernel takes the alarm in the rtc's own time. An rtc kept in local time (eg: dual booting with windows) is
+    ahead/behind by the UTC offset, which is added to the alarm like rtcwake does.
+    """
+
+    def __init__(
+        self,
+        root: str = "/sys",
+        device: Optional[str] = None,
+        adjtime: str = "/etc/adjtime",
+    ):
+        """
+        :param root: the sysfs mount point. can be pointed to a fake tree
+        :param device: the rtc to use eg: rtc0. by default the one the system clock is set from
+        :param adjtime: hwclock's state file, which says whether the rtc keeps UTC or local time
+        """
+        self.root = root
+        self.device = device
+        self.adjtime = adjtime
+        # seconds from deciding to suspend to writing to /sys/power/state, of the last suspend
+        self.last_latency: Optional[float] = None
+        # monotonic times the last suspend was entered at & returned at
+        self.entered_at: Optional[float] = None
+        self.resumed_at: Optional[float] = None
+
+    def _rtc_path(self, *path: str) -> str:
+        if self.device is None:
+            rtcs = os.path.join(self.root, "class", "rtc")
+            try:
+                devices = sorted(os.listdir(rtcs))
+            except OSError:
+                devices = []
+
+            def sets_system_clock(device: str) -> bool:
+                try:
+                    with open(os.path.join(rtcs, device, "hctosys")) as file:
+                        return file.read().strip() == "1"
+                except OSError:
+                    return False
+
+            self.device = next(
+                (device for device in devices if sets_system_clock(device)),
+                devices[0] if devices else "rtc0",
+            )
+        return os.path.join(self.root, "class", "rtc", self.device, *path)
+
+    def clock_mode(self) -> Optional[str]:
+        """
+        whether the rtc keeps UTC or local time. read from /etc/adjtime like hwclock & rtcwake do (UTC, if it doesn't
+        say). without /etc/adjtime (eg: in a container), the rtc's time is compared with the system clock instead
+        :return: "UTC", "LOCAL", or None if it can't be told
+        """
+        try:
+            with open(self.adjtime) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            pass
+        else:
+            return "LOCAL" if len(lines) > 2 and lines[2].strip() == "LOCAL" else "UTC"
+        try:
+            with open(self._rtc_path("since_epoch")) as file:
+                # the kernel reads the rtc as if it kept UTC
+                skew = int(file.read()) - clock_gettime(CLOCK_REALTIME)
+        except (OSError, ValueError):
+            return None
+        # UTC offsets are multiples of 15 minutes, a rtc that has drifted less than 5 minutes can still be told apart
+        if abs(skew) < 300:
+            return "UTC"
+        if abs(skew - now_local().utcoffset().total_seconds()) < 300:
+            return "LOCAL"
+        return None
+
+    @property
+    def available(self) -> bool:
+        """:return: True if we can set the wake alarm & suspend to ram ourselves"""
+        state = os.path.join(self.root, "power", "state")
+        try:
+            with open(state) as file:
+                can_suspend = "mem" in file.read().split()
+        except OSError:
+            return False
+        return (
+            can_suspend
+            and os.access(state, os.W_OK)
+            and os.access(self._rtc_path("wakealarm"), os.W_OK)
+            and self.clock_mode() is not None
+        )
+
+    def set_alarm(self, wake_at: int):
+        """
+        sets the rtc to wake the computer up at `wake_at`
+        :param wake_at: unix timestamp
+        :return: None
+        Raises a ValueError if the alarm read back from the rtc is not what was set or it's not known whether the rtc
+        keeps UTC or local time, OSError if it couldn't be set
+        """
+        mode = self.clock_mode()
+        if mode is None:
+            raise ValueError(
+                f"can't tell whether rtc {self.device} keeps UTC or local time"
+            )
+        if mode == "LOCAL":
+            # the offset at the time of waking up, it may be across a DST change
+            wake_at += int(
+                datetime.datetime.fromtimestamp(wake_at)
+                .astimezone()
+                .utcoffset()
+                .total_seconds()
+            )
+        path = self._rtc_path("wakealarm")
+        # an alarm that's already set has to be cleared before setting a new one
+        self.clear_alarm()
+        with open(path, "w") as file:
+            file.write(str(wake_at))
+        with open(path) as file:
+            read_back = file.read().strip()
+        if read_back != str(wake_at):
+            raise ValueError(
+                f"rtc {self.device} wake alarm reads '{read_back}' instead of '{wake_at}'"
+            )
+
+    def clear_alarm(self):
+        """
+        clears the rtc's wake alarm
+        :return: None
+        Raises an OSError if it couldn't be cleared
+        """
+        with open(self._rtc_path("wakealarm"), "w") as file:
+            file.write("0")
+
+    def suspend(self, decided_at: float):
+        """
+        suspends the computer to ram. returns after the computer resumes
+        :param decided_at: monotonic time at which it was decided to suspend, to measure the latency till suspending
+        :return: None
+        """
+        with open(os.path.join(self.root, "power", "state"), "w") as file:
+            self.entered_at = monotonic()
+            self.last_latency = self.entered_at - decided_at
+            file.write("mem")
+        self.resumed_at = monotonic()
+
+    def sleep_until(self, wake_at: int, decided_at: float):
+        """
+        sets the wake alarm & suspends the computer till `wake_at`
+        :param wake_at: unix timestamp
+        :param decided_at: monotonic time at which it was decided to suspend
+        :return: None
+        """
+        self.set_alarm(wake_at)
+        self.suspend(decided_at)
+        logger.info(
+            "Suspended %.1f ms after deciding to, using rtc %s",
+            self.last_latency * 1000,
+            self.device,
+        )
+
+
+RTC_DRIVER = RtcDriver()
+
+
 # noinspection PyShadowingNames
-def sleep_computer_but_wake_at(time: datetime.timedelta, debug: bool = False):
+def sleep_computer_but_wake_at(time, debug: bool = False):
     """
     sleeps the computer when func is executed and sets the wake timer till `time` seconds using rtcwake
     Assumes the time is greater than `now` time.
-    :param time: the datetime.timedelta object of the time you need the computer to wake up at
+    :param time: the datetime.timedelta object of the time (of the day) you need the computer to wake up at, or the
+                 datetime instant eg: from the phase timeline
     :return: None
     :param debug: true to debug and not make the computer sleep but just display the waketimer in stdout
     Raises a ValueError if time is less than current time
     """
+    decided_at = monotonic()
+    SPANS.since("changed", "decision", until=decided_at)
     # get the time in seconds left until wake time
-    time_to_wake_up = time - get_current_time_delta()
+    wake_at = to_instant(time)
+    time_to_wake_up = max(datetime.timedelta(seconds=0), wake_at - now_local())
+
+    # now we go schleep schleep
+    logger.info(
+        "Going schleep schleep, and will wake up at %s.",
+        wake_at.strftime("%d/%b/%Y %H:%M:%S"),
+    )
+    SUSPEND_TRACKER.sample(save=True)
+    flush_logs()
+    seconds = str(int(time_to_wake_up.total_seconds()))
+    suspended = False
+    if not debug and RTC_DRIVER.available:
+        try:
+            RTC_DRIVER.sleep_until(int(wake_at.timestamp()), decided_at)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not suspend through sysfs, using rtcwake: %s", e)
+        else:
+            suspended = True
+    if debug:
+        logger.info("DEBUG enabled, dry-running rtcwake")
+        output = subprocess.check_output(
+            ["sudo", "-s", "rtcwake", "-m", "on", "-s", seconds]
+        )
+        logger.debug(output.decode())
+    elif not suspended:
+        entered_at = monotonic()
+        output = subprocess.check_output(
+            ["sudo", "rtcwake", "-m", "mem", "-s", seconds]
+        )
+        resumed_at = monotonic()
+        logger.debug(output.decode())
+    if suspended:
+        entered_at, resumed_at = RTC_DRIVER.entered_at, RTC_DRIVER.resumed_at
+    if not debug:
+        METRICS.suspends += 1
+        # returning from the write or rtcwake doesn't mean the computer suspended, the clocks' gap growing does
+        if SUSPEND_TRACKER.sample(save=True):
+            METRICS.resumes += 1
+        else:
+            logger.warning("Came back without the computer having suspended")
+        # the monotonic clock stops while suspended, so this is the time spent getting into & out of suspend
+        SPANS.record("pre-suspend", entered_at - decided_at)
+        SPANS.record("suspend entry", resumed_at - entered_at)
+        SPANS.mark("resumed", resumed_at)
+    logger.info('"Good Mawrning!" [read that in Tim Cook way] I am awake now.')
+
+
+def suspend_thread_until(time):
+    """
+    suspends the current thread until the `time` time reaches, with a single timerfd wait. falls back to time.sleep()
+    (or rtcwake chunks of `sleep_interval`) if timerfd is not available. returns early if the config gets reloaded
+    If `time` is greater than current time, assumes that `time` happens on same day.
+    If `time` is lesser than current time, assumes that `time` happens on next day
+    :param time: the time (of the day, timedelta) or the datetime instant to wake the thread at
+    :return: None
+    """
+
+    config = CONFIG
+
+    def __sleep_or_rtc_wake(time_s: datetime.timedelta):
+        """based on `sleep_interval` decides if it should use rtcwake or python sleep"""
+        logger.debug(
+            "Sleeping the program until %s for duration %s...",
+            (datetime.datetime.now() + time_s).strftime("%d/%b/%Y %H:%M:%S"),
+            str(time_s),
+        )
+        seconds = int(time_s.total_seconds())
+        if seconds <= 0:
+            return
+
+        if (
+            bool(config.sleep_interval) is False
+        ):  # bool(x) because `0 is False` is false. TIL
+            sleep(seconds)
+        else:
+            output = subprocess.check_output(
+                ["sudo", "-s", "rtcwake", "-m", "on", "-s", str(seconds)]
+            )
+            logger.debug(output.decode())
+
+    SPANS.since("changed", "decision")
+    # convert timedelta to datetime. if time is less, then wakeup is tomorrow
+    time_to_wakeup = to_instant(time)
+
+    logger.info(
+        "Sleeping thread till: %s", time_to_wakeup.strftime("%d/%b/%Y %H:%M:%S")
+    )
+    # a single timerfd wait to the deadline. with sleep_interval, the timer has to wake the computer up like rtcwake did
+    waiter = get_timer_waiter(alarm=bool(config.sleep_interval))
+    # the sleep loop
+    _one_timedelta = datetime.timedelta(seconds=1)
+    while not REPLAN.is_set() and _one_timedelta < (
+        remaining_sleep_time := time_to_wakeup - now_local()
+    ):
+        if waiter is not None:
+            try:
+                if not waiter.wait_until(time_to_wakeup.timestamp(), REPLAN):
+                    logger.debug("System clock was changed, checking the time again")
+                continue
+            except OSError as e:
+                logger.warning("timerfd wait failed, falling back to polling: %s", e)
+                waiter = None
+        # if sleep interval is defined use that, else use logarithmic time inspired by jgillick/python-pause
+        if config.sleep_interval:
+            __sleep_or_rtc_wake(min(remaining_sleep_time, config.sleep_interval_delta))
+        else:
+            __sleep_or_rtc_wake(max(_one_timedelta, remaining_sleep_time / 2))
+
+    if REPLAN.is_set():
+        logger.debug("Config was reloaded, woke up early to re-plan")
+        return
+    logger.debug("exit")
+
+
+def sleep_or_suspend_until(time: int, mode: Literal["suspend", "sleep"]):
+    """
+    This function will take the time, and choice of the user to either: sleep the computer, or suspend the thread. aka
+    time.sleep() suspend.
+    The caller should then pause() for a few seconds to give the computer time to connect to the wifi.
+    :param time: the "duration" of seconds to wake the computer/thread after the "current" time
+    :param mode:
+        - 'suspend': will time.sleep() the thread.
+        - 'sleep': will make the computer go to sleep.
+    :return:
+    """
+    time = now_local() + datetime.timedelta(seconds=time)
+    if mode == "suspend":
+        suspend_thread_until(time)
+    elif mode == "sleep":
+        sleep_computer_but_wake_at(time, debug=DEBUG)
+    else:
+        logger.error(
+            "'%s' is not a valid argument for parameter 'mode'. 'mode' can either be 'sleep' or 'suspend'",
+            mode,
+        )
+
+
+"""
+                                                                                    
+    88           88               88                                   88               
+    88           ""               88                                   ""               
+    88                            88                                                    
+    88,dPPYba,   88   ,adPPYb,d8  88,dPPYba,   8b,dPPYba,  ,adPPYYba,  88  8b,dPPYba,   
+    88P'    "8a  88  a8"    `Y88  88P'    "8a  88P'   "Y8  ""     `Y8  88  88P'   `"8a  
+    88       d8  88  8b       88  88       d8  88          ,adPPPPP88  88  88       88  
+    88b,   ,a8"  88  "8a,   ,d88  88b,   ,a8"  88          88,    ,88  88  88       88  
+    8Y"Ybbd8"'   88   `"YbbdP"Y8  8Y"Ybbd8"'   88          `"8bbdP"Y8  88  88       88  
+                      aa,    ,88                                                        
+                       "Y8bbdP"                                                         
+                                                                                        
+                88                                    88                                            
+                88                                    ""                                            
+                88                                                                                  
+                88           ,adPPYba,    ,adPPYb,d8  88   ,adPPYba,                                
+                88          a8"     "8a  a8"    `Y88  88  a8"     ""                                
+                88          8b       d8  8b       88  88  8b                                        
+                88          "8a,   ,a8"  "8a,   ,d88  88  "8a,   ,aa                                
+                88888888888  `"YbbdP"'    `"YbbdP"Y8  88   `"Ybbd8"'                                
+                                          aa,    ,88                                                
+                                           "Y8bbdP"                                                 
+"""
+
+
+# fixed width probe record: timestamp, method, phase, result, probe duration, rtt (NaN if none), devices
+PROBE_RECORD = struct.Struct("<dBBBxff16s")
+PROBE_METHODS = ["v2", "v3", "v2+v3", "race"]
+PHASES = ["NEITHER", "NIGHT PHASE", "MORNING PHASE"]
+
+
+class RecordStore:
+    """
+    Compact store of fixed width records, appended to one file per day, so reading weeks of them back is just memory
+    mapping the files and unpacking. The first field of every record is the unix timestamp it was written at.
+    """
+
+    def __init__(self, directory: str, prefix: str, record: struct.Struct):
+        """
+        :param directory: where the daily files are kept
+        :param prefix: the daily files' name prefix
+        :param record: the records' layout
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.record = record
+        self._fd: Optional[int] = None
+        self._day: Optional[datetime.date] = None
+
+    def filename(self, day: datetime.date) -> str:
+        return os.path.join(
+            self.directory, f"{self.prefix}-{day.strftime('%Y%m%d')}.bin"
+        )
+
+    def write(self, *fields):
+        """
+        appends one record, timestamped now. each record is a single write() on an O_APPEND file
+        :param fields: the record's fields after the timestamp
+        """
+        now = datetime.datetime.now()
+        try:
+            if self._day != now.date():
+                if self._fd is not None:
+                    os.close(self._fd)
+                os.makedirs(self.directory, exist_ok=True)
+                self._fd = os.open(
+                    self.filename(now.date()),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o644,
+                )
+                self._day = now.date()
+            os.write(self._fd, self.record.pack(now.timestamp(), *fields))
+        except OSError as e:
+            logger.debug("Unable to write %s record: %s", self.prefix, e)
+
+    def records(
+        self, since: datetime.datetime, until: Optional[datetime.datetime] = None
+    ) -> Iterator[tuple]:
+        """
+        reads back the records in between `since` and `until`, oldest first
+        :return: iterator of raw record tuples
+        """
+        until = until or datetime.datetime.now()
+        since_ts, until_ts = since.timestamp(), until.timestamp()
+        day = since.date()
+        while day <= until.date():
+            try:
+                with open(self.filename(day), "rb") as file:
+                    size = os.fstat(file.fileno()).st_size
+                    usable = size - size % self.record.size
+                    if usable:
+                        import mmap
+
+                        with mmap.mmap(
+                            file.fileno(), 0, access=mmap.ACCESS_READ
+                        ) as mapped:
+                            view = memoryview(mapped)[:usable]
+                            try:
+                                for record in self.record.iter_unpack(view):
+                                    if since_ts <= record[0] <= until_ts:
+                                        yield record
+                            finally:
+                                view.release()
+            except FileNotFoundError:
+                pass
+            day += datetime.timedelta(days=1)
+
+
+class ProbeStore(RecordStore):
+    """
+    Compact store of every connectivity probe's outcome, as PROBE_RECORDs
+    """
+
+    def __init__(self, directory: str = "logs/probes"):
+        """
+        :param directory: where the daily files are kept
+        """
+        super().__init__(directory, "probes", PROBE_RECORD)
+
+    def append(
+        self,
+        method: str,
+        phase: str,
+        result: bool,
+        duration: float,
+        rtt: Optional[float],
+        devices: Tuple[str, ...],
+    ):
+        """
+        appends one probe's outcome
+        :param method: the connectivity method used
+        :param phase: the phase's name, one of PHASES
+        :param result: whether the probe found us connected
+        :param duration: seconds the probe took
+        :param rtt: round trip time to the gateway in seconds, if the method pings
+        :param devices: the devices found connected
+        """
+        self.write(
+            PROBE_METHODS.index(method),
+            PHASES.index(phase),
+            result,
+            duration,
+            math.nan if rtt is None else rtt,
+            ",".join(devices).encode()[:16],
+        )
+
+
+PROBE_STORE = ProbeStore()
+
+
+# the stages of going to sleep & waking up that get timed
+STAGES = [
+    "probe",
+    "decision",
+    "pre-suspend",
+    "suspend entry",
+    "resume",
+    "link up",
+    "first successful probe",
+    "notification sent",
+]
+# fixed width span record: timestamp, stage, seconds
+SPAN_RECORD = struct.Struct("<dBxxxf")
+
+
+class LatencyHistogram:
+    """
+    Histogram with log spaced buckets (from 100µs doubling up to ~14 minutes), so that recording a value is a bisect
+    and memory stays constant no matter how long the program runs.
+    """
+
+    BOUNDS = [0.0001 * 2**i for i in range(24)]
+
+    def __init__(self):
+        # the last bucket is for everything above the largest bound
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :param fraction: 0 to 1
+        :return: the upper bound of the bucket the percentile falls in, NaN if nothing was recorded
+        """
+        if not self.count:
+            return math.nan
+        rank = fraction * self.count
+        for bound, cumulative in zip(
+            self.BOUNDS + [math.inf], itertools.accumulate(self.counts)
+        ):
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class StageSpans:
+    """
+    Times the stages from deciding to sleep till being back online, on the monotonic clock. each stage has an in
+    memory histogram, and every span is also written to the stats store so the delays can be tuned from `stats`.
+    Stages that start in one place and end in another are timed from a named mark, eg: "resumed".
+    """
+
+    def __init__(self, store: Optional[RecordStore] = None):
+        """
+        :param store: where to write the spans, not written anywhere if None
+        """
+        self.store = store
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        # mark name -> (monotonic time, stages already timed from it)
+        self._marks: Dict[str, Tuple[float, set]] = {}
+
+    def record(self, stage: str, duration: float):
+        self.histograms[stage].observe(duration)
+        if self.store is not None:
+            self.store.write(STAGES.index(stage), duration)
+
+    def mark(self, name: str, at: Optional[float] = None):
+        """
+        :param name: the mark's name
+        :param at: monotonic time of the mark, now by default
+        """
+        self._marks[name] = (monotonic() if at is None else at, set())
+
+    def pending(self, name: str, stage: str) -> bool:
+        """:return: True if `stage` has not been timed since the mark `name` yet"""
+        return name in self._marks and stage not in self._marks[name][1]
+
+    def since(
+        self, name: str, stage: str, until: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        records `stage` as the time from the mark `name` till `until`, once per mark
+        :param name: the mark's name
+        :param stage: the stage to record
+        :param until: monotonic time the stage ended at, now by default
+        :return: the stage's duration, None if there's no such mark or the stage was already timed since it
+        """
+        if not self.pending(name, stage):
+            return None
+        start, timed = self._marks[name]
+        timed.add(stage)
+        duration = (monotonic() if until is None else until) - start
+        self.record(stage, duration)
+        return duration
+
+    def summary(self) -> Dict[str, Tuple[int, float, float, float]]:
+        """:return: stage -> (count, p50, p95, p99) in seconds, of the stages timed so far"""
+        return {
+            stage: (
+                histogram.count,
+                histogram.percentile(0.5),
+                histogram.percentile(0.95),
+                histogram.percentile(0.99),
+            )
+            for stage, histogram in self.histograms.items()
+            if histogram.count
+        }
+
+
+SPAN_STORE = RecordStore("logs/probes", "spans", SPAN_RECORD)
+SPANS = StageSpans(SPAN_STORE)
+
+
+class Metrics:
+    """
+    Counters & gauges for the metrics endpoint. they're updated in place where things happen (probes, phase changes,
+    suspends), so a scrape only formats them and never probes anything.
+    """
+
+    def __init__(self):
+        self.probes: Dict[Tuple[str, bool], int] = collections.defaultdict(int)
+        self.probe_durations: Dict[str, LatencyHistogram] = collections.defaultdict(
+            LatencyHistogram
+        )
+        self.phase = "NEITHER"
+        self.next_transition: Optional[Tuple[datetime.datetime, str]] = None
+        self.suspends = 0
+        self.resumes = 0
+        self.race_decisions: Dict[Tuple[str, bool], int] = collections.defaultdict(int)
+        # fleet coordinator only
+        self.fleet_agents = 0
+        self.wake_packets = 0
+        # the clock gap at start, the time spent suspended since is how much it grew by
+        self._start_gap = clock_gettime(CLOCK_BOOTTIME) - clock_gettime(CLOCK_MONOTONIC)
+
+    def probe(self, method: str, result: bool, duration: float):
+        self.probes[(method, result)] += 1
+        self.probe_durations[method].observe(duration)
+
+    def set_phase(self, phase: str, next_transition: Tuple[datetime.datetime, str]):
+        self.phase = phase
+        self.next_transition = next_transition
+
+    @staticmethod
+    def _histogram(name: str, labels: str, histogram: LatencyHistogram) -> List[str]:
+        lines = []
+        for bound, cumulative in zip(
+            LatencyHistogram.BOUNDS, itertools.accumulate(histogram.counts)
+        ):
+            lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return lines
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the prometheus text exposition format
+        """
+        # scrapes are served from other threads, while the probes add keys. iterate over copies
+        probes, probe_durations, race_decisions = (
+            dict(self.probes),
+            dict(self.probe_durations),
+            dict(self.race_decisions),
+        )
+        lines = [
+            "# HELP smart_sleep_probes_total Connectivity probes, by method & result",
+            "# TYPE smart_sleep_probes_total counter",
+        ]
+        for (method, result), count in sorted(probes.items()):
+            lines.append(
+                f'smart_sleep_probes_total{{method="{method}",result="{str(result).lower()}"}} {count}'
+            )
+        lines += [
+            "# HELP smart_sleep_probe_duration_seconds How long connectivity probes take",
+            "# TYPE smart_sleep_probe_duration_seconds histogram",
+        ]
+        for method, histogram in sorted(probe_durations.items()):
+            lines += self._histogram(
+                "smart_sleep_probe_duration_seconds", f'method="{method}"', histogram
+            )
+        if race_decisions:
+            lines += [
+                "# HELP smart_sleep_race_decisions_total Outcomes of the race method, by the signal that decided them",
+                "# TYPE smart_sleep_race_decisions_total counter",
+            ]
+            for (signal, result), count in sorted(race_decisions.items()):
+                lines.append(
+                    f'smart_sleep_race_decisions_total{{signal="{signal}",result="{str(result).lower()}"}} {count}'
+                )
+        lines += [
+            "# HELP smart_sleep_stage_duration_seconds How long each stage of sleeping & waking up takes",
+            "# TYPE smart_sleep_stage_duration_seconds histogram",
+        ]
+        for stage, histogram in SPANS.histograms.items():
+            if histogram.count:
+                lines += self._histogram(
+                    "smart_sleep_stage_duration_seconds", f'stage="{stage}"', histogram
+                )
+        lines += [
+            "# HELP smart_sleep_phase The phase the program is in",
+            "# TYPE smart_sleep_phase gauge",
+        ]
+        for phase in PHASES:
+            lines.append(
+                f'smart_sleep_phase{{phase="{phase}"}} {int(phase == self.phase)}'
+            )
+        if self.next_transition is not None:
+            instant, phase = self.next_transition
+            lines += [
+                "# HELP smart_sleep_next_transition_timestamp_seconds When the phase changes next",
+                "# TYPE smart_sleep_next_transition_timestamp_seconds gauge",
+                f'smart_sleep_next_transition_timestamp_seconds{{phase="{phase}"}} {instant.timestamp()}',
+            ]
+        suspended = max(
+            0.0,
+            clock_gettime(CLOCK_BOOTTIME)
+            - clock_gettime(CLOCK_MONOTONIC)
+            - self._start_gap,
+        )
+        lines += [
+            "# HELP smart_sleep_suspends_total Suspends the program started",
+            "# TYPE smart_sleep_suspends_total counter",
+            f"smart_sleep_suspends_total {self.suspends}",
+            "# HELP smart_sleep_resumes_total Resumes seen after the suspends the program started",
+            "# TYPE smart_sleep_resumes_total counter",
+            f"smart_sleep_resumes_total {self.resumes}",
+            "# HELP smart_sleep_suspends_detected_total Suspends detected from the kernel clocks, by anyone",
+            "# TYPE smart_sleep_suspends_detected_total counter",
+            f"smart_sleep_suspends_detected_total {SUSPEND_TRACKER.detected}",
+            "# HELP smart_sleep_suspended_seconds_total Time spent suspended since the program started",
+            "# TYPE smart_sleep_suspended_seconds_total counter",
+            f"smart_sleep_suspended_seconds_total {suspended:.3f}",
+            "# HELP smart_sleep_notifier_queue_depth Telegram alerts waiting to be delivered",
+            "# TYPE smart_sleep_notifier_queue_depth gauge",
+            f"smart_sleep_notifier_queue_depth {NOTIFIER.outbox.depth}",
+            "# HELP smart_sleep_notifications_sent_total Telegram alerts delivered",
+            "# TYPE smart_sleep_notifications_sent_total counter",
+            f"smart_sleep_notifications_sent_total {NOTIFIER.sent}",
+            "# HELP smart_sleep_notification_retries_total Failed telegram deliveries that were retried",
+            "# TYPE smart_sleep_notification_retries_total counter",
+            f"smart_sleep_notification_retries_total {NOTIFIER.retries}",
+            "# HELP smart_sleep_log_records_dropped_total Log records dropped because the log queue was full",
+            "# TYPE smart_sleep_log_records_dropped_total counter",
+            f"smart_sleep_log_records_dropped_total {log_queue_handler.dropped}",
+            "# HELP smart_sleep_fleet_agents Fleet agents connected to the coordinator",
+            "# TYPE smart_sleep_fleet_agents gauge",
+            f"smart_sleep_fleet_agents {self.fleet_agents}",
+            "# HELP smart_sleep_wake_packets_total Wake-on-LAN magic packets sent to fleet agents",
+            "# TYPE smart_sleep_wake_packets_total counter",
+            f"smart_sleep_wake_packets_total {self.wake_packets}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def serve_metrics(settings: dict) -> "socketserver.BaseServer":
+    """
+    starts the metrics endpoint in a background thread. http.server is only imported here, when metrics are enabled
+    :param settings: the `metrics` config. either `socket` (path of a unix socket), or `port` (& optionally `host`,
+                     localhost by default)
+    :return: the server
+    """
+    import http.server
+    import socketserver
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        """Serves METRICS on GET /metrics"""
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args):
+            # the client address is empty on a unix socket, so the default implementation can't be used
+            logger.debug("metrics endpoint: " + format, *args)
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            # BaseHTTPRequestHandler expects a (host, port) client address
+            return request, ("unix", 0)
+
+    if "socket" in settings:
+        try:
+            os.unlink(settings["socket"])
+        except FileNotFoundError:
+            pass
+        server = UnixHTTPServer(settings["socket"], MetricsRequestHandler)
+        address = settings["socket"]
+    else:
+        server = http.server.ThreadingHTTPServer(
+            (settings.get("host", "127.0.0.1"), settings["port"]),
+            MetricsRequestHandler,
+        )
+        address = "http://{}:{}/metrics".format(*server.server_address[:2])
+    # the queue depth gauge reads the outbox's depth, which is only loaded when the outbox is opened
+    NOTIFIER.outbox.open()
+    threading.Thread(
+        target=server.serve_forever, name="metrics endpoint", daemon=True
+    ).start()
+    logger.info("Serving metrics at %s", address)
+    return server
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    :param sorted_values: the values, sorted
+    :param fraction: 0 to 1
+    :return: the nearest rank percentile, NaN if there are no values
+    """
+    if not sorted_values:
+        return math.nan
+    return sorted_values[
+        min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    ]
+
+
+def print_stats(days: int = 30, max_gap: float = 3600):
+    """
+    prints the uptime, outage windows, probe & stage latencies of the last `days` days from the stats store
+    :param days: how many days to look back
+    :param max_gap: probes further apart than these many seconds are not counted towards uptime (we were asleep)
+    :return: None
+    """
+    since = datetime.datetime.combine(
+        datetime.date.today() - datetime.timedelta(days=days - 1), datetime.time.min
+    )
+    up: Dict[datetime.date, float] = collections.defaultdict(float)
+    observed: Dict[datetime.date, float] = collections.defaultdict(float)
+    outages: List[Tuple[float, float]] = []
+    durations: Dict[int, List[float]] = collections.defaultdict(list)
+    rtts: Dict[int, List[float]] = collections.defaultdict(list)
+    previous = None
+    outage_start = None
+    count = 0
+    for timestamp, method, _, result, duration, rtt, _ in PROBE_STORE.records(since):
+        count += 1
+        durations[method].append(duration)
+        if not math.isnan(rtt):
+            rtts[method].append(rtt)
+        if previous is not None and timestamp - previous[0] <= max_gap:
+            day = datetime.date.fromtimestamp(previous[0])
+            observed[day] += timestamp - previous[0]
+            if previous[1]:
+                up[day] += timestamp - previous[0]
+        if not result and outage_start is None:
+            outage_start = timestamp
+        elif result and outage_start is not None:
+            outages.append((outage_start, timestamp))
+            outage_start = None
+        previous = (timestamp, result)
+    if outage_start is not None:
+        outages.append((outage_start, math.nan))
+
+    print(f"{count} probes in the last {days} days\n")
+    print("Uptime (while awake & probing):")
+    for day in sorted(observed):
+        print(f"  {day.strftime('%a %d/%b/%Y')}  {100 * up[day] / observed[day]:6.2f}%")
+
+    print("\nOutage windows (first failed probe -> first successful probe):")
+    for start, end in outages:
+        start_time = datetime.datetime.fromtimestamp(start)
+        if math.isnan(end):
+            print(f"  {start_time.strftime('%a %d/%b/%Y %H:%M:%S')} -> ongoing")
+        else:
+            print(
+                f"  {start_time.strftime('%a %d/%b/%Y %H:%M:%S')} -> "
+                f"{datetime.datetime.fromtimestamp(end).strftime('%H:%M:%S')} "
+                f"({datetime.timedelta(seconds=round(end - start))})"
+            )
+
+    print("\nProbe latency (ms):")
+    print(
+        f"  {'method':<8}{'p50':>10}{'p95':>10}{'p99':>10}{'rtt p50':>10}{'rtt p95':>10}"
+    )
+    for method in sorted(durations):
+        values, rtt_values = sorted(durations[method]), sorted(rtts[method])
+        print(
+            f"  {PROBE_METHODS[method]:<8}"
+            + "".join(
+                f"{1000 * percentile(values, fraction):>10.2f}"
+                for fraction in [0.5, 0.95, 0.99]
+            )
+            + "".join(
+                f"{1000 * percentile(rtt_values, fraction):>10.2f}"
+                for fraction in [0.5, 0.95]
+            )
+        )
+
+    spans: Dict[int, List[float]] = collections.defaultdict(list)
+    for _, stage, duration in SPAN_STORE.records(since):
+        spans[stage].append(duration)
+    if spans:
+        print("\nSleep & wake up stage latency (ms):")
+        print(f"  {'stage':<24}{'count':>7}{'p50':>11}{'p95':>11}{'p99':>11}")
+        for stage in sorted(spans):
+            values = sorted(spans[stage])
+            print(
+                f"  {STAGES[stage]:<24}{len(values):>7}"
+                + "".join(
+                    f"{1000 * percentile(values, fraction):>11.1f}"
+                    for fraction in [0.5, 0.95, 0.99]
+                )
+            )
+
+
+class AdaptiveProbeScheduler:
+    """
+    Learns at what times of the day the connectivity usually changes, per phase & weekday, from the probe store.
+    Probes densely around those times and sparsely everywhere else: the interval at any time goes from `min_interval`
+    at the most likely transition time, to `max_interval` where no transition has ever happened.
+    """
+
+    def __init__(
+        self,
+        store: ProbeStore,
+        min_interval: float,
+        max_interval: float,
+        history_days: int = 28,
+        min_suspend: float = 60,
+        bandwidth: float = 600,
+        max_gap: float = 3600,
+    ):
+        """
+        :param store: the probe store to learn from
+        :param min_interval: seconds in between probes around likely transitions
+        :param max_interval: seconds in between probes when no transition is expected
+        :param history_days: how many days of history to learn from
+        :param min_suspend: seconds in between probes at least, when the computer is suspended in between them. every
+                            probe costs a suspend & resume cycle then. never more than `max_interval`
+        :param bandwidth: seconds, how far the influence of a past transition spreads
+        :param max_gap: probes further apart than these many seconds don't make a transition (we were asleep)
+        """
+        self.store = store
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.history_days = history_days
+        self.min_suspend = min(max(min_suspend, min_interval), max_interval)
+        self.bandwidth = bandwidth
+        self.max_gap = max_gap
+        self._transitions: Dict[Tuple[int, int], List[float]] = {}
+        self._peaks: Dict[Tuple[str, int], float] = {}
+        self._learnt_on: Optional[datetime.date] = None
+
+    def _learn(self):
+        """(re)learns the transition times from the store, once a day"""
+        today = datetime.date.today()
+        if self._learnt_on == today:
+            return
+        transitions: Dict[Tuple[int, int], List[float]] = collections.defaultdict(list)
+        since = datetime.datetime.combine(
+            today - datetime.timedelta(days=self.history_days), datetime.time.min
+        )
+        previous = None
+        for timestamp, _, phase, result, _, _, _ in self.store.records(since):
+            if (
+                previous is not None
+                and previous[1] == phase
+                and previous[2] != result
+                and timestamp - previous[0] <= self.max_gap
+            ):
+                when = datetime.datetime.fromtimestamp(timestamp)
+                transitions[(phase, when.weekday())].append(
+                    when.hour * 3600 + when.minute * 60 + when.second
+                )
+            previous = (timestamp, phase, result)
+        self._transitions = transitions
+        self._peaks = {}
+        self._learnt_on = today
+        logger.debug(
+            "Learnt %d connectivity transitions from the last %d days",
+            sum(map(len, transitions.values())),
+            self.history_days,
+        )
+
+    def transitions(self, phase: str, weekday: int) -> List[float]:
+        """
+        :param phase: the phase's name
+        :param weekday: 0 is monday
+        :return: the learnt transition times (seconds since midnight). falls back to every weekday's transitions when
+                 the weekday has too few of them
+        """
+        self._learn()
+        phase_index = PHASES.index(phase)
+        times = self._transitions.get((phase_index, weekday), [])
+        if len(times) < 3:
+            times = [
+                t
+                for (_phase, _), _times in self._transitions.items()
+                if _phase == phase_index
+                for t in _times
+            ]
+        return times
+
+    def _density(self, times: List[float], seconds: float) -> float:
+        """gaussian kernel density at `seconds` since midnight, wrapping around midnight"""
+        total = 0.0
+        for t in times:
+            distance = abs(seconds - t) % 86400
+            distance = min(distance, 86400 - distance)
+            total += math.exp(-0.5 * (distance / self.bandwidth) ** 2)
+        return total
+
+    def interval(self, phase: str, when: datetime.datetime) -> Optional[float]:
+        """
+        :param phase: the phase's name
+        :param when: the time to get the interval at
+        :return: seconds to wait before the next probe, None if there's no history to go by
+        """
+        times = self.transitions(phase, when.weekday())
+        if not times:
+            return None
+        # the peak only changes when the transitions are relearnt, and it's quadratic in them
+        key = (phase, when.weekday())
+        if key not in self._peaks:
+            self._peaks[key] = max(self._density(times, t) for t in times)
+        peak = self._peaks[key]
+        seconds = when.hour * 3600 + when.minute * 60 + when.second
+        # in between two close transitions the density can exceed its value at either of them
+        likeliness = min(1.0, self._density(times, seconds) / peak)
+        return self.max_interval - (self.max_interval - self.min_interval) * likeliness
+
+    def summary(
+        self, phase: "Phase", weekday: int, fixed_timeout: float
+    ) -> Dict[str, float]:
+        """
+        what the adaptive schedule achieves over a whole phase, compared to probing every `fixed_timeout` seconds
+        :param phase: the compiled phase
+        :param weekday: 0 is monday
+        :param fixed_timeout: the phase's fixed timeout
+        :return: wakeups per phase & expected detection latency (half the interval at the past transitions) for both
+        """
+        times = self.transitions(phase.name, weekday)
+        length = (phase.end_time - phase.start_time).total_seconds() % 86400
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+        start += phase.start_time
+        start += datetime.timedelta(days=(weekday - start.weekday()) % 7)
+        wakeups, elapsed = 0, 0.0
+        while elapsed < length:
+            wakeups += 1
+            elapsed += (
+                self.interval(phase.name, start + datetime.timedelta(seconds=elapsed))
+                or fixed_timeout
+            )
+        latencies = [
+            (
+                self.interval(
+                    phase.name,
+                    start.replace(hour=0, minute=0, second=0)
+                    + datetime.timedelta(seconds=t),
+                )
+                or fixed_timeout
+            )
+            / 2
+            for t in times
+        ]
+        return {
+            "adaptive wakeups": wakeups,
+            "adaptive latency": (
+                sum(latencies) / len(latencies) if latencies else fixed_timeout / 2
+            ),
+            "fixed wakeups": math.ceil(length / fixed_timeout),
+            "fixed latency": fixed_timeout / 2,
+        }
+
+
+def print_schedule():
+    """
+    prints what the adaptive schedule achieves for each phase & weekday, against the fixed timeouts
+    :return: None
+    """
+    scheduler = CONFIG.adaptive_scheduler
+    if scheduler is None:
+        print("`adaptive_timeout` is not enabled in the config")
+        return
+    print(
+        f"  {'phase':<15}{'day':<6}{'wakeups':>9}{'fixed':>8}"
+        f"{'latency s':>11}{'fixed':>8}"
+    )
+    for phase in CONFIG.phases:
+        for weekday in range(7):
+            summary = scheduler.summary(phase, weekday, phase.timeout)
+            print(
+                f"  {phase.name:<15}{calendar.day_abbr[weekday]:<6}"
+                f"{summary['adaptive wakeups']:>9}{summary['fixed wakeups']:>8}"
+                f"{summary['adaptive latency']:>11.1f}{summary['fixed latency']:>8.1f}"
+            )
+
+
+class WakePlanner:
+    """
+    Picks when to wake the computer up next in the morning phase. Instead of waking up every morning phase->timeout
+    seconds, it learns the times the router came back on in the past mornings and wakes up at the next quantile of
+    those times that's still ahead of us. so on most mornings, the computer resumes once or twice instead of a dozen
+    times.
+    """
+
+    def __init__(
+        self,
+        store: ProbeStore,
+        step: float = 0.25,
+        margin: float = 30,
+        history_days: int = 28,
+        min_interval: float = 60,
+    ):
+        """
+        :param store: the probe store to learn from
+        :param step: which quantile of the router-up times still ahead of us to wake up at (0 to 1). lower means more
+                     wakeups but being awake sooner after the router comes up
+        :param margin: seconds to wake up after the planned router-up time, to give it time to hand out addresses
+        :param history_days: how many days of history to learn from
+        :param min_interval: never plan a wakeup sooner than these many seconds
+        """
+        self.store = store
+        self.step = step
+        self.margin = margin
+        self.history_days = history_days
+        self.min_interval = min_interval
+        self._router_up: Dict[datetime.timedelta, List[float]] = {}
+        self._learnt_on: Optional[datetime.date] = None
+
+    def router_up_times(self, start_time: datetime.timedelta) -> List[float]:
+        """
+        learns the time the router came back up on each past morning, from the first connected probe after a
+        disconnected one. relearnt once a day.
+        :param start_time: the morning phase's start time
+        :return: sorted seconds after `start_time` at which the router came up
+        """
+        today = datetime.date.today()
+        if self._learnt_on == today and start_time in self._router_up:
+            return self._router_up[start_time]
+        if self._learnt_on != today:
+            self._router_up = {}
+            self._learnt_on = today
+        since = datetime.datetime.combine(
+            today - datetime.timedelta(days=self.history_days), datetime.time.min
+        )
+        morning = PHASES.index(CONFIG.morning.name)
+        mornings: Dict[datetime.date, float] = {}
+        was_down = {}
+        for timestamp, _, phase, result, _, _, _ in self.store.records(since):
+            if phase != morning:
+                continue
+            # the day the morning phase started on, so phases crossing midnight count as one morning
+            started = datetime.datetime.fromtimestamp(timestamp) - start_time
+            day = started.date()
+            if day in mornings:
+                continue
+            if not result:
+                was_down[day] = True
+            elif was_down.get(day):
+                mornings[day] = (
+                    started - datetime.datetime.combine(day, datetime.time.min)
+                ).total_seconds()
+        self._router_up[start_time] = sorted(mornings.values())
+        return self._router_up[start_time]
+
+    def _plan(self, router_up: List[float], offset: float) -> Optional[float]:
+        """
+        :param router_up: sorted router-up times, seconds after the phase's start
+        :param offset: seconds after the phase's start right now
+        :return: seconds from now to wake up at, None if the router has never come up this late
+        """
+        ahead = router_up[bisect.bisect_right(router_up, offset) :]
+        if not ahead:
+            return None
+        target = ahead[max(0, math.ceil(self.step * len(ahead)) - 1)] + self.margin
+        return max(self.min_interval, target - offset)
+
+    def next_wake(self, now: datetime.datetime, time_left: float) -> Optional[float]:
+        """
+        :param now: the time the router was found to be down at
+        :param time_left: seconds left in the phase, the wakeup is never planned after it
+        :return: seconds to sleep for, None if there's no history to go by
+        """
+        start_time = CONFIG.morning.start_time
+        offset = (
+            now - datetime.datetime.combine(now.date(), datetime.time.min) - start_time
+        ).total_seconds() % 86400
+        interval = self._plan(self.router_up_times(start_time), offset)
+        return None if interval is None else min(interval, time_left)
+
+    def compare(self, fixed_timeout: float) -> Dict[str, float]:
+        """
+        replays every recorded morning with both the planned & the fixed step schedules. each morning is planned
+        without knowing its own router-up time (leave one out)
+        :param fixed_timeout: the morning phase's timeout
+        :return: mornings replayed, mean resume cycles & mean seconds from router-up to the computer being awake
+        """
+        morning = CONFIG.morning
+        router_up = self.router_up_times(morning.start_time)
+        length = (morning.end_time - morning.start_time).total_seconds() % 86400
+        result = {
+            "mornings": len(router_up),
+            "fixed cycles": 0.0,
+            "fixed time to awake": 0.0,
+            "planned cycles": 0.0,
+            "planned time to awake": 0.0,
+        }
+        if not router_up:
+            return result
+        for i, up in enumerate(router_up):
+            others = router_up[:i] + router_up[i + 1 :]
+            for name, plan in [
+                ("fixed", lambda offset: fixed_timeout),
+                ("planned", lambda offset: self._plan(others, offset) or fixed_timeout),
+            ]:
+                offset, cycles = 0.0, 0
+                while offset < up and offset < length:
+                    offset += min(plan(offset), length - offset)
+                    cycles += 1
+                result[f"{name} cycles"] += cycles / len(router_up)
+                result[f"{name} time to awake"] += max(0.0, offset - up) / len(
+                    router_up
+                )
+        return result
+
+
+def print_wake_plan():
+    """
+    prints how the planned morning wakeups compare against waking up every morning phase->timeout seconds
+    :return: None
+    """
+    planner = CONFIG.wake_planner or WakePlanner(PROBE_STORE)
+    comparison = planner.compare(CONFIG.morning.timeout)
+    if not comparison["mornings"]:
+        print("  no mornings with the router coming back up were recorded yet")
+        return
+    print(f"  replayed {comparison['mornings']} mornings")
+    print(f"  {'schedule':<12}{'resume cycles':>15}{'time to awake':>15}")
+    for name in ["fixed", "planned"]:
+        print(
+            f"  {name:<12}{comparison[name + ' cycles']:>15.1f}"
+            f"{str(datetime.timedelta(seconds=round(comparison[name + ' time to awake']))):>15}"
+        )
+
+
+FLEET_ROLES = ["coordinator", "agent"]
+
+
+def parse_mac(mac: str) -> bytes:
+    """
+    :param mac: a MAC address, eg: aa:bb:cc:dd:ee:ff or aa-bb-cc-dd-ee-ff
+    :return: the 6 bytes of the address
+    Raises ValueError if it isn't a MAC address
+    """
+    try:
+        address = bytes.fromhex(str(mac).replace(":", "").replace("-", ""))
+    except ValueError:
+        address = b""
+    if len(address) != 6:
+        raise ValueError(f"not a MAC address: {mac}")
+    return address
+
+
+def send_magic_packet(
+    mac: str, broadcast: str = "255.255.255.255", port: int = 9, count: int = 3
+):
+    """
+    wakes a computer up with a Wake-on-LAN magic packet: 6 bytes of 0xff followed by its MAC address 16 times, over UDP
+    :param mac: the MAC address of the computer's network card
+    :param broadcast: the broadcast address of the computer's network
+    :param port: the UDP port, 9 (discard) by convention
+    :param count: how many times to send the packet, UDP may drop one
+    Raises OSError if it can't be sent
+    """
+    packet = b"\xff" * 6 + parse_mac(mac) * 16
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for _ in range(count):
+            sock.sendto(packet, (broadcast, port))
+            METRICS.wake_packets += 1
+
+
+def local_networks() -> list:
+    """
+    :return: the ipv4 networks of this computer's cards, as ipaddress.IPv4Network
+    """
+    import ipaddress
+    import netifaces
+
+    networks = []
+    for card in netifaces.interfaces():
+        for entry in netifaces.ifaddresses(card).get(netifaces.AF_INET, []):
+            try:
+                networks.append(
+                    ipaddress.IPv4Network(
+                        f"{entry['addr']}/{entry['netmask']}", strict=False
+                    )
+                )
+            except (KeyError, ValueError):
+                continue
+    return networks
+
+
+def is_local_broadcast(address: str, networks: Optional[list] = None) -> bool:
+    """
+    :param address: where a magic packet would be sent
+    :param networks: the networks from local_networks(), looked up if not given
+    :return: True if it's the limited broadcast address, or an address on one of the networks of this computer's cards
+    """
+    import ipaddress
+
+    try:
+        address = ipaddress.IPv4Address(address)
+    except ValueError:
+        return False
+    if address == ipaddress.IPv4Address("255.255.255.255"):
+        return True
+    if networks is None:
+        networks = local_networks()
+    return any(address in network for network in networks)
+
+
+def own_mac_address() -> Optional[str]:
+    """
+    :return: the MAC address of the first wired card, or of the first wireless card if there's no wired one
+    """
+    try:
+        cards = SYSFS_NET.list_devices()
+    except OSError:
+        return None
+    for kind in "ew":
+        for card in cards:
+            address = SYSFS_NET.read(card, "address") if card[0] == kind else None
+            if address and address != "00:00:00:00:00:00":
+                return address
+    return None
+
+
+async def fleet_send(writer: "asyncio.StreamWriter", message: dict):
+    """sends a message of the fleet protocol: one JSON object per line"""
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+
+class FleetCoordinator:
+    """
+    Runs the phase logic once for a fleet of servers behind the same router. Agents connect to the coordinator and are
+    pushed every sleep & wake decision, one JSON object per line:
+        {"type": "sleep", "until": <unix time>}: suspend, with a wake timer at `until` in case no magic packet comes
+        {"type": "awake"}: the internet is up, stay awake
+    An agent says {"type": "hello", "name": ..., "mac": ..., "broadcast": ..., "port": ...} when it connects, and
+    {"type": "sleeping", "until": <unix time>} before disconnecting to suspend. The last decision is sent again to every
+    agent that connects.
+    When the internet comes back, the agents that aren't connected are woken up with Wake-on-LAN. Agents are remembered
+    in `state_file`, so they can be woken up even if the coordinator restarted while they were asleep.
+    With a `secret` in the settings, a hello has to carry the same "secret", or the agent is turned away. Magic packets
+    are only sent to broadcast addresses of the coordinator's own networks, at most `max agents` agents are remembered
+    and the ones that haven't connected for `forget_after` days are forgotten.
+    """
+
+    def __init__(
+        self,
+        settings: dict,
+        state_file: str = "logs/fleet_agents.json",
+        wake_retries: int = 3,
+        wake_retry_interval: float = 60,
+        forget_after: float = 30,
+    ):
+        """
+        :param settings: the `fleet` config. either `socket` (path of a unix socket), or `port` (& optionally `host`,
+                         every interface by default). `secret` & `max agents` (64 by default) are optional
+        :param state_file: where to remember the agents
+        :param wake_retries: how many more times to send magic packets to agents that don't come back
+        :param wake_retry_interval: seconds to wait for agents to come back before sending them magic packets again
+        :param forget_after: days after which an agent that didn't connect is forgotten
+        """
+        self.settings = settings
+        self.state_file = state_file
+        self.wake_retries = wake_retries
+        self.wake_retry_interval = wake_retry_interval
+        self.forget_after = forget_after
+        self.max_agents = settings.get("max agents", 64)
+        # name -> {"mac", "broadcast", "port", "seen"} of the agents that connected lately
+        try:
+            with open(state_file) as file:
+                self.agents: Dict[str, dict] = json.load(file)
+        except (OSError, ValueError):
+            self.agents = {}
+        # agents remembered before they were stamped count as seen now
+        for agent in self.agents.values():
+            if isinstance(agent, dict):
+                agent.setdefault("seen", round(datetime.datetime.now().timestamp()))
+        self._forget_stale()
+        self._saved_at = monotonic()
+        self._networks: list = []
+        self._networks_at = -math.inf
+        # name -> connection of the agents that are connected, ie: awake
+        self.connections: Dict[str, "asyncio.StreamWriter"] = {}
+        self.decision: dict = {"type": "awake"}
+        self.server: Optional["asyncio.AbstractServer"] = None
+        self._waking: Optional["asyncio.Task"] = None
+        # the tasks talking to the connected agents
+        self._handlers: set = set()
+
+    async def start(self):
+        import asyncio
+
+        if "socket" in self.settings:
+            try:
+                os.unlink(self.settings["socket"])
+            except FileNotFoundError:
+                pass
+            self.server = await asyncio.start_unix_server(
+                self._serve, self.settings["socket"], backlog=socket.SOMAXCONN
+            )
+            address = self.settings["socket"]
+        else:
+            # a whole fleet connects at once when it wakes up, more than the default backlog of 100 would refuse some
+            self.server = await asyncio.start_server(
+                self._serve,
+                self.settings.get("host", "0.0.0.0"),
+                self.settings["port"],
+                backlog=socket.SOMAXCONN,
+            )
+            address = "{}:{}".format(*self.server.sockets[0].getsockname()[:2])
+        logger.info(
+            "Fleet coordinator listening at %s, %d agents known",
+            address,
+            len(self.agents),
+        )
+
+    async def close(self):
+        import asyncio
+
+        if self._waking is not None:
+            self._waking.cancel()
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.connections.values()):
+            writer.close()
+        # the agents' connections end once closed, let their tasks finish instead of cancelling them
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def _forget_stale(self) -> bool:
+        """
+        forgets the agents that haven't connected for `forget_after` days
+        :return: True if any agent was forgotten
+        """
+        oldest = datetime.datetime.now().timestamp() - self.forget_after * 86400
+        stale = [
+            name
+            for name, agent in self.agents.items()
+            if not isinstance(agent, dict) or agent.get("seen", 0) < oldest
+        ]
+        for name in stale:
+            logger.info("Forgetting agent %s, it hasn't connected for a while", name)
+            del self.agents[name]
+        return bool(stale)
+
+    def _save(self):
+        self._saved_at = monotonic()
+        try:
+            with open(self.state_file, "w") as file:
+                file.write(json.dumps(self.agents))
+        except OSError as e:
+            logger.debug("Unable to save the fleet agents: %s", e)
+
+    def _register(self, name: str, hello: dict) -> bool:
+        """
+        remembers an agent that said hello
+        :return: False if it was turned away, because `max agents` agents are already known
+        """
+        if name not in self.agents and len(self.agents) >= self.max_agents:
+            self._forget_stale()
+            if len(self.agents) >= self.max_agents:
+                logger.warning(
+                    "Turned agent %s away, %d agents are known already",
+                    name,
+                    len(self.agents),
+                )
+                return False
+        agent = {
+            key: hello[key]
+            for key in ["mac", "broadcast", "port"]
+            if hello.get(key) is not None
+        }
+        if "mac" in agent:
+            try:
+                parse_mac(agent["mac"])
+            except ValueError as e:
+                logger.warning("Agent %s can't be woken up: %s", name, e)
+                del agent["mac"]
+        else:
+            logger.warning("Agent %s sent no MAC address, it can't be woken up", name)
+        if monotonic() - self._networks_at > 60:
+            # a whole fleet says hello at once, the networks hardly change in between
+            self._networks, self._networks_at = local_networks(), monotonic()
+        if "broadcast" in agent and not is_local_broadcast(
+            agent["broadcast"], self._networks
+        ):
+            logger.warning(
+                "Agent %s asked to be woken up at %s, which isn't on a network of ours. using 255.255.255.255",
+                name,
+                agent["broadcast"],
+            )
+            del agent["broadcast"]
+        if "port" in agent and not (
+            isinstance(agent["port"], int) and 0 < agent["port"] < 65536
+        ):
+            logger.warning("Agent %s sent a bad wake port: %r", name, agent["port"])
+            del agent["port"]
+        agent["seen"] = round(datetime.datetime.now().timestamp())
+        previous = self.agents.get(name)
+        self.agents[name] = agent
+        # a whole fleet says hello at once, the `seen` stamps alone are only saved once an hour
+        if (
+            previous is None
+            or {**previous, "seen": agent["seen"]} != agent
+            or monotonic() - self._saved_at > 3600
+        ):
+            self._save()
+        return True
+
+    async def _serve(
+        self, reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"
+    ):
+        """talks to a connected agent, till it disconnects"""
+        import asyncio
+        import hmac
+
+        name = None
+        self._handlers.add(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                try:
+                    message = json.loads(line)
+                    kind = message["type"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignored a malformed fleet message: %r", line[:200])
+                    continue
+                if kind == "hello":
+                    secret = self.settings.get("secret")
+                    if secret and not hmac.compare_digest(
+                        str(message.get("secret", "")).encode(), secret.encode()
+                    ):
+                        logger.warning("Turned away a fleet agent with a wrong secret")
+                        break
+                    if not isinstance(message.get("name"), str) or not message["name"]:
+                        logger.warning("Turned away a fleet agent without a name")
+                        break
+                    if not self._register(message["name"], message):
+                        break
+                    name = message["name"]
+                    self.connections[name] = writer
+                    METRICS.fleet_agents = len(self.connections)
+                    logger.info("Agent %s connected", name)
+                    await fleet_send(writer, self.decision)
+                elif kind == "sleeping":
+                    logger.info("Agent %s is going to sleep", name)
+        except (OSError, ValueError) as e:
+            logger.debug("Lost the connection to agent %s: %s", name, e)
+        finally:
+            if name is not None and self.connections.get(name) is writer:
+                del self.connections[name]
+                METRICS.fleet_agents = len(self.connections)
+                logger.info("Agent %s disconnected", name)
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
 
-    # # check if time isn't negative
-    # if time_to_wake_up.total_seconds() <= 0:
-    if time_to_wake_up < datetime.timedelta(seconds=0):
-        time_to_wake_up += datetime.timedelta(hours=24)
+    async def _push(self, decision: dict):
+        """sends the decision to every connected agent, all at once"""
+        import asyncio
 
-    # now we go schleep schleep
-    logger.info("Going schleep schleep, and will wake up at %s.", repr_time_delta(time))
-    if not debug:
-        output = subprocess.check_output(
-            ["sudo", "rtcwake", "-m", "mem", "-s", str(time_to_wake_up.seconds)]
+        self.decision = decision
+        connections = list(self.connections.items())
+        results = await asyncio.gather(
+            *(fleet_send(writer, decision) for _, writer in connections),
+            return_exceptions=True,
         )
-    else:
-        logger.info("DEBUG enabled, dry-running rtcwake")
-        output = subprocess.check_output(
-            ["sudo", "-s", "rtcwake", "-m", "on", "-s", str(time_to_wake_up.seconds)]
+        for (name, _), result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.warning("Unable to reach agent %s: %s", name, result)
+
+    async def sleep(self, until: datetime.datetime):
+        """
+        tells the agents to go to sleep
+        :param until: the instant the agents should wake up at by themselves, if no magic packet wakes them up before
+        """
+        if self._waking is not None:
+            self._waking.cancel()
+        logger.info(
+            "Telling %d agents to sleep until %s at the latest",
+            len(self.connections),
+            until.strftime("%d/%b/%Y %H:%M:%S"),
         )
-    logger.debug(output.decode())
-    sleep(2)
-    logger.info('"Good Mawrning!" [read that in Tim Cook way] I am awake now.')
+        await self._push({"type": "sleep", "until": until.timestamp()})
+
+    async def wake(self):
+        """
+        tells the connected agents to stay awake, and wakes up the sleeping ones with Wake-on-LAN. the magic packets
+        are sent again in the background to the agents that don't come back
+        """
+        import asyncio
+
+        await self._push({"type": "awake"})
+        if self._waking is not None:
+            self._waking.cancel()
+        self._waking = asyncio.get_running_loop().create_task(self._wake_sleeping())
+
+    async def _wake_sleeping(self):
+        import asyncio
+
+        for attempt in range(self.wake_retries + 1):
+            asleep = [name for name in self.agents if name not in self.connections]
+            if not asleep:
+                return
+            if attempt:
+                logger.info(
+                    "%d agents haven't come back yet, sending them magic packets again",
+                    len(asleep),
+                )
+            for name in asleep:
+                agent = self.agents[name]
+                if "mac" not in agent:
+                    continue
+                try:
+                    send_magic_packet(
+                        agent["mac"],
+                        agent.get("broadcast", "255.255.255.255"),
+                        agent.get("port", 9),
+                    )
+                except OSError as e:
+                    logger.warning("Unable to wake up agent %s: %s", name, e)
+                else:
+                    logger.debug("Sent agent %s a magic packet", name)
+            await asyncio.sleep(self.wake_retry_interval)
 
 
-def suspend_thread_until(time: datetime.timedelta):
+class FleetAgent:
     """
-    suspends the current thread until the `time` time reaches using time.sleep()
-    If `time` is greater than current time, assumes that `time` happens on same day.
-    If `time` is lesser than current time, assumes that `time` happens on next day
-    :param time: the time to wake the thread
-    :return: None
+    Does what a fleet coordinator decides instead of probing & following the phases itself. It stays connected to the
+    coordinator while awake, suspends when told to (with a wake timer, in case no magic packet comes), and connects
+    again after waking up.
     """
 
-    def __sleep_or_rtc_wake(time_s: datetime.timedelta):
-        """based on SLEEP_INTERVAL decides if it should use rtcwake or python sleep"""
-        logger.debug(
-            "Sleeping the program until %s for duration %s...",
-            (datetime.datetime.now() + time_s).strftime("%d/%b/%Y %H:%M:%S"),
-            str(time_s),
-        )
-        if time_s.seconds <= 0:
-            return
+    def __init__(self, settings: dict, suspend: Optional[Callable] = None):
+        """
+        :param settings: the `fleet` config. either `socket` (path of the coordinator's unix socket), or `host` &
+                         `port` of the coordinator. `name`, `mac`, `broadcast` & `wake port` are optional
+        :param suspend: called with the instant to wake up at, returns once awake. sleep_computer_but_wake_at() by
+                        default
+        """
+        self.settings = settings
+        self.suspend = suspend or sleep_computer_but_wake_at
+        self.name = str(settings.get("name") or socket.gethostname())
+        self.mac = settings.get("mac") or own_mac_address()
 
-        if bool(SLEEP_INTERVAL) is False:  # bool(x) because `0 is False` is false. TIL
-            sleep(time_s.seconds)
-        else:
-            output = subprocess.check_output(
-                ["sudo", "-s", "rtcwake", "-m", "on", "-s", str(time_s.seconds)]
-            )
-            logger.debug(output.decode())
+    async def _connect(self) -> Tuple["asyncio.StreamReader", "asyncio.StreamWriter"]:
+        import asyncio
 
-    # convert timedelta to datetime
-    wakeup_date = datetime.date.today()
-    if (
-        time <= get_current_time_delta()
-    ):  # if time is less, then assume wakeup is tomorrow
-        wakeup_date += datetime.timedelta(days=1)
+        if "socket" in self.settings:
+            return await asyncio.open_unix_connection(self.settings["socket"])
+        return await asyncio.open_connection(
+            self.settings["host"], self.settings["port"]
+        )
 
-    time_to_wakeup = datetime.datetime.combine(wakeup_date, datetime.time.min) + time
+    async def _follow(
+        self, reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"
+    ) -> Optional[datetime.datetime]:
+        """
+        follows the coordinator's decisions till it says to sleep
+        :return: the instant to wake up at, None if the coordinator went away
+        """
+        await fleet_send(
+            writer,
+            {
+                "type": "hello",
+                "name": self.name,
+                "secret": self.settings.get("secret"),
+                "mac": self.mac,
+                "broadcast": self.settings.get("broadcast"),
+                "port": self.settings.get("wake port"),
+            },
+        )
+        logger.info("Connected to the fleet coordinator as %s", self.name)
+        while line := await reader.readline():
+            message = json.loads(line)
+            if message["type"] == "sleep":
+                until = datetime.datetime.fromtimestamp(message["until"]).astimezone()
+                if until <= now_local():
+                    continue
+                logger.info(
+                    "Coordinator says the internet is down, going to sleep until %s at the latest",
+                    until.strftime("%d/%b/%Y %H:%M:%S"),
+                )
+                await fleet_send(
+                    writer, {"type": "sleeping", "until": message["until"]}
+                )
+                return until
+            if message["type"] == "awake":
+                logger.info("Coordinator says the internet is up, staying awake")
+        return None
 
-    logger.info(
-        "Sleeping thread till: %s", time_to_wakeup.strftime("%d/%b/%Y %H:%M:%S")
-    )
-    # the sleep loop
-    _one_timedelta = datetime.timedelta(seconds=1)
-    _sleep_interval_timedelta = datetime.timedelta(seconds=SLEEP_INTERVAL)
-    while _one_timedelta < (
-        remaining_sleep_time := time_to_wakeup - datetime.datetime.now()
-    ):
-        # if sleep interval is defined use that, else use logarithmic time inspired by jgillick/python-pause
-        if SLEEP_INTERVAL:
-            __sleep_or_rtc_wake(min(remaining_sleep_time, _sleep_interval_timedelta))
-        else:
-            __sleep_or_rtc_wake(max(_one_timedelta, remaining_sleep_time / 2))
+    async def run(self):
+        """follows the coordinator forever"""
+        import asyncio
 
-    logger.debug("exit")
-    # extra delay seconds
-    sleep(1)
+        retry_in = 1
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except OSError as e:
+                logger.warning(
+                    "Unable to reach the fleet coordinator, retrying in %ds: %s",
+                    retry_in,
+                    e,
+                )
+                await asyncio.sleep(retry_in)
+                retry_in = min(retry_in * 2, 60)
+                continue
+            retry_in = 1
+            try:
+                until = await self._follow(reader, writer)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Lost the fleet coordinator: %s", e)
+                until = None
+            else:
+                if until is None:
+                    logger.warning("The fleet coordinator closed the connection")
+            finally:
+                writer.close()
+            if until is not None:
+                await run_blocking(self.suspend, until)
+            else:
+                await asyncio.sleep(retry_in)
 
 
-def sleep_or_suspend_until(time: int, mode: Literal["suspend", "sleep"]):
+async def run_blocking(function: Callable, *args, **kwargs):
     """
-    This function will take the time, and choice of the user to either: sleep the computer, or suspend the thread. aka
-    time.sleep() suspend.
-    Will also pause the program for a few seconds to give the computer time to connect to the wifi.
-    :param time: the "duration" of seconds to wake the computer/thread after the "current" time
-    :param mode:
-        - 'suspend': will time.sleep() the thread.
-        - 'sleep': will make the computer go to sleep.
-    :return:
+    runs a blocking function (rtcwake, the connectivity probes, ...) in a worker thread, so that the event loop stays
+    free for the other tasks
+    :param function: the blocking function
+    :return: whatever the function returns
     """
-    time = get_current_time_delta() + datetime.timedelta(seconds=time)
-    if mode == "suspend":
-        suspend_thread_until(time)
-    elif mode == "sleep":
-        sleep_computer_but_wake_at(time, debug=DEBUG)
-    else:
-        logger.error(
-            "'%s' is not a valid argument for parameter 'mode'. 'mode' can either be 'sleep' or 'suspend'",
-            mode,
-        )
-    DELAY = 5
-    logger.debug(
-        "%s is awake now, suspending the thread for %d more seconds...",
-        "computer" if mode == "sleep" else "program",
-        DELAY,
+    import asyncio
+
+    # asyncio.to_thread() would do, but it's python3.9+
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs)
     )
-    sleep(DELAY)
 
 
-"""
-                                                                                    
-    88           88               88                                   88               
-    88           ""               88                                   ""               
-    88                            88                                                    
-    88,dPPYba,   88   ,adPPYb,d8  88,dPPYba,   8b,dPPYba,  ,adPPYYba,  88  8b,dPPYba,   
-    88P'    "8a  88  a8"    `Y88  88P'    "8a  88P'   "Y8  ""     `Y8  88  88P'   `"8a  
-    88       d8  88  8b       88  88       d8  88          ,adPPPPP88  88  88       88  
-    88b,   ,a8"  88  "8a,   ,d88  88b,   ,a8"  88          88,    ,88  88  88       88  
-    8Y"Ybbd8"'   88   `"YbbdP"Y8  8Y"Ybbd8"'   88          `"8bbdP"Y8  88  88       88  
-                      aa,    ,88                                                        
-                       "Y8bbdP"                                                         
-                                                                                        
-                88                                    88                                            
-                88                                    ""                                            
-                88                                                                                  
-                88           ,adPPYba,    ,adPPYb,d8  88   ,adPPYba,                                
-                88          a8"     "8a  a8"    `Y88  88  a8"     ""                                
-                88          8b       d8  8b       88  88  8b                                        
-                88          "8a,   ,a8"  "8a,   ,d88  88  "8a,   ,aa                                
-                88888888888  `"YbbdP"'    `"YbbdP"Y8  88   `"Ybbd8"'                                
-                                          aa,    ,88                                                
-                                           "Y8bbdP"                                                 
-"""
+async def pause(seconds: float):
+    """
+    waits on the event loop, instead of holding a worker thread with a blocking sleep
+    :param seconds: how long to wait
+    :return: None
+    """
+    import asyncio
+
+    await asyncio.sleep(seconds)
 
 
-def wait_for_connectivity_to_change_to(
+async def wait_for_connectivity_to_change_to(
     req_connection_status: Literal["connected", "disconnected"],
     action: Literal["suspend", "sleep"],
     start_time: datetime.timedelta,
     end_time: datetime.timedelta,
     timeout: int = -1,
-    use_v2: Literal["v2", "v3", "v2+v3"] = "v2",
+    use_v2: Literal["v2", "v3", "v2+v3", "race"] = "v2",
 ) -> bool:
     """
     This function is partly big brain logic.
@@ -895,86 +4803,196 @@ def wait_for_connectivity_to_change_to(
     connection, then function will continue until computer connects to internet
     if wait for disconnection, then program will continue until the connectivity drops
     If computer/server is connected to the internet, then function will run until the connection drops
+    Every probe gets the phase's end time as its deadline, and gives up by itself when it's reached. a probe cut short
+    by the end of the phase is ignored and the function returns. it also returns when the config gets reloaded, to
+    re-plan.
     :param req_connection_status: the connection stage to wait
-    :param action: sleep/suspend the computer/thread when waiting for TIMEOUT duration to check for connectivity changes
-    :param start_time: the starting time of the current phase
-    :param end_time: the time till the function should check for connection changes
-    :param timeout: *Optional. -1 by default to use the default TIMEOUT. otherwise specify timeout
+    :param action: sleep/suspend the computer/thread when waiting for `timeout` duration to check for connectivity
+                   changes
+    :param start_time: the starting time of the current phase. the phase's instants come from the timeline, this is
+                       only logged & checked against the phase we're in
+    :param end_time: the time till the function should check for connection changes: the phase's end time, or its
+                     passive end time for the passive window
+    :param timeout: *Optional. -1 by default to use the config's default timeout. otherwise specify timeout
     :param use_v2: *Optional. which connectivity function to use. uses v2 by default
     :return: True/False if connection changed to what was asked
     """
     # convert connection types to a boolean dictionary
     con_val = {"connected": True, "disconnected": False}
     # We start with an infinite loop.
-    logger.info("Waiting for connectivity to change to '%s'...", req_connection_status)
-    # PRocess end_time to account for cur_time < 12am but end_time > 12am
-    phase = {
-        "start time": start_time,
-        "end time": end_time,
-    }
+    logger.info(
+        "Waiting for connectivity to change to '%s' (%s - %s)...",
+        req_connection_status,
+        start_time,
+        end_time,
+    )
+    # the config this wait was planned with. a reloaded config ends the wait (REPLAN), so it never changes midway
+    config = CONFIG
+    # the phase we're in & the instant it ends, from the timeline, so DST & phases crossing midnight are accounted for
+    phase_name, phase_end = config.timeline.phase_at()
+    current_phase = next(
+        (_phase for _phase in config.phases if _phase.name == phase_name), None
+    )
+    # the passive window ends `timeout` before the phase does. the timedeltas only tell which window we were asked for
+    passive = current_phase is not None and end_time == current_phase.passive_end_time
+    # the instant to stop waiting at. nothing to wait for if we're not in the phase we were asked to wait in
+    if current_phase is None or current_phase.start_time != start_time:
+        deadline = now_local()
+    elif passive:
+        deadline = phase_end - current_phase.timeout_delta
+    else:
+        deadline = phase_end
     # the connectivity check function to use
-    connectivity_method = connectivity_function_factory(use_v2)
+    connectivity_method = timed_connectivity_function_factory(use_v2)
+    # only the passive windows, probed every phase timeout, are adapted. the end of phase windows keep their fixed rate
+    adaptive = config.adaptive_scheduler is not None and passive
+    if adaptive:
+        summary = config.adaptive_scheduler.summary(
+            current_phase, datetime.date.today().weekday(), current_phase.timeout
+        )
+        logger.info(
+            "Adaptive schedule for %s: ~%d wakeups & ~%.0fs expected detection latency "
+            "(fixed timeout: %d wakeups, %.0fs)",
+            phase_name,
+            summary["adaptive wakeups"],
+            summary["adaptive latency"],
+            summary["fixed wakeups"],
+            summary["fixed latency"],
+        )
 
-    while current_time_within_time_range(phase):
+    while now_local() < deadline:
+        if REPLAN.is_set():
+            logger.info("Config was reloaded, stopped waiting to re-plan")
+            return False
+        # keep the suspend tracker's samples dense, so suspends we didn't start are timed accurately too
+        SUSPEND_TRACKER.sample()
+        if SPANS.pending("resumed", "link up") and link_is_up():
+            SPANS.since("resumed", "link up")
         # We check now the status of internet connection.
-        status, _ = connectivity_method(CONNECTION_TYPE)
+        probe_start = monotonic()
+        SPANS.since("resumed", "resume", until=probe_start)
+        # the probe gets the rest of the phase, and gives up by itself when it ends instead of being left running
+        status, devices, rtt = await run_blocking(
+            connectivity_method,
+            config.connection_type,
+            (deadline - now_local()).total_seconds(),
+        )
+        if now_local() >= deadline and status != con_val[req_connection_status]:
+            logger.warning(
+                "Phase ended while checking connectivity, ignoring the check"
+            )
+            break
+        probe_duration = monotonic() - probe_start
+        SPANS.record("probe", probe_duration)
+        METRICS.probe(use_v2, status, probe_duration)
+        if status and SPANS.since("resumed", "first successful probe") is not None:
+            logger.debug(
+                "Stage latencies since start (count, p50, p95, p99 seconds): %s",
+                SPANS.summary(),
+            )
+        PROBE_STORE.append(
+            use_v2,
+            phase_name,
+            status,
+            probe_duration,
+            rtt,
+            devices,
+        )
+
+        # alerts that were queued while we were offline can go out now
+        if status and config.bot_token and config.chat_id:
+            NOTIFIER.flush()
 
         # Now check if the internet status is the same as required status' boolean value
         if status == con_val[req_connection_status]:
             old = "disconnected" if con_val[req_connection_status] else "connected"
             new = "connected" if status else "disconnected"
             logger.info("Connection status has been changed! (%s -> %s)", old, new)
+            SPANS.mark("changed")
             return True
-        # If the internet status is not what is required, then we just wait for TIMEOUT duration and check back
+        # If the internet status is not what is required, then we just wait for `timeout` duration and check back
         # again
         else:
             # refresh timeout
-            timeout = TIMEOUT if timeout == -1 else timeout
-            sleep_or_suspend_until(timeout, action)
+            timeout = config.timeout if timeout == -1 else timeout
+            probe_interval = timeout
+            if adaptive:
+                probe_interval = (
+                    config.adaptive_scheduler.interval(
+                        phase_name, datetime.datetime.now()
+                    )
+                    or timeout
+                )
+                if action == "sleep":
+                    # every probe costs a suspend & resume cycle, don't do them too often. still within min/max
+                    probe_interval = max(
+                        probe_interval, config.adaptive_scheduler.min_suspend
+                    )
+                logger.debug("Next probe in %.1f seconds", probe_interval)
+            if (
+                config.wake_planner is not None
+                and action == "sleep"
+                and current_phase is config.morning
+            ):
+                planned = config.wake_planner.next_wake(
+                    datetime.datetime.now(),
+                    (deadline - now_local()).total_seconds(),
+                )
+                if planned is not None:
+                    probe_interval = planned
+                    logger.info(
+                        "Router usually comes up by then, next wakeup in %s",
+                        datetime.timedelta(seconds=round(planned)),
+                    )
+            # if we're only suspending the thread, let the kernel wake us up on link changes instead of polling.
+            monitor = get_link_monitor() if action == "suspend" else None
+            if monitor is not None:
+                # v2 only looks at link state, so nothing can change without an event. wait till the phase ends.
+                # other methods ping the gateway, so keep polling at `timeout` but wake up early on link events
+                wait_time = (deadline - now_local()).total_seconds()
+                if use_v2 != "v2":
+                    wait_time = min(wait_time, probe_interval)
+                elif config.sleep_interval:
+                    # select() doesn't count the time the computer spends suspended
+                    wait_time = min(wait_time, config.sleep_interval)
+                if await monitor.wait_async(wait_time):
+                    logger.debug(
+                        "Kernel reported a link change, checking connectivity..."
+                    )
+                continue
+            await run_blocking(sleep_or_suspend_until, probe_interval, action)
+            delay = WAKE_DELAY[action] + PROBE_WAKE_DELAY
+            logger.debug(
+                "%s is awake now, waiting %d more seconds...",
+                "computer" if action == "sleep" else "program",
+                delay,
+            )
+            await pause(delay)
             continue
     logger.info("Connectivity did not change in the specified time.")
     return False
 
 
-"""
-                888b     d888        d8888 8888888 888b    888 
-                8888b   d8888       d88888   888   8888b   888 
-                88888b.d88888      d88P888   888   88888b  888 
-                888Y88888P888     d88P 888   888   888Y88b 888 
-                888 Y888P 888    d88P  888   888   888 Y88b888 
-                888  Y8P  888   d88P   888   888   888  Y88888 
-                888   "   888  d8888888888   888   888   Y8888 
-                888       888 d88P     888 8888888 888    Y888 
-"""
-
-if __name__ == "__main__":
-
-    print(
-        """
-    12-hour-server/smart_sleep  Copyright (C) 2021-22  Roguedbear
-    This program comes with ABSOLUTELY NO WARRANTY.
-    This is free software, and you are welcome to redistribute it
-    under certain conditions
+async def main_loop(
+    LAST_SLEEP_TIME: datetime.datetime, config_file: Optional[str] = None
+):
     """
-    )
-    sleep(2)
+    The core of the program. the phase logic below runs as the main task, while telegram alerts are delivered by the
+    notifier's thread and logs are written by the log listener's thread, so that a slow notification, a slow disk or a
+    hung probe never delays a phase transition.
+    Every round is planned with the config active at its start. when the config file is edited, the new config is
+    swapped in and the round in progress stops waiting, so the next one re-plans with it.
+    As a fleet coordinator, the sleep & wake decisions are also pushed to the agents, and the morning phase is spent
+    awake, to wake the agents up with Wake-on-LAN as soon as the internet is back.
+    :param LAST_SLEEP_TIME: the last time the computer went to sleep
+    :param config_file: the config file to reload when it's edited. not watched if None
+    :return: None, runs forever
+    """
+    import asyncio
 
-    LAST_SLEEP_TIME = get_last_sleep_time()
     LAST_SLEEP_TIME_byProgram = datetime.datetime.min
     _wake_up_message_sent = False
     debug = False
-    # if debug:
-    #     config_loader()
-    #     logger.debug("Testing check_connected_to_internetV2() function:")
-    #     logger.debug("Result:" + Fore.CYAN + str(check_connected_to_internetV2()))
-    #
-    #     # test sleep function
-    #     delta = get_current_time_delta() + datetime.timedelta(seconds=10)
-    #     # sleep_computer_but_wake_at(delta, debug=True)
-    #
-    #     print(get_nearest_phaseV2(MORNING_PHASE, NIGHT_PHASE))
-    #
-    #     sleep_or_suspend_until(10, "suspend")
 
     # The main big brain logic of the program
     """Pseudocode:
@@ -986,157 +5004,277 @@ if __name__ == "__main__":
     * if internet is not there, wait 5-10 minute (or WIFI_Wait).
         * if internet still not there, sleep until morning phase
     * if we're within ~night phase->timeout seconds of `end time` of the NIGHT PHASE, go to sleep
-    
+
     - MORNING PHASE
     * wakey wakey and see if internet is connected. after waiting 60 seconds giving the computer oppurtunity to connect
     * if internet not there, sleep and check again in morning phase->timeout seconds
     * if internet there no problem. awake, sleep until NighPhase
-    * if we're within ~morning-phase->timeout seconds of `end time` of morning phase, we'll go awake and sleep the 
+    * if we're within ~morning-phase->timeout seconds of `end time` of morning phase, we'll go awake and sleep the
         thread until NIGHT PHASE arrives
-    
+
     - NEITHER
-    * if we're in neither phase (possibly cuz you ran the program at your own will), suspend the thread if nearest is 
+    * if we're in neither phase (possibly cuz you ran the program at your own will), suspend the thread if nearest is
       NIGHT, else sleep if the nearest is morning
     """
-    config_data = config_loader()
-    logging_level = config_data.get("logging level", 10)
-    logger.setLevel(logging_level)
-    connectivity_method = config_data["connectivity_method"]
+    watcher = watch_config(config_file) if config_file is not None else None
+    # with a fleet, the coordinator stays awake through the morning phase to wake the agents up when the internet is back
+    fleet = None
+    if CONFIG.fleet is not None and CONFIG.fleet["role"] == "coordinator":
+        fleet = FleetCoordinator(CONFIG.fleet)
+        await fleet.start()
     # Alright, let's start.
-    while True:
-        go_to_sleep = False
-        be_awake = False
-
-        # Check if we're in NIGHT PHASE
-        if current_time_within_time_range(NIGHT_PHASE):
-            logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} night phase")
-            _wake_up_message_sent = False
-            # In the night mode, check if we're nearing the end time, if yes then check *vigorously* for connectivity
-            # changes
-            if current_time_within_time_range(
-                {
-                    "start time": NIGHT_PHASE["end time"]
-                    - datetime.timedelta(seconds=NIGHT_PHASE["timeout"]),
-                    "end time": NIGHT_PHASE["end time"],
-                }
-            ):
-                go_to_sleep = wait_for_connectivity_to_change_to(
-                    "disconnected",
-                    "suspend",
-                    NIGHT_PHASE["start time"],
-                    NIGHT_PHASE["end time"],
-                    5,
-                    connectivity_method,
-                )
+    try:
+        while True:
+            go_to_sleep = False
+            be_awake = False
+            REPLAN.clear()
+            config = CONFIG
+            night, morning = config.night, config.morning
+            connectivity_method = config.connectivity_method
+            current_phase, phase_end = config.timeline.phase_at()
+            METRICS.set_phase(current_phase, config.timeline.next_transition())
+            time_left = (phase_end - now_local()).total_seconds()
 
-            # Otherwise passively check for connectivity changes till
-            else:
-                go_to_sleep = wait_for_connectivity_to_change_to(
-                    "disconnected",
-                    "suspend",
-                    NIGHT_PHASE["start time"],
-                    NIGHT_PHASE["end time"]
-                    - datetime.timedelta(seconds=NIGHT_PHASE["timeout"]),
-                    NIGHT_PHASE["timeout"],
-                    connectivity_method,
-                )
+            # Check if we're in NIGHT PHASE
+            if current_phase == night.name:
+                logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} night phase")
+                _wake_up_message_sent = False
+                # In the night mode, check if we're nearing the end time, if yes then check *vigorously* for
+                # connectivity changes
+                if time_left <= night.timeout:
+                    go_to_sleep = await wait_for_connectivity_to_change_to(
+                        "disconnected",
+                        "suspend",
+                        night.start_time,
+                        night.end_time,
+                        5,
+                        connectivity_method,
+                    )
 
-        # Check if we're in MORNING PHASE now
-        elif current_time_within_time_range(MORNING_PHASE):
-            logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} morning phase.")
-            # Check if we're nearing the end time. ig yes, then check vigorously
-
-            if current_time_within_time_range(
-                {
-                    "start time": MORNING_PHASE["end time"]
-                    - datetime.timedelta(seconds=MORNING_PHASE["timeout"]),
-                    "end time": MORNING_PHASE["end time"],
-                }
-            ):
-                be_awake = wait_for_connectivity_to_change_to(
-                    "connected",
-                    "suspend",
-                    MORNING_PHASE["start time"],
-                    MORNING_PHASE["end time"],
-                    60,
-                    connectivity_method,
-                )
+                # Otherwise passively check for connectivity changes till
+                else:
+                    go_to_sleep = await wait_for_connectivity_to_change_to(
+                        "disconnected",
+                        "suspend",
+                        night.start_time,
+                        night.passive_end_time,
+                        night.timeout,
+                        connectivity_method,
+                    )
+
+            # Check if we're in MORNING PHASE now
+            elif current_phase == morning.name:
+                logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} morning phase.")
+                # Check if we're nearing the end time. ig yes, then check vigorously
+
+                if time_left <= morning.timeout:
+                    be_awake = await wait_for_connectivity_to_change_to(
+                        "connected",
+                        "suspend",
+                        morning.start_time,
+                        morning.end_time,
+                        60,
+                        connectivity_method,
+                    )
+                else:
+                    be_awake = await wait_for_connectivity_to_change_to(
+                        "connected",
+                        "sleep" if fleet is None else "suspend",
+                        morning.start_time,
+                        morning.passive_end_time,
+                        morning.timeout,
+                        connectivity_method,
+                    )
+
+            # here we see which phase is the nearest to us and take actions accordingly
             else:
-                be_awake = wait_for_connectivity_to_change_to(
-                    "connected",
-                    "sleep",
-                    MORNING_PHASE["start time"],
-                    MORNING_PHASE["end time"]
-                    - datetime.timedelta(seconds=MORNING_PHASE["timeout"]),
-                    MORNING_PHASE["timeout"],
-                    connectivity_method,
-                )
+                logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} neither phase")
+                next_start, nearest_phase = config.timeline.next_transition()
 
-        # here we see which phase is the nearest to us and take actions accordingly
-        else:
-            logger.info(f"Computer is in {Fore.LIGHTMAGENTA_EX} neither phase")
-            nearest_phase = get_nearest_phaseV2(NIGHT_PHASE, MORNING_PHASE)
+                # If nearest phase is the morning phase then sleep the computer until morning phase
+                if nearest_phase == morning.name:
+                    logger.info(
+                        "NIGHT PHASE has passed. Computer is going to sleep until: %s",
+                        next_start.strftime("%d/%b/%Y %H:%M:%S"),
+                    )
+                    LAST_SLEEP_TIME_byProgram = datetime.datetime.now()
+                    if fleet is not None:
+                        # the agents wake up by the end of the morning phase by themselves, if no magic packet comes
+                        await fleet.sleep(config.timeline.phase_at(next_start)[1])
+                    await run_blocking(
+                        sleep_computer_but_wake_at,
+                        next_start,
+                        debug=debug,
+                    )
+                    await pause(WAKE_DELAY["sleep"])
+                elif nearest_phase == night.name:
+                    if _wake_up_message_sent is False:
+                        _wake_up_message_sent = True
+
+                        logger.info(
+                            "MORNING PHASE's 'end time' has passed. Computer will be awake now and wait till %s.",
+                            next_start.strftime("%d/%b/%Y %H:%M:%S"),
+                        )
+                        alert_onTelegram(
+                            "Computer is awake, and internet is back up at this time.\nLast sleep time: "
+                            f"`{LAST_SLEEP_TIME.strftime('%b %d %H:%M:%S')}` "
+                        )
+                        if fleet is not None:
+                            await fleet.wake()
+                    await run_blocking(suspend_thread_until, next_start)
+                    await pause(WAKE_DELAY["suspend"])
 
-            # If nearest phase is MORNING_PHASE then sleep the computer until morning phase
-            if nearest_phase[0] == "MORNING PHASE":
+            # If the internet goes out early
+            if go_to_sleep:
+                wake_at = config.timeline.next_start(morning.name)
                 logger.info(
-                    "NIGHT PHASE has passed. Computer is going to sleep until: %s",
-                    repr_time_delta(MORNING_PHASE["start time"]),
+                    "Internet went down early than the 'end time'. going to sleep until %s...",
+                    wake_at.strftime("%d/%b/%Y %H:%M:%S"),
                 )
+                # LAST_SLEEP_TIME = datetime.datetime.now()
                 LAST_SLEEP_TIME_byProgram = datetime.datetime.now()
-                sleep_computer_but_wake_at(MORNING_PHASE["start time"], debug=debug)
-            elif nearest_phase[0] == "NIGHT PHASE":
-                if _wake_up_message_sent is False:
-                    _wake_up_message_sent = True
+                # we're offline, so this waits in the outbox until we're connected again
+                alert_onTelegram(
+                    "Internet went down, going to sleep at: `{}`".format(
+                        LAST_SLEEP_TIME_byProgram.strftime("%b %d %H:%M:%S")
+                    )
+                )
+                if fleet is not None:
+                    await fleet.sleep(config.timeline.phase_at(wake_at)[1])
+                await run_blocking(sleep_computer_but_wake_at, wake_at, debug=debug)
+                await pause(WAKE_DELAY["sleep"])
+                LAST_SLEEP_TIME = await run_blocking(get_last_sleep_time)
 
-                    logger.info(
-                        "MORNING PHASE's 'end time' has passed. Computer will be awake now and wait till %s.",
-                        repr_time_delta(NIGHT_PHASE["start time"]),
+            # If internet comes back in early
+            if be_awake:
+                resume_at = config.timeline.next_start(night.name)
+                logger.info(
+                    "Internet back up! will resume the program at: %s",
+                    resume_at.strftime("%d/%b/%Y %H:%M:%S"),
+                )
+                alert_onTelegram(
+                    "Hello There!\nToday the internet came back quite early.\nLast sleep time: `{}`".format(
+                        LAST_SLEEP_TIME_byProgram.strftime("%b %d %H:%M:%S")
+                        if LAST_SLEEP_TIME_byProgram != datetime.datetime.min
+                        else LAST_SLEEP_TIME.strftime("%b %d %H:%M:%S")
                     )
-                    while True:
-                        try:
-                            alert_onTelegram(
-                                "Computer is awake, and internet is back up at this time.\nLast sleep time: "
-                                f"`{LAST_SLEEP_TIME.strftime('%b %d %H:%M:%S')}` "
-                            )
-                            break
-                        except requests.exceptions.ConnectionError:
-                            sleep(5)
-                            continue
-                suspend_thread_until(NIGHT_PHASE["start time"])
+                )
+                if fleet is not None:
+                    await fleet.wake()
+                await run_blocking(suspend_thread_until, resume_at)
+                await pause(WAKE_DELAY["suspend"])
+    finally:
+        if watcher is not None:
+            asyncio.get_running_loop().remove_reader(watcher.fd)
+            watcher.close()
+        if fleet is not None:
+            await fleet.close()
+        flush_logs()
 
-        # If the internet goes out early
-        if go_to_sleep:
-            logger.info(
-                "Internet went down early than the 'end time'. going to sleep until %s...",
-                repr_time_delta(
-                    MORNING_PHASE["start time"]
-                    if get_current_time_delta() < MORNING_PHASE["start time"]
-                    else MORNING_PHASE["start time"] + datetime.timedelta(hours=24)
-                ),
-            )
-            # LAST_SLEEP_TIME = datetime.datetime.now()
-            LAST_SLEEP_TIME_byProgram = datetime.datetime.now()
-            sleep_computer_but_wake_at(MORNING_PHASE["start time"], debug=debug)
-            LAST_SLEEP_TIME = get_last_sleep_time()
 
-        # If internet comes back in early
-        if be_awake:
-            logger.info(
-                "Internet back up! will resume the program at: %s",
-                repr_time_delta(NIGHT_PHASE["start time"]),
-            )
-            while True:
-                try:
-                    alert_onTelegram(
-                        "Hello There!\nToday the internet came back quite early.\nLast sleep time: `{}`".format(
-                            LAST_SLEEP_TIME_byProgram.strftime("%b %d %H:%M:%S")
-                            if LAST_SLEEP_TIME_byProgram != datetime.datetime.min
-                            else LAST_SLEEP_TIME.strftime("%b %d %H:%M:%S")
-                        )
-                    )
-                    break
-                except Exception:
-                    sleep(5)
-                    continue
-            suspend_thread_until(NIGHT_PHASE["start time"])
+"""
+                888b     d888        d8888 8888888 888b    888 
+                8888b   d8888       d88888   888   8888b   888 
+                88888b.d88888      d88P888   888   88888b  888 
+                888Y88888P888     d88P 888   888   888Y88b 888 
+                888 Y888P 888    d88P  888   888   888 Y88b888 
+                888  Y8P  888   d88P   888   888   888  Y88888 
+                888   "   888  d8888888888   888   888   Y8888 
+                888       888 d88P     888 8888888 888    Y888 
+"""
+
+if __name__ == "__main__":
+    init_console()
+    parser = argparse.ArgumentParser(
+        description="put the home server to sleep when the internet goes down at night, and wake it up the next day"
+    )
+    subcommands = parser.add_subparsers(dest="command")
+    stats_parser = subcommands.add_parser(
+        "stats", help="uptime, outage windows & probe latencies from the probe store"
+    )
+    stats_parser.add_argument(
+        "--days", type=int, default=30, help="how many days to look back"
+    )
+    stats_parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="also show what the adaptive timeout achieves (loads config.yaml)",
+    )
+    stats_parser.add_argument(
+        "--wakes",
+        action="store_true",
+        help="also compare the planned morning wakeups against the fixed timeout (loads config.yaml)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print the phase transitions of the next week and exit (loads config.yaml)",
+    )
+    arguments = parser.parse_args()
+
+    if arguments.plan:
+        logger.setLevel(logging.WARNING)
+        config_loader()
+        print_plan()
+        quit(0)
+
+    if arguments.command == "stats":
+        print_stats(arguments.days)
+        if arguments.schedule or arguments.wakes:
+            logger.setLevel(logging.WARNING)
+            config_loader()
+        if arguments.schedule:
+            print("\nAdaptive schedule (per phase, vs the fixed timeout):")
+            print_schedule()
+        if arguments.wakes:
+            print("\nMorning wakeups (planned vs every morning phase->timeout):")
+            print_wake_plan()
+        quit(0)
+
+    print(
+        """
+    12-hour-server/smart_sleep  Copyright (C) 2021-22  Roguedbear
+    This program comes with ABSOLUTELY NO WARRANTY.
+    This is free software, and you are welcome to redistribute it
+    under certain conditions
+    """
+    )
+
+    # if debug:
+    #     config_loader()
+    #     logger.debug("Testing check_connected_to_internetV2() function:")
+    #     logger.debug("Result:" + Fore.CYAN + str(check_connected_to_internetV2()))
+    #
+    #     # test sleep function
+    #     delta = get_current_time_delta() + datetime.timedelta(seconds=10)
+    #     # sleep_computer_but_wake_at(delta, debug=True)
+    #
+    #     sleep_or_suspend_until(10, "suspend")
+
+    try:
+        config_data = read_config()
+    except ConfigError:
+        quit(1)
+    # scanning the syslog for the last sleep time can take a while, so it's done while the config is compiled
+    from concurrent.futures import ThreadPoolExecutor
+
+    last_sleep_lookup = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="last sleep"
+    ).submit(get_last_sleep_time, config_data.get("sleep_detection", "auto"))
+    try:
+        config = compile_config(config_data)
+    except ConfigError:
+        quit(1)
+    apply_config(config)
+    logger.setLevel(config.logging_level)
+    if config.metrics is not None:
+        serve_metrics(config.metrics)
+    LAST_SLEEP_TIME = last_sleep_lookup.result()
+    import asyncio
+
+    # Alright, let's start.
+    if config.fleet is not None and config.fleet["role"] == "agent":
+        # the coordinator probes & follows the phases, an agent only does what it's told
+        asyncio.run(FleetAgent(config.fleet).run())
+    else:
+        asyncio.run(main_loop(LAST_SLEEP_TIME, "config.yaml"))